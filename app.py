@@ -2,22 +2,39 @@
 Application principale Flask - Avena SAV
 Dashboard de gestion des emails SAV avec IA
 """
+import atexit
 import os
 import re
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+import secrets
+import traceback
+from collections import Counter
+from flask import Flask, Response, abort, render_template, request, jsonify, redirect, url_for, session, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from datetime import datetime
-import threading
+from email import policy as email_policy
+from email.parser import BytesHeaderParser, BytesParser
+from email.utils import getaddresses, parseaddr, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from functools import lru_cache
 import time
 import logging
+import orjson
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, object_session
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from config import get_config
-from models import db, Email, ShopifyToken, SentEmail
+from models import db, Email, ShopifyToken, SentEmail, MailboxState, Settings, upgrade_schema
 from modules.email_handler import ZohoEmailHandler, test_zoho_connection
 from modules.shopify_handler import ShopifyHandler, test_shopify_connection
-from modules.ai_responder import AIResponder, test_ai_connection
-from modules.shopify_oauth import ShopifyOAuth, ShopifyTokenStorage, ShopifyTokenStorageDB, get_oauth_handler, get_oauth_handler_for_shop, get_permanent_access_token
+from modules.ai_responder import AIResponder, BatchJobFailed, test_ai_connection
+from modules.shopify_oauth import ShopifyOAuth, ShopifyTokenStorage, ShopifyTokenStorageDB, get_oauth_handler, get_oauth_handler_for_shop, get_permanent_access_token, get_shopify_credentials
 from modules.parcelpanel_handler import get_parcelpanel_manager, test_parcelpanel_connection
+from modules.spam_detector import (
+    detect_spam, add_spam_sender_pattern, add_spam_subject_pattern,
+    SPAM_SENDER_PATTERNS, SPAM_SUBJECT_PATTERNS, SPAM_BODY_PATTERNS
+)
 
 # Configuration logging
 logging.basicConfig(
@@ -26,6 +43,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Les 7 shops attendus pour Parcelpanel
+_EXPECTED_PP_SHOPS = (
+    'tgir1c-x2',  # FR
+    'qk16wv-2e',  # NL
+    'jl1brs-gp',  # ES
+    'pz5e9e-2e',  # IT
+    'u06wln-hf',  # DE
+    'xptmak-r7',  # PL
+    'fyh99s-h9'   # EN
+)
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Sérialisation JSON via orjson (beaucoup plus rapide que json de la stdlib)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 def create_app():
     """Factory pour crÃ©er l'application Flask"""
@@ -35,6 +73,10 @@ def create_app():
     config = get_config()
     app.config.from_object(config)
 
+    # Toutes les réponses jsonify() et request.get_json() passent par orjson
+    app.json_provider_class = ORJSONProvider
+    app.json = ORJSONProvider(app)
+
     # Support pour les proxys (Railway, Heroku, etc.)
     # Permet Ã  Flask de dÃ©tecter correctement HTTPS derriÃ¨re un reverse proxy
     app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
@@ -47,6 +89,7 @@ def create_app():
 
     with app.app_context():
         db.create_all()
+        upgrade_schema()
 
     return app
 
@@ -55,7 +98,6 @@ app = create_app()
 
 # Handlers globaux (initialisÃ©s au premier besoin)
 email_handler = None
-shopify_handlers = {}  # Dict de handlers par shop
 ai_responder = None
 token_storage = None
 
@@ -82,18 +124,17 @@ def get_email_handler():
     return email_handler
 
 
-def get_shopify_handler(shop_name: str = None):
+def get_shopify_handler(shop_name: str = None, access_token: str = None):
     """
     Lazy loading du handler Shopify pour un shop spÃ©cifique
 
     Args:
         shop_name: Nom du shop (ex: avena-paris). Si None, utilise le shop par dÃ©faut.
+        access_token: Token dÃ©jÃ  rÃ©cupÃ©rÃ© (Ã©vite de le rechercher en base)
 
     Returns:
         ShopifyHandler ou None si aucun token disponible
     """
-    global shopify_handlers
-
     # Si pas de shop spÃ©cifiÃ©, essaie le shop par dÃ©faut
     if shop_name is None:
         shop_name = app.config.get('SHOPIFY_SHOP_NAME')
@@ -103,17 +144,14 @@ def get_shopify_handler(shop_name: str = None):
         storage = get_token_storage_instance()
         shops = storage.get_all_shops()
         if shops:
-            shop_name = list(shops.keys())[0]
+            shop_name = next(iter(shops))
         else:
             logger.warning("Aucun shop Shopify configurÃ©")
             return None
 
-    # VÃ©rifie si on a dÃ©jÃ  un handler pour ce shop
-    if shop_name in shopify_handlers:
-        return shopify_handlers[shop_name]
-
     # 1. D'abord essaie les tokens permanents configurÃ©s dans SHOPIFY_CREDENTIALS
-    access_token = get_permanent_access_token(shop_name)
+    if not access_token:
+        access_token = get_permanent_access_token(shop_name)
 
     # 2. Si pas de token permanent, essaie le storage DB/fichier (OAuth)
     if not access_token:
@@ -128,24 +166,30 @@ def get_shopify_handler(shop_name: str = None):
         logger.warning(f"Pas de token disponible pour {shop_name}")
         return None
 
-    # CrÃ©e le handler
-    handler = ShopifyHandler(
+    return _build_shopify_handler(shop_name, access_token)
+
+
+@lru_cache(maxsize=32)
+def _build_shopify_handler(shop_name: str, access_token: str) -> ShopifyHandler:
+    """Cache des handlers Shopify par (shop, token) - thread-safe, un nouveau token crée un nouveau handler"""
+    return ShopifyHandler(
         shop_name=shop_name,
         access_token=access_token
     )
 
-    shopify_handlers[shop_name] = handler
-    return handler
-
 
 def get_all_shopify_handlers():
     """Retourne les handlers pour tous les shops connectÃ©s"""
     storage = get_token_storage_instance()
     shops = storage.get_all_shops()
 
+    # Tous les tokens en une seule requête (au lieu d'une par shop)
+    tokens = storage.get_tokens_bulk(list(shops.keys()))
+
     handlers = {}
     for shop_name in shops.keys():
-        handler = get_shopify_handler(shop_name)
+        access_token = get_permanent_access_token(shop_name) or tokens.get(shop_name)
+        handler = get_shopify_handler(shop_name, access_token=access_token)
         if handler:
             handlers[shop_name] = handler
 
@@ -158,8 +202,10 @@ def get_ai_responder():
     if ai_responder is None:
         # Utilise Gemini en priorité, fallback sur Anthropic
         api_key = app.config.get('GEMINI_API_KEY') or app.config.get('ANTHROPIC_API_KEY')
+        # Cles supplementaires (GEMINI_API_KEYS) : rotation automatique quand une cle atteint sa limite
+        api_keys = list(dict.fromkeys(key for key in [api_key, *app.config.get('GEMINI_API_KEYS', [])] if key))
         ai_responder = AIResponder(
-            api_key=api_key,
+            api_key=api_keys or api_key,
             company_name=app.config.get('COMPANY_NAME', 'Avena Paris')
         )
     return ai_responder
@@ -184,26 +230,20 @@ def settings():
 @app.route('/stores')
 def stores():
     """Page de gestion des stores Shopify connectÃ©s"""
-    import json
-
     # RÃ©cupÃ¨re les shops connectÃ©s via OAuth (DB)
     storage = get_token_storage_instance()
     connected_shops = storage.get_all_shops()
 
     # Ajoute aussi les shops avec access_token permanent dans SHOPIFY_CREDENTIALS
-    credentials_json = os.environ.get('SHOPIFY_CREDENTIALS', '{}')
-    try:
-        credentials = json.loads(credentials_json)
-        for shop_key, creds in credentials.items():
-            if creds.get('access_token') and shop_key not in connected_shops:
-                connected_shops[shop_key] = {
-                    'shop_domain': f"{shop_key}.myshopify.com",
-                    'shop_name': shop_key,
-                    'connected_at': 'Permanent Token',
-                    'permanent': True
-                }
-    except json.JSONDecodeError:
-        pass
+    # (parsé une seule fois, voir get_shopify_credentials)
+    for shop_key, creds in get_shopify_credentials().items():
+        if creds.get('access_token') and shop_key not in connected_shops:
+            connected_shops[shop_key] = {
+                'shop_domain': f"{shop_key}.myshopify.com",
+                'shop_name': shop_key,
+                'connected_at': 'Permanent Token',
+                'permanent': True
+            }
 
     return render_template('stores.html', shops=connected_shops)
 
@@ -235,11 +275,9 @@ def shopify_install():
         oauth = get_oauth_handler_for_shop(shop)
 
         # GÃ©nÃ¨re une clÃ© state pour la sÃ©curitÃ© CSRF
-        import secrets
         state = secrets.token_urlsafe(32)
 
         # Stocke le state en session
-        from flask import session
         session['shopify_oauth_state'] = state
         session['shopify_oauth_shop'] = shop
 
@@ -280,7 +318,6 @@ def shopify_callback():
                                error="ParamÃ¨tres manquants dans le callback OAuth")
 
     # VÃ©rifie le state (protection CSRF)
-    from flask import session
     expected_state = session.get('shopify_oauth_state')
     if state and expected_state and state != expected_state:
         return render_template('oauth_error.html',
@@ -311,10 +348,8 @@ def shopify_callback():
         session.pop('shopify_oauth_state', None)
         session.pop('shopify_oauth_shop', None)
 
-        # Invalide le cache du handler pour ce shop
-        shop_key = shop.replace('.myshopify.com', '')
-        if shop_key in shopify_handlers:
-            del shopify_handlers[shop_key]
+        # Invalide le cache des handlers
+        _build_shopify_handler.cache_clear()
 
         logger.info(f"Shop {shop} connectÃ© avec succÃ¨s")
 
@@ -333,9 +368,8 @@ def shopify_disconnect(shop_name):
     storage = get_token_storage_instance()
     storage.remove_token(shop_name)
 
-    # Invalide le cache du handler
-    if shop_name in shopify_handlers:
-        del shopify_handlers[shop_name]
+    # Invalide le cache des handlers
+    _build_shopify_handler.cache_clear()
 
     logger.info(f"Shop {shop_name} dÃ©connectÃ©")
 
@@ -374,48 +408,49 @@ def get_emails():
     """RÃ©cupÃ¨re la liste des emails"""
     status = request.args.get('status', 'pending')
 
-    query = Email.query
+    # has_reply calculé par la base (EXISTS corrélé sur colonnes indexées) - CASE INSENSITIVE
+    has_reply = db.exists().where(db.or_(
+        SentEmail.original_email_id == Email.id,
+        SentEmail.recipient_email_ci == Email.sender_email_ci
+    )).label('has_reply')
+    query = db.select(Email, has_reply)
 
     if status != 'all':
-        query = query.filter_by(status=status)
-
-    emails = query.order_by(Email.received_at.desc()).all()
+        query = query.where(Email.status == status)
 
-    # Ajoute l'info has_reply pour chaque email
     emails_data = []
-    for e in emails:
+    for e, replied in db.session.execute(query.order_by(Email.received_at.desc())):
         email_dict = e.to_dict()
-        # Vérifie si on a une réponse envoyée pour cet email - CASE INSENSITIVE
-        sender_lower = e.sender_email.lower() if e.sender_email else ''
-        has_reply = SentEmail.query.filter(
-            (SentEmail.original_email_id == e.id) |
-            (db.func.lower(SentEmail.recipient_email) == sender_lower)
-        ).first() is not None
-        email_dict['has_reply'] = has_reply
+        email_dict['has_reply'] = bool(replied)
         emails_data.append(email_dict)
 
     return jsonify({
         'success': True,
         'emails': emails_data,
-        'count': len(emails)
+        'count': len(emails_data)
     })
 
 
 @app.route('/api/debug/sent-emails', methods=['GET'])
 def debug_sent_emails():
     """Debug: Liste des emails envoyés et correspondances"""
-    sent_emails = SentEmail.query.limit(20).all()
-    received_emails = Email.query.limit(20).all()
+    # Une requête par table : échantillon (adresses déjà en minuscules) + total via COUNT(*) OVER ()
+    sent_rows = db.session.execute(
+        db.select(SentEmail.recipient_email_ci, db.func.count().over()).limit(20)
+    ).all()
+    received_rows = db.session.execute(
+        db.select(Email.sender_email_ci, db.func.count().over()).limit(20)
+    ).all()
 
     # Trouve les correspondances
-    sent_recipients = set(s.recipient_email.lower() for s in sent_emails if s.recipient_email)
-    received_senders = set(e.sender_email.lower() for e in received_emails if e.sender_email)
+    sent_recipients = {address for address, _ in sent_rows if address}
+    received_senders = {address for address, _ in received_rows if address}
 
     matches = sent_recipients.intersection(received_senders)
 
     return jsonify({
-        'sent_count': SentEmail.query.count(),
-        'received_count': Email.query.count(),
+        'sent_count': sent_rows[0][1] if sent_rows else 0,
+        'received_count': received_rows[0][1] if received_rows else 0,
         'sent_recipients_sample': list(sent_recipients)[:10],
         'received_senders_sample': list(received_senders)[:10],
         'matches': list(matches),
@@ -426,7 +461,7 @@ def debug_sent_emails():
 @app.route('/api/emails/<int:email_id>', methods=['GET'])
 def get_email(email_id):
     """RÃ©cupÃ¨re un email spÃ©cifique"""
-    email = Email.query.get_or_404(email_id)
+    email = db.get_or_404(Email, email_id)
     return jsonify({
         'success': True,
         'email': email.to_dict()
@@ -436,7 +471,7 @@ def get_email(email_id):
 @app.route('/api/emails/<int:email_id>/approve', methods=['POST'])
 def approve_email(email_id):
     """Approuve et envoie une rÃ©ponse"""
-    email_record = Email.query.get_or_404(email_id)
+    email_record = db.get_or_404(Email, email_id)
 
     # RÃ©cupÃ¨re la rÃ©ponse (modifiÃ©e ou originale)
     data = request.get_json() or {}
@@ -477,7 +512,7 @@ def approve_email(email_id):
 @app.route('/api/emails/<int:email_id>/ignore', methods=['POST'])
 def ignore_email(email_id):
     """Ignore un email (ne pas rÃ©pondre)"""
-    email_record = Email.query.get_or_404(email_id)
+    email_record = db.get_or_404(Email, email_id)
     email_record.status = 'ignored'
     email_record.processed_at = datetime.utcnow()
     db.session.commit()
@@ -491,7 +526,7 @@ def ignore_email(email_id):
 @app.route('/api/emails/<int:email_id>/category', methods=['POST'])
 def update_email_category(email_id):
     """Change la catégorie d'un email (AUTO, MANUEL, SPAM)"""
-    email_record = Email.query.get_or_404(email_id)
+    email_record = db.get_or_404(Email, email_id)
 
     data = request.get_json()
     if not data or not data.get('category'):
@@ -533,8 +568,61 @@ def update_email_category(email_id):
 @app.route('/api/emails/<int:email_id>/regenerate', methods=['POST'])
 def regenerate_response(email_id):
     """RÃ©gÃ©nÃ¨re la rÃ©ponse IA"""
-    email_record = Email.query.get_or_404(email_id)
+    email_record = db.get_or_404(Email, email_id)
+
+    ai, email_data, order_context, language = _regeneration_inputs(email_record)
+
+    new_response = ai.generate_response(
+        email_data=email_data,
+        order_context=order_context,
+        category=email_record.category or 'AUTRE',
+        language=language,
+        use_cache=False  # Regeneration demandee : toujours une nouvelle reponse
+    )
+
+    email_record.generated_response = new_response
+    db.session.commit()
+
+    return jsonify({
+        'success': True,
+        'response': new_response
+    })
+
+
+@app.route('/api/emails/<int:email_id>/regenerate-stream', methods=['POST'])
+def regenerate_response_stream(email_id):
+    """Regenere la reponse IA en streaming (Server-Sent Events)
+
+    Chaque morceau de texte est envoye des sa generation ("data: {"text": ...}"),
+    puis un evenement final {"done": true} une fois la reponse enregistree.
+    """
+    email_record = db.get_or_404(Email, email_id)
+    ai, email_data, order_context, language = _regeneration_inputs(email_record)
+
+    def generate():
+        parts = []
+        for text in ai.generate_response_stream(
+            email_data=email_data,
+            order_context=order_context,
+            category=email_record.category or 'AUTRE',
+            language=language
+        ):
+            parts.append(text)
+            yield 'data: ' + orjson.dumps({'text': text}).decode() + '\n\n'
+
+        email_record.generated_response = ''.join(parts)
+        db.session.commit()
+        yield 'data: ' + orjson.dumps({'done': True}).decode() + '\n\n'
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
+
+def _regeneration_inputs(email_record):
+    """Prepare la regeneration d'une reponse : (ai, email_data, order_context, langue)"""
     # RÃ©cupÃ¨re le contexte Shopify (si connectÃ©)
     shopify = get_shopify_handler()
     if shopify:
@@ -545,7 +633,6 @@ def regenerate_response(email_id):
     else:
         order_context = {'order': None, 'customer': None}
 
-    # RÃ©gÃ©nÃ¨re la rÃ©ponse
     ai = get_ai_responder()
     email_data = {
         'subject': email_record.subject,
@@ -553,20 +640,18 @@ def regenerate_response(email_id):
         'sender_name': email_record.sender_name
     }
 
-    new_response = ai.generate_response(
-        email_data=email_data,
-        order_context=order_context,
-        category=email_record.category or 'AUTRE'
-    )
+    # Réutilise la langue stockée (détectée au premier passage) au lieu de la recalculer
+    language = email_record.language
+    if not language:
+        language = ai.detect_language(f"{email_record.subject} {email_record.body}", email_record.sender_email)
+        email_record.language = language
+
+    return ai, email_data, order_context, language
 
-    email_record.generated_response = new_response
-    db.session.commit()
 
-    return jsonify({
-        'success': True,
-        'response': new_response
-    })
 
+# Taille des lots d'insertion (un savepoint par lot) lors de la recuperation des emails
+INSERT_BATCH_SIZE = 25
 
 
 @app.route('/api/fetch-emails', methods=['POST'])
@@ -587,16 +672,22 @@ def fetch_new_emails():
                 'message': 'Erreur connexion IMAP - verifiez les identifiants Zoho'
             }), 500
 
-        # Import du detecteur de spam (rapide, pas d'IA)
-        from modules.spam_detector import detect_spam
 
         # Recupere les emails depuis INBOX et Archives
         # Inclut INBOX + Archive (Zoho déplace les emails répondus dans Archive)
         # Limite à 50 par dossier pour éviter les crashs
         logger.info("Debut recuperation emails depuis IMAP...")
+        folders = ["INBOX", "Archive", "Archiver"]
+        # Dernier UID importe par dossier : seuls les nouveaux emails sont telecharges
+        mailbox_states = {
+            state.folder: state
+            for state in MailboxState.query.filter(MailboxState.folder.in_(folders))
+        }
+        handler.uid_marks = {}
         new_emails = handler.fetch_emails_from_folders(
-            folders=["INBOX", "Archive", "Archiver"],
-            limit_per_folder=50
+            folders=folders,
+            limit_per_folder=50,
+            since_uids={folder: (state.uid_validity, state.last_uid) for folder, state in mailbox_states.items()}
         )
         logger.info(f"Emails recuperes: {len(new_emails)}")
 
@@ -617,11 +708,19 @@ def fetch_new_emails():
         to_classify = 0
         customers_found = 0
 
+        # Message-IDs deja en base : une seule requete au lieu d'une par email
+        fetched_ids = [e['message_id'] for e in new_emails]
+        known_ids = set(db.session.scalars(
+            db.select(Email.message_id).where(Email.message_id.in_(fetched_ids))
+        )) if fetched_ids else set()
+        rows = []
+        row_uids = {}  # message_id -> (dossier, UID) : une insertion ratee retient la marque haute
+
         for email_data in new_emails:
-            # Verifie si deja en base
-            existing = Email.query.filter_by(message_id=email_data['message_id']).first()
-            if existing:
+            # Verifie si deja en base (ou deja vu dans un autre dossier)
+            if email_data['message_id'] in known_ids:
                 continue
+            known_ids.add(email_data['message_id'])
 
             # Detection automatique de spam (RAPIDE - pas d'IA)
             is_spam, spam_score, spam_reason = detect_spam(
@@ -653,12 +752,13 @@ def fetch_new_emails():
             # === ENRICHISSEMENT CLIENT SHOPIFY ===
             # Si pas de numéro de commande trouvé, cherche par email/nom dans Shopify
             order_number = email_data.get('order_number')
+            language = None
 
             if not order_number and not is_spam:
                 try:
                     # Détecte la langue pour choisir le bon shop
                     email_text = f"{email_data.get('subject', '')} {email_data.get('body', '')}"
-                    language = ai.detect_language(email_text) if ai else 'fr'
+                    language = ai.detect_language(email_text, email_data.get('sender_email')) if ai else 'fr'
                     target_shop = lang_to_shop.get(language, 'tgir1c-x2')
 
                     shopify = get_shopify_handler(target_shop)
@@ -676,25 +776,63 @@ def fetch_new_emails():
                 except Exception as e:
                     logger.debug(f"Erreur recherche client Shopify: {e}")
 
-            # Cree l'enregistrement IMMEDIATEMENT
-            email_record = Email(
-                message_id=email_data['message_id'],
-                sender_email=email_data['sender_email'],
-                sender_name=email_data.get('sender_name'),
-                subject=email_data['subject'],
-                body=email_data['body'],
-                received_at=email_data.get('received_at'),
-                category=category,
-                confidence=confidence,
-                order_number=order_number,  # Peut maintenant venir de Shopify
-                generated_response=None,
-                status=status
-            )
+            # Prepare la ligne (insertion groupee en fin de boucle)
+            if email_data.get('folder') and email_data.get('imap_id'):
+                row_uids[email_data['message_id']] = (email_data['folder'], int(email_data['imap_id']))
+            rows.append({
+                'message_id': email_data['message_id'],
+                'sender_email': email_data['sender_email'],
+                'sender_email_ci': (email_data['sender_email'] or '').lower(),
+                'sender_name': email_data.get('sender_name'),
+                'subject': email_data['subject'],
+                'body': email_data['body'],
+                'received_at': email_data.get('received_at'),
+                'category': category,
+                'confidence': confidence,
+                'language': language,
+                'order_number': order_number,  # Peut maintenant venir de Shopify
+                'generated_response': None,
+                'status': status
+            })
+
+        # Insertion par lots dans un savepoint : une ligne invalide (doublon concurrent...)
+        # n'annule que son lot, qui est alors rejoue ligne par ligne
+        first_failed_uid = {}  # dossier -> plus petit UID non enregistre
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            batch = rows[start:start + INSERT_BATCH_SIZE]
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(db.insert(Email), batch)
+                processed += len(batch)
+            except SQLAlchemyError as e:
+                logger.warning(f"Lot d'emails rejete ({e}), insertion ligne par ligne")
+                for row in batch:
+                    try:
+                        with db.session.begin_nested():
+                            db.session.execute(db.insert(Email), [row])
+                        processed += 1
+                    except SQLAlchemyError as row_error:
+                        logger.error(f"Email ignore {row['message_id']}: {row_error}")
+                        if row['message_id'] in row_uids:
+                            folder, uid = row_uids[row['message_id']]
+                            first_failed_uid[folder] = min(uid, first_failed_uid.get(folder, uid))
+        logger.info(f"{processed} emails enregistres sur {len(rows)} nouveaux")
+
+        # Avance la marque haute de chaque dossier dans la meme transaction, sans depasser
+        # un email non enregistre : il sera retelecharge au prochain passage
+        for folder, (uid_validity, max_uid) in handler.uid_marks.items():
+            if folder in first_failed_uid:
+                max_uid = min(max_uid, first_failed_uid[folder] - 1)
+            state = mailbox_states.get(folder)
+            if state is None:
+                state = MailboxState(folder=folder)
+                db.session.add(state)
+            state.uid_validity = uid_validity
+            state.last_uid = max_uid
 
-            db.session.add(email_record)
-            db.session.commit()  # Commit chaque email individuellement
-            processed += 1
-            logger.info(f"Email {processed} enregistre: {email_data.get('subject', '')[:50]}")
+        db.session.commit()
+        if rows:
+            _invalidate_stats_cache()  # INSERT Core : pas d'evenement ORM
 
         handler.disconnect_imap()
 
@@ -708,7 +846,7 @@ def fetch_new_emails():
         })
 
     except Exception as e:
-        import traceback
+        db.session.rollback()
         logger.error(f"Erreur fetch emails: {e}")
         logger.error(traceback.format_exc())
         return jsonify({
@@ -717,17 +855,25 @@ def fetch_new_emails():
         }), 500
 
 
+def _needs_classification():
+    """
+    Prédicat des emails à (re)classifier : catégorie absente ou hors AUTO/MANUEL/SPAM
+    (couvre PENDING et AUTRE). Un seul NOT IN au lieu d'une chaîne de OR.
+    """
+    return db.or_(Email.category.is_(None), Email.category.notin_(['AUTO', 'MANUEL', 'SPAM']))
+
+
 @app.route('/api/classify-next', methods=['POST'])
 def classify_next_email():
     """Classifie UN SEUL email en attente avec l'IA - appele en boucle par le frontend"""
     try:
         # Trouve le prochain email a classifier (PENDING ou sans categorie valide)
-        email = Email.query.filter(
-            (Email.category == 'PENDING') |
-            (Email.category == None) |
-            (Email.category == 'AUTRE') |
-            (~Email.category.in_(['AUTO', 'MANUEL', 'SPAM']))
-        ).first()
+        # Le frontend renvoie le "remaining" du dernier appel : pas de COUNT à chaque email
+        data = request.get_json(silent=True) or {}
+        previous_remaining = data.get('remaining')
+
+        # SKIP LOCKED : deux appels concurrents ne prennent pas le même email
+        email = Email.query.filter(_needs_classification()).limit(1).with_for_update(skip_locked=True).first()
 
         if not email:
             return jsonify({
@@ -758,13 +904,11 @@ def classify_next_email():
 
         db.session.commit()
 
-        # Compte combien il en reste
-        remaining = Email.query.filter(
-            (Email.category == 'PENDING') |
-            (Email.category == None) |
-            (Email.category == 'AUTRE') |
-            (~Email.category.in_(['AUTO', 'MANUEL', 'SPAM']))
-        ).count()
+        # Compte combien il en reste (COUNT seulement au premier appel)
+        if isinstance(previous_remaining, int) and previous_remaining > 0:
+            remaining = previous_remaining - 1
+        else:
+            remaining = Email.query.filter(_needs_classification()).count()
 
         return jsonify({
             'success': True,
@@ -807,10 +951,8 @@ def learn_spam_from_zoho():
 
         for folder in spam_folders:
             try:
-                handler.disconnect_imap()
-                handler.connect_imap()
-                status, _ = handler.imap_connection.select(folder)
-                if status == 'OK':
+                # Même connexion pour chaque dossier candidat : simple SELECT (lecture seule)
+                if handler.select_folder(folder, readonly=True):
                     found_folder = folder
                     logger.info(f"Dossier spam trouvé: {folder}")
 
@@ -836,13 +978,9 @@ def learn_spam_from_zoho():
                                 from_header = msg.get('From', '')
                                 from_decoded = handler._decode_header_value(from_header)
 
-                                # Extrait email et nom
-                                import re
-                                email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', from_decoded)
-                                sender_email = email_match.group(0).lower() if email_match else ''
-
-                                name_match = re.match(r'^(.+?)\s*<', from_decoded)
-                                sender_name = name_match.group(1).strip().strip('"') if name_match else ''
+                                # Extrait email et nom (un seul appel, gère les noms entre guillemets)
+                                sender_name, sender_email = parseaddr(from_decoded)
+                                sender_email = sender_email.lower()
 
                                 subject = handler._decode_header_value(msg.get('Subject', ''))
 
@@ -870,9 +1008,6 @@ def learn_spam_from_zoho():
             })
 
         # Analyse les patterns
-        import re
-        from collections import Counter
-
         # Compte les domaines
         domains = Counter([e['domain'] for e in spam_emails if e['domain']])
 
@@ -911,7 +1046,6 @@ def learn_spam_from_zoho():
         })
 
     except Exception as e:
-        import traceback
         logger.error(f"Erreur learn spam: {e}")
         logger.error(traceback.format_exc())
         return jsonify({
@@ -924,11 +1058,6 @@ def learn_spam_from_zoho():
 def apply_learned_spam():
     """Applique les patterns appris et re-détecte le spam"""
     try:
-        from modules.spam_detector import (
-            detect_spam, add_spam_sender_pattern, add_spam_subject_pattern,
-            SPAM_SENDER_PATTERNS, SPAM_SUBJECT_PATTERNS, SPAM_BODY_PATTERNS
-        )
-
         data = request.get_json() or {}
 
         patterns_added = 0
@@ -994,7 +1123,6 @@ def apply_learned_spam():
         })
 
     except Exception as e:
-        import traceback
         logger.error(f"Erreur apply learned spam: {e}")
         logger.error(traceback.format_exc())
         return jsonify({
@@ -1011,8 +1139,6 @@ def redetect_spam():
     pour les bloquer, mais les garde dans l'app pour vérifier les faux positifs.
     """
     try:
-        from modules.spam_detector import detect_spam
-
         # Recupere TOUS les emails non-spam pour re-verifier
         emails = Email.query.filter(Email.category != 'SPAM').all()
 
@@ -1140,8 +1266,8 @@ def check_customer():
         # Détecte la langue pour choisir le bon shop
         ai = get_ai_responder()
         language = 'fr'  # Défaut
-        if email_text and ai:
-            language = ai.detect_language(email_text)
+        if ai and (email_text or sender_email):
+            language = ai.detect_language(email_text, sender_email)
 
         # Mapping langue -> shop
         lang_to_shop = {
@@ -1162,7 +1288,7 @@ def check_customer():
             storage = get_token_storage_instance()
             shops = storage.get_all_shops()
             if shops:
-                target_shop = list(shops.keys())[0]
+                target_shop = next(iter(shops))
                 shopify = get_shopify_handler(target_shop)
 
         if not shopify:
@@ -1210,19 +1336,26 @@ def enrich_emails_customer_info():
     Pour chaque email sans numéro de commande, vérifie si l'expéditeur
     est un client existant et ajoute le numéro de commande.
     Cherche d'abord dans la boutique de la langue détectée, puis dans toutes les autres.
+
+    Traite 50 emails par appel : passer ?after_id=<next_after_id> pour continuer
+    à partir du dernier email traité au lieu de rescanner depuis le début.
     """
     try:
-        # Récupère les emails sans numéro de commande (non-spam)
+        after_id = request.args.get('after_id', 0, type=int)
+
+        # Récupère les emails sans numéro de commande (non-spam), page suivante par id
         emails = Email.query.filter(
             Email.order_number == None,
-            Email.category != 'SPAM'
-        ).limit(50).all()
+            Email.category != 'SPAM',
+            Email.id > after_id
+        ).order_by(Email.id).limit(50).all()
 
         if not emails:
             return jsonify({
                 'success': True,
                 'message': 'Aucun email à enrichir',
-                'enriched': 0
+                'enriched': 0,
+                'next_after_id': None
             })
 
         ai = get_ai_responder()
@@ -1243,38 +1376,73 @@ def enrich_emails_customer_info():
             'en': 'x1jxji-gh'    # Anglais - avenaparis.shop
         }
 
+        # Détecte la langue de chaque email pour connaître sa boutique cible
+        target_shops = {}
         for email in emails:
-            try:
-                # Détecte la langue
-                email_text = f"{email.subject or ''} {email.body or ''}"
-                language = ai.detect_language(email_text) if ai else 'fr'
+            email_text = f"{email.subject or ''} {email.body or ''}"
+            language = ai.detect_language(email_text, email.sender_email) if ai else 'fr'
+            target_shops[email.id] = lang_to_shop.get(language, 'tgir1c-x2')
 
-                # Ordre des shops à essayer: d'abord celui de la langue, puis les autres
-                target_shop = lang_to_shop.get(language, 'tgir1c-x2')
-                shops_to_try = [target_shop] + [s for s in all_shops if s != target_shop]
+        # Un handler par shop (et non par email)
+        handlers = {}
+        for shop_name in all_shops:
+            handlers[shop_name] = get_shopify_handler(shop_name)
+            if not handlers[shop_name]:
+                shops_not_found += 1
+
+        remaining = {email.id: email for email in emails}
+
+        def mark_enriched(email, order_number, shop_name, method):
+            nonlocal enriched_count
+            email.order_number = order_number
+            enriched_count += 1
+            remaining.pop(email.id, None)
+            logger.info(f"Email {email.id} ({email.sender_name}) enrichi: commande #{order_number} (shop: {shop_name}, via {method})")
+
+        # 1. Recherche groupée par email : une requête GraphQL par shop,
+        #    d'abord le shop de la langue détectée, puis les autres
+        for first_pass in (True, False):
+            for shop_name in all_shops:
+                shopify = handlers.get(shop_name)
+                if not shopify:
+                    continue
 
-                found = False
-                for shop_name in shops_to_try:
-                    shopify = get_shopify_handler(shop_name)
+                candidates = [
+                    email for email in remaining.values()
+                    if email.sender_email and (target_shops[email.id] == shop_name) == first_pass
+                ]
+                if not candidates:
+                    continue
 
-                    if not shopify:
-                        shops_not_found += 1
-                        continue
+                try:
+                    orders_by_email = shopify.find_customers_bulk([email.sender_email for email in candidates])
+                except Exception as e:
+                    logger.error(f"Erreur recherche groupée sur {shop_name}: {e}")
+                    continue
 
-                    # Recherche le client
-                    result = shopify.find_customer_orders(
-                        email=email.sender_email,
-                        name=email.sender_name
-                    )
+                for email in candidates:
+                    order_number = orders_by_email.get(email.sender_email.lower())
+                    if order_number:
+                        mark_enriched(email, order_number, shop_name, 'email')
 
-                    if result['found'] and result['last_order_number']:
-                        email.order_number = result['last_order_number']
-                        enriched_count += 1
-                        found = True
-                        logger.info(f"Email {email.id} ({email.sender_name}) enrichi: commande #{result['last_order_number']} (shop: {shop_name}, via {result['search_method']})")
-                        break
+        # 2. Pour les emails restants, recherche par nom (shop de la langue d'abord)
+        for email in list(remaining.values()):
+            try:
+                if email.sender_name:
+                    target_shop = target_shops[email.id]
+                    shops_to_try = [target_shop] + [s for s in all_shops if s != target_shop]
 
-                if not found:
+                    for shop_name in shops_to_try:
+                        shopify = handlers.get(shop_name)
+                        if not shopify:
+                            continue
+
+                        result = shopify.find_customer_orders(name=email.sender_name)
+                        if result['found'] and result['last_order_number']:
+                            mark_enriched(email, result['last_order_number'], shop_name, result['search_method'])
+                            break
+
+                if email.id in remaining:
                     search_failed += 1
                     logger.debug(f"Client non trouvé pour email {email.id}: {email.sender_name} <{email.sender_email}>")
 
@@ -1289,7 +1457,8 @@ def enrich_emails_customer_info():
             'message': f'{enriched_count} emails enrichis avec numéro de commande',
             'enriched': enriched_count,
             'total_checked': len(emails),
-            'not_found': search_failed
+            'not_found': search_failed,
+            'next_after_id': emails[-1].id
         })
 
     except Exception as e:
@@ -1303,8 +1472,6 @@ def enrich_emails_customer_info():
 @app.route('/api/debug/shopify-status', methods=['GET'])
 def debug_shopify_status():
     """Debug: Vérifie quels shops Shopify ont des tokens configurés"""
-    import json
-
     all_shops = ['ajejh8-ms', 'tgir1c-x2', 'k8ejin-gc', 'z1w10j-ne', 'a6kcxh-0q', 'x1jxji-gh']
     shop_labels = {
         'ajejh8-ms': 'FR (France) - avenaparis.com',
@@ -1315,13 +1482,9 @@ def debug_shopify_status():
         'x1jxji-gh': 'EN (Anglais) - avenaparis.shop'
     }
 
-    # Vérifie SHOPIFY_CREDENTIALS
-    credentials_json = os.getenv('SHOPIFY_CREDENTIALS', '{}')
-    try:
-        credentials = json.loads(credentials_json)
-        configured_shops = list(credentials.keys())
-    except:
-        configured_shops = []
+    # Vérifie SHOPIFY_CREDENTIALS (parsé une seule fois)
+    credentials = get_shopify_credentials()
+    configured_shops = list(credentials.keys())
 
     # Vérifie les tokens en base
     storage = get_token_storage_instance()
@@ -1405,7 +1568,7 @@ def unspam_email(email_id):
 
     Utilisé quand un vrai client a été marqué spam par erreur.
     """
-    email_record = Email.query.get_or_404(email_id)
+    email_record = db.get_or_404(Email, email_id)
 
     if email_record.category != 'SPAM':
         return jsonify({
@@ -1435,62 +1598,105 @@ def unspam_email(email_id):
 def reclassify_all_emails():
     """Reclassifie tous les emails en attente avec l'IA et le detecteur de spam"""
     try:
-        from modules.spam_detector import detect_spam
-
-        # Recupere tous les emails pending sans categorie ou avec anciennes categories
-        emails_to_classify = Email.query.filter(
-            (Email.status == 'pending') |
-            (Email.category == None) |
-            (Email.category == 'AUTRE') |
-            (Email.category.notin_(['AUTO', 'MANUEL', 'SPAM']))
-        ).all()
-
-        logger.info(f"Reclassification de {len(emails_to_classify)} emails...")
-
         reclassified = 0
         spam_detected = 0
+        chunk_size = 100
+        last_id = 0
 
-        for email in emails_to_classify:
-            # D'abord verifier si c'est du spam
-            is_spam, spam_score, spam_reason = detect_spam(
-                email.sender_email or '',
-                email.sender_name or '',
-                email.subject or '',
-                email.body or ''
-            )
+        ai_responder = get_ai_responder()
 
-            if is_spam:
-                email.category = 'SPAM'
-                email.confidence = spam_score
-                email.status = 'ignored'
-                spam_detected += 1
-                logger.info(f"Email {email.id} marque SPAM: {spam_reason}")
-            else:
-                # Classification IA
-                try:
-                    ai_responder = get_ai_responder()
-                    if ai_responder:
-                        category, confidence = ai_responder.classify_email(
-                            email.subject or '',
-                            email.body or ''
-                        )
-                        email.category = category
-                        email.confidence = confidence
-                        logger.info(f"Email {email.id} classifie: {category} ({confidence:.0%})")
-                except Exception as e:
-                    logger.error(f"Erreur classification email {email.id}: {e}")
-                    email.category = 'MANUEL'
-                    email.confidence = 0.0
+        # Mode batch : la classification IA part en differe (Batch API Gemini), appliquee
+        # ensuite par /api/reclassify-emails/batch. Un seul job en cours a la fois : tant qu'il
+        # n'est pas applique, une nouvelle reclassification ne classerait rien
+        use_batch = bool(ai_responder and app.config.get('AI_BATCH_ENABLED'))
+        pending_batch = _pending_classification_batch() if use_batch else None
+        if pending_batch:
+            return jsonify({
+                'success': False,
+                'message': f'Classification IA en differe deja en cours ({pending_batch})',
+                'batch': pending_batch
+            }), 400
+        batch_emails = {}
+
+        while True:
+            # Emails pending sans categorie ou avec anciennes categories, par lots pagines
+            # sur l'id (keyset) : jamais toute la file en memoire, colonnes seules (pas d'objets ORM)
+            chunk = db.session.execute(
+                db.select(Email.id, Email.sender_email, Email.sender_name, Email.subject, Email.body)
+                .where((Email.status == 'pending') | _needs_classification(), Email.id > last_id)
+                .order_by(Email.id)
+                .limit(chunk_size)
+            ).all()
+            if not chunk:
+                break
+            last_id = chunk[-1].id
 
-            reclassified += 1
+            updates = []
+            ai_emails = []
 
-        db.session.commit()
+            for email in chunk:
+                # D'abord verifier si c'est du spam (local, rapide)
+                is_spam, spam_score, spam_reason = detect_spam(
+                    email.sender_email or '',
+                    email.sender_name or '',
+                    email.subject or '',
+                    email.body or ''
+                )
+
+                if is_spam:
+                    updates.append({'id': email.id, 'category': 'SPAM', 'confidence': spam_score, 'status': 'ignored'})
+                    spam_detected += 1
+                    logger.info(f"Email {email.id} marque SPAM: {spam_reason}")
+                else:
+                    ai_emails.append(email)
+
+                reclassified += 1
+
+            if use_batch:
+                # Classification IA differee : envoyee en un seul job apres la boucle
+                batch_emails.update((str(email.id), (email.subject or '', email.body or '')) for email in ai_emails)
+            elif ai_responder and ai_emails:
+                # Classification IA du lot en parallele (appels HTTP concurrents) - la session
+                # DB n'est utilisee que dans ce thread
+                results = ai_responder.classify_many(
+                    [(email.subject or '', email.body or '') for email in ai_emails]
+                )
+                for email, (category, confidence) in zip(ai_emails, results):
+                    updates.append({'id': email.id, 'category': category, 'confidence': confidence})
+
+            # Commit par lot : progression durable et transaction courte
+            if updates:
+                db.session.bulk_update_mappings(Email, updates)
+            db.session.commit()
+
+        batch_name = None
+        if batch_emails:
+            known, batch_name = ai_responder.submit_classification_batch(batch_emails)
+            # Emails evidents ou deja en cache : appliques tout de suite
+            db.session.bulk_update_mappings(Email, [
+                {'id': int(email_id), 'category': category, 'confidence': confidence}
+                for email_id, (category, confidence) in known.items()
+            ])
+            if batch_name:
+                db.session.add(Settings(
+                    key=AI_BATCH_SETTING, value=batch_name,
+                    description='Job Batch API Gemini de classification en cours'
+                ))
+            db.session.commit()
+
+        _invalidate_stats_cache()  # UPDATE en masse : pas d'evenement ORM
+        logger.info(f"Reclassification terminee: {reclassified} emails ({spam_detected} spam)")
+
+        message = f'{reclassified} emails reclassifies ({spam_detected} spam)'
+        if batch_name:
+            message += f' - classification IA en differe ({batch_name})'
 
         return jsonify({
             'success': True,
-            'message': f'{reclassified} emails reclassifies ({spam_detected} spam)',
+            'message': message,
             'reclassified': reclassified,
-            'spam_detected': spam_detected
+            'spam_detected': spam_detected,
+            'batch': batch_name
         })
 
     except Exception as e:
@@ -1501,11 +1707,97 @@ def reclassify_all_emails():
         }), 500
 
 
+# Cle Settings du job Batch API de classification en cours (mode AI_BATCH_ENABLED)
+AI_BATCH_SETTING = 'ai_classification_batch'
+
+
+def _pending_classification_batch():
+    """Nom du job batch de classification en cours, ou None"""
+    return db.session.scalar(db.select(Settings.value).where(Settings.key == AI_BATCH_SETTING))
+
+
+def apply_classification_batch():
+    """Applique le resultat du job batch en cours s'il est termine
+
+    Les emails modifies depuis l'envoi du job (spam, classification manuelle, reponse
+    envoyee...) gardent leur etat : le resultat differe ne remplace pas une decision recente.
+
+    Returns:
+        (nom du job ou None, nombre d'emails classifies ou None si le job tourne encore)
+    """
+    pending = db.session.execute(
+        db.select(Settings.value, Settings.updated_at).where(Settings.key == AI_BATCH_SETTING)
+    ).first()
+    if not pending:
+        return None, 0
+    batch_name, submitted_at = pending
+
+    try:
+        results = get_ai_responder().poll_classification_batch(batch_name)
+    except BatchJobFailed:
+        # Etat definitif : on libere la place, les emails restent a classifier (reclassify-emails)
+        db.session.execute(db.delete(Settings).where(Settings.key == AI_BATCH_SETTING))
+        db.session.commit()
+        logger.error(f"Batch {batch_name} abandonne - emails a reclassifier")
+        raise
+    if results is None:
+        return batch_name, None
+
+    unchanged_ids = set(db.session.scalars(
+        db.select(Email.id).where(
+            Email.id.in_([int(email_id) for email_id in results]),
+            Email.status == 'pending',
+            db.or_(Email.updated_at.is_(None), Email.updated_at <= submitted_at)
+        )
+    ))
+    db.session.bulk_update_mappings(Email, [
+        {'id': int(email_id), 'category': category, 'confidence': confidence}
+        for email_id, (category, confidence) in results.items()
+        if int(email_id) in unchanged_ids
+    ])
+    db.session.execute(db.delete(Settings).where(Settings.key == AI_BATCH_SETTING))
+    db.session.commit()
+    _invalidate_stats_cache()  # UPDATE en masse : pas d'evenement ORM
+
+    if len(unchanged_ids) < len(results):
+        logger.info(f"Batch {batch_name}: {len(results) - len(unchanged_ids)} emails modifies entre-temps, ignores")
+    return batch_name, len(unchanged_ids)
+
+
+@app.route('/api/reclassify-emails/batch', methods=['POST'])
+def apply_reclassify_batch():
+    """Recupere la classification IA differee (Batch API) et l'applique aux emails"""
+    try:
+        batch_name, classified = apply_classification_batch()
+
+        if not batch_name:
+            message = 'Aucune classification en attente'
+        elif classified is None:
+            message = f'Classification {batch_name} en cours'
+        else:
+            message = f'{classified} emails classifies ({batch_name})'
+
+        return jsonify({
+            'success': True,
+            'message': message,
+            'batch': batch_name,
+            'done': classified is not None,
+            'classified': classified or 0
+        })
+
+    except Exception as e:
+        logger.error(f"Erreur recuperation batch classification: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
 @app.route('/api/emails/<int:email_id>/generate', methods=['POST'])
 def generate_email_response(email_id):
     """GÃ©nÃ¨re une rÃ©ponse IA pour un email spÃ©cifique - appelÃ© manuellement"""
     try:
-        email_record = Email.query.get_or_404(email_id)
+        email_record = db.get_or_404(Email, email_id)
 
         # Si dÃ©jÃ  traitÃ©, retourne la rÃ©ponse existante
         if email_record.generated_response:
@@ -1518,9 +1810,12 @@ def generate_email_response(email_id):
 
         ai = get_ai_responder()
 
-        # DÃ©tecte la langue de l'email
-        email_text = f"{email_record.subject} {email_record.body}"
-        language = ai.detect_language(email_text)
+        # DÃ©tecte la langue de l'email (rÃ©utilise celle dÃ©jÃ  stockÃ©e)
+        language = email_record.language
+        if not language:
+            email_text = f"{email_record.subject} {email_record.body}"
+            language = ai.detect_language(email_text, email_record.sender_email)
+            email_record.language = language
         logger.info(f"Langue dÃ©tectÃ©e pour email {email_id}: {language}")
 
         # Mapping langue -> shop Shopify
@@ -1542,28 +1837,34 @@ def generate_email_response(email_id):
         # RÃ©cupÃ¨re le handler Shopify pour le bon shop
         shopify = get_shopify_handler(target_shop)
 
-        # Classifie l'email
-        category, confidence = ai.classify_email(
-            subject=email_record.subject,
-            body=email_record.body
-        )
+        # RÃ©cupÃ¨re le contexte Shopify (si connectÃ©) et, en parallÃ¨le, le tracking
+        # Parcelpanel par numÃ©ro de commande (connu d'avance)
+        parcelpanel_manager = get_parcelpanel_manager()
+        tracking_info = None
+        tracking_by_order = None
 
-        # RÃ©cupÃ¨re le contexte Shopify (si connectÃ©)
-        order_context = {}
-        if shopify:
-            order_context = shopify.get_order_context(
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            future_order = executor.submit(
+                shopify.get_order_context,
                 order_number=email_record.order_number,
                 email=email_record.sender_email
-            )
-            logger.info(f"Contexte Shopify: order={order_context.get('order') is not None}")
-        else:
-            order_context = {'order': None, 'customer': None}
-            logger.warning(f"Pas de handler Shopify pour {target_shop}")
+            ) if shopify else None
+            future_tracking = executor.submit(
+                parcelpanel_manager.get_tracking_for_shop,
+                target_shop, order_number=str(email_record.order_number)
+            ) if email_record.order_number else None
+
+            if future_order:
+                order_context = future_order.result()
+                logger.info(f"Contexte Shopify: order={order_context.get('order') is not None}")
+            else:
+                order_context = {'order': None, 'customer': None}
+                logger.warning(f"Pas de handler Shopify pour {target_shop}")
 
-        # RÃ©cupÃ¨re les infos de tracking Parcelpanel en temps rÃ©el
-        parcelpanel_manager = get_parcelpanel_manager()
-        tracking_info = None
+            if future_tracking:
+                tracking_by_order = future_tracking.result()
 
+        # RÃ©cupÃ¨re les infos de tracking Parcelpanel en temps rÃ©el
         if order_context.get('order'):
             order = order_context['order']
             tracking_number = order.get('tracking_number')
@@ -1575,9 +1876,13 @@ def generate_email_response(email_id):
                     target_shop, tracking_number=tracking_number
                 )
             if not tracking_info and order_num:
-                tracking_info = parcelpanel_manager.get_tracking_for_shop(
-                    target_shop, order_number=str(order_num)
-                )
+                if future_tracking and str(order_num) == str(email_record.order_number):
+                    # RÃ©cupÃ©rÃ© en parallÃ¨le de Shopify
+                    tracking_info = tracking_by_order
+                else:
+                    tracking_info = parcelpanel_manager.get_tracking_for_shop(
+                        target_shop, order_number=str(order_num)
+                    )
 
             if tracking_info:
                 order_context['parcelpanel_tracking'] = tracking_info
@@ -1596,12 +1901,19 @@ def generate_email_response(email_id):
             'order_number': email_record.order_number
         }
 
-        response = ai.generate_response(
-            email_data=email_data,
-            order_context=order_context,
-            category=category,
-            language=language  # Passe la langue dÃ©tectÃ©e
-        )
+        # Email deja classifie : seule la reponse est a generer ; sinon classification
+        # et redaction en un seul appel Gemini
+        if email_record.category in ('AUTO', 'MANUEL'):
+            category, confidence = email_record.category, email_record.confidence
+            response = ai.generate_response(
+                email_data=email_data,
+                order_context=order_context,
+                category=category,
+                language=language  # Passe la langue detectee
+            )
+        else:
+            result = ai.classify_and_generate(email_data, order_context, language)
+            category, confidence, response = result['category'], result['confidence'], result['response']
 
         # Met Ã  jour l'enregistrement
         email_record.category = category
@@ -1630,12 +1942,38 @@ def generate_email_response(email_id):
         }), 500
 
 
+# Patterns pour categoriser les reponses envoyees
+SENT_CATEGORY_KEYWORDS = {
+    'SUIVI': [
+        r'suivi', r'livraison', r'colis', r'expedi', r'tracking',
+        r'ou en est', r'quand.*recev', r'delai', r'transporteur'
+    ],
+    'RETOUR': [
+        r'retour', r'rembours', r'echang', r'renvoy', r'renvoie'
+    ],
+    'PROBLEME': [
+        r'probleme', r'defectueu', r'casse', r'abime', r'erreur',
+        r'manqu', r'incomplet', r'mauvais', r'endommage'
+    ],
+    'QUESTION': [
+        r'question', r'renseign', r'information', r'savoir'
+    ],
+    'MODIFICATION': [
+        r'modifi', r'chang', r'annul', r'adresse', r'commande'
+    ]
+}
+# Compilees une fois : une regex par categorie, testees dans l'ordre (la premiere qui matche l'emporte).
+# Patterns en minuscules appliques a un texte deja passe en minuscules : pas besoin de re.IGNORECASE
+SENT_CATEGORY_PATTERNS = {
+    cat: re.compile('|'.join(patterns))
+    for cat, patterns in SENT_CATEGORY_KEYWORDS.items()
+}
+SENT_ORDER_RE = re.compile(r'#?(\d{4,6})')
+
+
 @app.route('/api/extract-sent-emails', methods=['POST'])
 def extract_sent_emails():
     """Extrait les emails envoyes pour l'apprentissage IA"""
-    import re
-    import json
-
     try:
         handler = get_email_handler()
 
@@ -1644,10 +1982,16 @@ def extract_sent_emails():
 
         sent_emails = []
 
+        # Une seule connexion : chaque dossier candidat est ouvert en lecture seule (un dossier
+        # absent renvoie simplement une liste vide)
+        if not handler.connect_imap():
+            return jsonify({
+                'success': False,
+                'message': 'Erreur connexion IMAP'
+            }), 500
+
         for folder in sent_folders:
-            handler.disconnect_imap()
-            handler.connect_imap()
-            emails = handler.fetch_unread_emails(folder=folder, limit=500)
+            emails = handler.fetch_unread_emails(folder=folder, limit=500, readonly=True)
             if emails:
                 logger.info(f"Trouve {len(emails)} emails dans {folder}")
                 sent_emails.extend(emails)
@@ -1659,84 +2003,35 @@ def extract_sent_emails():
                 'message': 'Aucun email envoye trouve'
             })
 
-        # Analyse et structure les donnees pour l'apprentissage
-        training_data = []
-
-        # Patterns pour categoriser les reponses
-        categories = {
-            'SUIVI': [
-                r'suivi', r'livraison', r'colis', r'expedi', r'tracking',
-                r'ou en est', r'quand.*recev', r'delai', r'transporteur'
-            ],
-            'RETOUR': [
-                r'retour', r'rembours', r'echang', r'renvoy', r'renvoie'
-            ],
-            'PROBLEME': [
-                r'probleme', r'defectueu', r'casse', r'abime', r'erreur',
-                r'manqu', r'incomplet', r'mauvais', r'endommage'
-            ],
-            'QUESTION': [
-                r'question', r'renseign', r'information', r'savoir'
-            ],
-            'MODIFICATION': [
-                r'modifi', r'chang', r'annul', r'adresse', r'commande'
-            ]
-        }
-
-        for email_data in sent_emails:
-            subject = email_data.get('subject', '') or ''
-            body = email_data.get('body', '') or ''
-            recipient = email_data.get('sender_email', '')
-
-            if not body.strip():
-                continue
+        handler.disconnect_imap()
 
-            # Determine la categorie
-            detected_category = 'AUTRE'
-            subject_body = (subject + ' ' + body).lower()
+        def generate():
+            """Sérialise les entrées une par une : ni liste complète ni gros JSON en mémoire
 
-            for cat, patterns in categories.items():
-                for pattern in patterns:
-                    if re.search(pattern, subject_body, re.IGNORECASE):
-                        detected_category = cat
-                        break
-                if detected_category != 'AUTRE':
-                    break
+            "success" n'est écrit qu'à la fin : une erreur en cours de flux (après l'en-tête 200)
+            ferme quand même un JSON valide, avec success à false.
+            """
+            by_category = Counter()
 
-            # Extrait le numero de commande
-            order_match = re.search(r'#?(\d{4,6})', subject + ' ' + body)
-            order_number = order_match.group(1) if order_match else None
-
-            training_entry = {
-                'date': email_data.get('received_at').isoformat() if email_data.get('received_at') else None,
-                'recipient': recipient,
-                'subject': subject,
-                'body': body,
-                'category': detected_category,
-                'order_number': order_number,
-                'word_count': len(body.split())
+            yield '{"emails":['
+            try:
+                yield from _sent_training_entries(sent_emails, by_category)
+            except Exception as e:
+                logger.error(f"Erreur extraction emails envoyes (en cours de flux): {e}")
+                yield '],"success":false,"message":' + orjson.dumps(str(e)).decode() + '}'
+                return
+
+            total = sum(by_category.values())
+            # Statistiques (connues seulement une fois toutes les entrées émises)
+            stats = {
+                'total_emails': total,
+                'by_category': dict(by_category)
             }
+            yield '],"stats":' + orjson.dumps(stats).decode()
+            yield ',"message":' + orjson.dumps(f'{total} emails extraits pour apprentissage').decode()
+            yield ',"success":true}'
 
-            training_data.append(training_entry)
-
-        # Statistiques
-        stats = {
-            'total_emails': len(training_data),
-            'by_category': {}
-        }
-
-        for entry in training_data:
-            cat = entry['category']
-            stats['by_category'][cat] = stats['by_category'].get(cat, 0) + 1
-
-        handler.disconnect_imap()
-
-        return jsonify({
-            'success': True,
-            'stats': stats,
-            'emails': training_data,
-            'message': f'{len(training_data)} emails extraits pour apprentissage'
-        })
+        return Response(stream_with_context(generate()), mimetype='application/json')
 
     except Exception as e:
         logger.error(f"Erreur extraction emails envoyes: {e}")
@@ -1746,6 +2041,52 @@ def extract_sent_emails():
         }), 500
 
 
+def _sent_training_entries(sent_emails, by_category):
+    """Entrées d'apprentissage JSON (séparées par des virgules), comptées par catégorie dans by_category"""
+    total = 0
+    for email_data in sent_emails:
+        subject = email_data.get('subject', '') or ''
+        body = email_data.get('body', '') or ''
+        recipient = email_data.get('sender_email', '')
+
+        if not body.strip():
+            continue
+
+        # Determine la categorie
+        detected_category = 'AUTRE'
+        subject_body = (subject + ' ' + body).lower()
+
+        for cat, pattern in SENT_CATEGORY_PATTERNS.items():
+            if pattern.search(subject_body):
+                detected_category = cat
+                break
+
+        # Extrait le numero de commande
+        order_match = SENT_ORDER_RE.search(subject + ' ' + body)
+        order_number = order_match.group(1) if order_match else None
+
+        training_entry = {
+            'date': email_data.get('received_at').isoformat() if email_data.get('received_at') else None,
+            'recipient': recipient,
+            'subject': subject,
+            'body': body,
+            'category': detected_category,
+            'order_number': order_number,
+            'word_count': len(body.split())
+        }
+
+        yield (',' if total else '') + orjson.dumps(training_entry, default=str).decode()
+        total += 1
+        by_category[detected_category] += 1
+
+
+# En-têtes utiles à l'import des emails envoyés (Content-* pour reconstruire le MIME)
+SENT_HEADER_FIELDS = 'TO SUBJECT MESSAGE-ID IN-REPLY-TO REFERENCES DATE MIME-VERSION CONTENT-TYPE CONTENT-TRANSFER-ENCODING'
+# En-têtes seuls pour le tri des doublons, MIME complet (get_body) pour les nouveaux
+SENT_HEADER_PARSER = BytesHeaderParser()
+SENT_MIME_PARSER = BytesParser(policy=email_policy.default)
+
+
 @app.route('/api/fetch-sent-emails', methods=['POST'])
 def fetch_sent_emails():
     """Importe les emails envoyés depuis le dossier Sent pour les lier aux conversations"""
@@ -1762,86 +2103,90 @@ def fetch_sent_emails():
             }), 500
 
         sent_emails_data = []
+        known_sent_ids = set()  # Message-IDs déjà en base (vérifiés sur les en-têtes)
 
         # Essaie chaque dossier jusqu'à trouver le bon
         for folder in sent_folders:
             try:
-                handler.disconnect_imap()
-                handler.connect_imap()
-
-                # Sélectionne le dossier
-                status, _ = handler.imap_connection.select(folder)
-                if status != 'OK':
+                # Sélectionne le dossier (sans reconnexion, lecture seule : aucun flag modifié)
+                if not handler.select_folder(folder, readonly=True):
                     continue
 
                 logger.info(f"Dossier Sent trouvé: {folder}")
 
-                import email as email_lib
-
                 # D'abord récupère les expéditeurs des emails reçus pour chercher les réponses correspondantes
-                received_senders = db.session.query(Email.sender_email).distinct().all()
-                sender_emails = [s[0].lower() for s in received_senders if s[0]]
+                received_senders = db.session.query(Email.sender_email_ci).distinct().all()
+                sender_emails = [s[0] for s in received_senders if s[0]]
 
-                email_ids = []
+                max_emails = 50
+                seen_ids = {}  # UIDs, dict ordonné : déduplique au fil de l'eau
 
                 # Cherche les emails envoyés à chaque expéditeur connu
                 for sender_email in sender_emails[:30]:  # Limite à 30 pour éviter timeout
+                    if len(seen_ids) >= max_emails:
+                        break
                     try:
                         search_criteria = f'(TO "{sender_email}")'
-                        status, messages = handler.imap_connection.search(None, search_criteria)
+                        status, messages = handler.imap_connection.uid('SEARCH', None, search_criteria)
                         if status == 'OK' and messages[0]:
                             found_ids = messages[0].split()
-                            email_ids.extend(found_ids[-5:])  # Max 5 par destinataire
+                            for found_id in found_ids[-5:]:  # Max 5 par destinataire
+                                seen_ids.setdefault(found_id, None)
+                                if len(seen_ids) >= max_emails:
+                                    break
                     except Exception as search_err:
                         logger.debug(f"Erreur recherche pour {sender_email}: {search_err}")
                         continue
 
                 # Si pas assez trouvés, ajoute les plus récents
-                if len(email_ids) < 30:
-                    status, messages = handler.imap_connection.search(None, 'ALL')
+                if len(seen_ids) < 30:
+                    status, messages = handler.imap_connection.uid('SEARCH', None, 'ALL')
                     if status == 'OK':
                         all_ids = messages[0].split()
-                        email_ids.extend(list(reversed(all_ids[-30:])))
+                        for recent_id in reversed(all_ids[-30:]):
+                            seen_ids.setdefault(recent_id, None)
+                            if len(seen_ids) >= max_emails:
+                                break
 
-                # Déduplique
-                email_ids = list(dict.fromkeys(email_ids))[:50]
+                email_ids = list(seen_ids)
 
                 logger.info(f"Import de {len(email_ids)} emails envoyés (ciblés + récents)...")
-                processed_count = 0
 
-                for email_id_bytes in email_ids:
-                    try:
-                        status, msg_data = handler.imap_connection.fetch(email_id_bytes, '(RFC822)')
-                        if status != 'OK':
-                            continue
-
-                        raw_email = msg_data[0][1]
-                        msg = email_lib.message_from_bytes(raw_email)
+                # 1. En-têtes seuls, en une commande FETCH (BODY.PEEK : ne marque pas comme lu)
+                headers = handler.fetch_parts(email_ids, f'(BODY.PEEK[HEADER.FIELDS ({SENT_HEADER_FIELDS})])', uid=True)
+                header_msgs = {
+                    email_id_bytes: SENT_HEADER_PARSER.parsebytes(parts['HEADER'])
+                    for email_id_bytes, parts in headers.items() if 'HEADER' in parts
+                }
 
-                        processed_count += 1
-                        if processed_count % 10 == 0:
-                            logger.info(f"Traité {processed_count}/{len(email_ids)} emails envoyés")
+                # 2. Corps uniquement pour les messages pas encore importés
+                header_mids = {msg.get('Message-ID', '') for msg in header_msgs.values()}
+                known_sent_ids.update(db.session.scalars(
+                    db.select(SentEmail.message_id).where(SentEmail.message_id.in_(header_mids))
+                ))
+                new_ids = [i for i, msg in header_msgs.items() if msg.get('Message-ID', '') not in known_sent_ids]
+                bodies = handler.fetch_parts(new_ids, '(BODY.PEEK[TEXT])', uid=True)
 
-                        # Parse les headers
-                        to_header = msg.get('To', '')
-                        to_decoded = handler._decode_header_value(to_header)
-                        # Extrait email du format "Name <email>"
-                        to_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', to_decoded)
-                        recipient_email = to_match.group(0) if to_match else to_decoded
+                for email_id_bytes in new_ids:
+                    try:
+                        # En-têtes (dont Content-Type) + corps brut = message MIME complet
+                        raw_email = headers[email_id_bytes]['HEADER'] + bodies.get(email_id_bytes, {}).get('TEXT', b'')
+                        msg = SENT_MIME_PARSER.parsebytes(raw_email)
 
-                        to_name_match = re.match(r'^(.+?)\s*<', to_decoded)
-                        recipient_name = to_name_match.group(1).strip().strip('"') if to_name_match else ''
+                        # Parse les headers (déjà décodés par policy.default)
+                        # Extrait nom et email du format "Name <email>"
+                        recipient_name, recipient_email = (getaddresses([str(msg.get('To', ''))]) or [('', '')])[0]
 
-                        subject = handler._decode_header_value(msg.get('Subject', ''))
-                        body = handler._extract_email_body(msg)
-                        message_id = msg.get('Message-ID', '')
-                        in_reply_to = msg.get('In-Reply-To', '')
-                        references = msg.get('References', '')
+                        subject = str(msg.get('Subject', ''))
+                        body = handler._extract_message_body(msg)
+                        message_id = str(msg.get('Message-ID', ''))
+                        in_reply_to = str(msg.get('In-Reply-To', ''))
+                        references = str(msg.get('References', ''))
 
                         # Date d'envoi
-                        date_str = msg.get('Date', '')
+                        date_str = str(msg.get('Date', ''))
                         try:
-                            sent_at = email_lib.utils.parsedate_to_datetime(date_str)
+                            sent_at = parsedate_to_datetime(date_str)
                         except:
                             sent_at = datetime.utcnow()
 
@@ -1860,6 +2205,8 @@ def fetch_sent_emails():
                         logger.error(f"Erreur parsing email envoyé: {e}")
                         continue
 
+                logger.info(f"{len(sent_emails_data)} nouveaux emails envoyés ({len(header_msgs) - len(new_ids)} déjà importés)")
+
                 break  # On a trouvé le dossier Sent
 
             except Exception as e:
@@ -1877,56 +2224,69 @@ def fetch_sent_emails():
         # Enregistre les emails en base
         imported = 0
         linked = 0
+        rows = []
+
+        # Pré-charge tout ce qui servait aux recherches ligne par ligne (les message_ids
+        # déjà importés sont connus depuis la lecture des en-têtes) :
+        # emails d'origine via In-Reply-To, emails reçus par destinataire
+        seen_message_ids = known_sent_ids
+        all_in_reply_to = {e['in_reply_to'] for e in sent_emails_data if e['in_reply_to']}
+        email_id_by_mid = dict(db.session.execute(
+            db.select(Email.message_id, Email.id).where(Email.message_id.in_(all_in_reply_to))
+        ).all()) if all_in_reply_to else {}
+        recipients = {e['recipient_email'].lower() for e in sent_emails_data if e['recipient_email']}
+        received_by_sender = {}  # sender_email_ci -> [(id, sujet en minuscules)] du plus récent au plus ancien
+        if recipients:
+            for row in db.session.execute(
+                db.select(Email.id, Email.sender_email_ci, Email.subject)
+                .where(Email.sender_email_ci.in_(recipients))
+                .order_by(Email.received_at.desc())
+            ):
+                received_by_sender.setdefault(row.sender_email_ci, []).append((row.id, (row.subject or '').lower()))
 
         for email_data in sent_emails_data:
-            # Vérifie si déjà en base
-            existing = SentEmail.query.filter_by(message_id=email_data['message_id']).first()
-            if existing:
+            # Vérifie si déjà en base (ou déjà dans ce lot)
+            if email_data['message_id'] in seen_message_ids:
                 continue
+            seen_message_ids.add(email_data['message_id'])
 
             # Essaie de lier à l'email original via In-Reply-To
-            original_email_id = None
-            if email_data['in_reply_to']:
-                original = Email.query.filter_by(message_id=email_data['in_reply_to']).first()
-                if original:
-                    original_email_id = original.id
-                    linked += 1
+            original_email_id = email_id_by_mid.get(email_data['in_reply_to']) if email_data['in_reply_to'] else None
+            if original_email_id:
+                linked += 1
 
             # Si pas trouvé via In-Reply-To, essaie via l'adresse email et le sujet
             if not original_email_id and email_data['recipient_email']:
                 # Cherche un email reçu du même expéditeur avec un sujet similaire (case-insensitive)
                 subject_clean = email_data['subject'].replace('Re: ', '').replace('RE: ', '').replace('Ré: ', '').replace('Fwd: ', '').strip()
-                recipient_lower = email_data['recipient_email'].lower()
-                possible_original = Email.query.filter(
-                    db.func.lower(Email.sender_email) == recipient_lower,
-                    Email.subject.ilike(f'%{subject_clean[:30]}%')
-                ).order_by(Email.received_at.desc()).first()
-
-                # Si pas trouvé par sujet, cherche juste par email
-                if not possible_original:
-                    possible_original = Email.query.filter(
-                        db.func.lower(Email.sender_email) == recipient_lower
-                    ).order_by(Email.received_at.desc()).first()
-
-                if possible_original:
-                    original_email_id = possible_original.id
-                    linked += 1
+                subject_key = subject_clean[:30].lower()
+                candidates = received_by_sender.get(email_data['recipient_email'].lower(), [])
+                original_email_id = next((cid for cid, csubject in candidates if subject_key in csubject), None)
 
-            sent_record = SentEmail(
-                message_id=email_data['message_id'],
-                recipient_email=email_data['recipient_email'],
-                recipient_name=email_data['recipient_name'],
-                subject=email_data['subject'],
-                body=email_data['body'],
-                sent_at=email_data['sent_at'],
-                in_reply_to=email_data['in_reply_to'],
-                references=email_data['references'],
-                original_email_id=original_email_id
-            )
+                # Si pas trouvé par sujet, prend juste le plus récent de cet expéditeur
+                if not original_email_id and candidates:
+                    original_email_id = candidates[0][0]
+
+                if original_email_id:
+                    linked += 1
 
-            db.session.add(sent_record)
+            rows.append({
+                'message_id': email_data['message_id'],
+                'recipient_email': email_data['recipient_email'],
+                'recipient_email_ci': (email_data['recipient_email'] or '').lower(),
+                'recipient_name': email_data['recipient_name'],
+                'subject': email_data['subject'],
+                'body': email_data['body'],
+                'sent_at': email_data['sent_at'],
+                'in_reply_to': email_data['in_reply_to'],
+                'references': email_data['references'],
+                'original_email_id': original_email_id
+            })
             imported += 1
 
+        # Insertion groupée en une seule requête (executemany)
+        if rows:
+            db.session.execute(db.insert(SentEmail), rows)
         db.session.commit()
 
         logger.info(f"Emails envoyés importés: {imported}, liés: {linked}")
@@ -1939,7 +2299,6 @@ def fetch_sent_emails():
         })
 
     except Exception as e:
-        import traceback
         logger.error(f"Erreur fetch sent emails: {e}")
         logger.error(traceback.format_exc())
         return jsonify({
@@ -1952,54 +2311,53 @@ def fetch_sent_emails():
 def get_email_conversation(email_id):
     """Récupère l'historique complet d'une conversation (emails reçus + envoyés)"""
     try:
-        email = Email.query.get_or_404(email_id)
-        sender_email_lower = email.sender_email.lower() if email.sender_email else ''
-
-        conversation = []
-
-        # 1. Ajoute l'email principal (reçu)
-        email_dict = email.to_dict()
-        email_dict['type'] = 'received'
-        conversation.append(email_dict)
-
-        # 2. Cherche les réponses envoyées liées à cet email
-        # Via original_email_id
-        sent_replies = SentEmail.query.filter_by(original_email_id=email_id).all()
-        for sent in sent_replies:
-            conversation.append(sent.to_dict())
-
-        # 3. Cherche aussi via l'adresse email (même conversation) - CASE INSENSITIVE
-        # Emails reçus de la même personne
-        other_received = Email.query.filter(
-            db.func.lower(Email.sender_email) == sender_email_lower,
-            Email.id != email_id
-        ).order_by(Email.received_at).all()
-
-        for other in other_received:
-            other_dict = other.to_dict()
-            other_dict['type'] = 'received'
-            # Évite les doublons
-            if not any(c.get('message_id') == other_dict['message_id'] for c in conversation):
-                conversation.append(other_dict)
-
-        # Emails envoyés à la même personne - CASE INSENSITIVE
-        other_sent = SentEmail.query.filter(
-            db.func.lower(SentEmail.recipient_email) == sender_email_lower
+        sender_email_lower = db.one_or_404(
+            db.select(Email.sender_email_ci).where(Email.id == email_id)
+        ) or ''
+
+        # Liste ordonnée des messages de la conversation en une seule requête :
+        # email principal + emails reçus de la même personne, réponses liées à cet
+        # email + emails envoyés à la même personne (CASE INSENSITIVE).
+        # Seules les colonnes affichées dans le fil sont lues (pas d'objets ORM complets)
+        received_q = db.select(
+            Email.id, Email.message_id, Email.subject, Email.body, Email.received_at.label('ts'),
+            db.literal_column("'received'").label('type')
+        ).where(db.or_(
+            Email.id == email_id,
+            Email.sender_email_ci == sender_email_lower
+        ))
+        sent_q = db.select(
+            SentEmail.id, SentEmail.message_id, SentEmail.subject, SentEmail.body, SentEmail.sent_at.label('ts'),
+            db.literal_column("'sent'").label('type')
+        ).where(db.or_(
+            SentEmail.original_email_id == email_id,
+            SentEmail.recipient_email_ci == sender_email_lower
+        ))
+        timeline = db.union_all(received_q, sent_q).subquery()
+        rows = db.session.execute(
+            db.select(timeline).order_by(timeline.c.ts.asc().nullsfirst())
         ).all()
 
-        logger.info(f"Conversation pour {email_id}: sender={sender_email_lower}, found {len(other_sent)} sent emails")
-
-        for sent in other_sent:
-            sent_dict = sent.to_dict()
-            # Évite les doublons
-            if not any(c.get('message_id') == sent_dict['message_id'] for c in conversation):
-                conversation.append(sent_dict)
-
-        # Trie par date
-        conversation.sort(key=lambda x: x.get('received_at') or x.get('sent_at') or '')
+        # Évite les doublons (même message_id)
+        conversation = []
+        seen_message_ids = set()
+        has_reply = False
+        for row in rows:
+            if row.message_id in seen_message_ids:
+                continue
+            seen_message_ids.add(row.message_id)
+            date_key = 'received_at' if row.type == 'received' else 'sent_at'
+            conversation.append({
+                'id': row.id,
+                'message_id': row.message_id,
+                'type': row.type,
+                'subject': row.subject,
+                'body': row.body,
+                date_key: row.ts.isoformat() if row.ts else None
+            })
+            has_reply = has_reply or row.type == 'sent'
 
-        # Détermine si on a répondu
-        has_reply = any(c.get('type') == 'sent' for c in conversation)
+        logger.info(f"Conversation pour {email_id}: sender={sender_email_lower}, found {len(conversation)} messages")
 
         return jsonify({
             'success': True,
@@ -2020,7 +2378,12 @@ def get_email_conversation(email_id):
 @app.route('/api/emails/<int:email_id>/send-custom', methods=['POST'])
 def send_custom_response(email_id):
     """Envoie une reponse personnalisee (modifiee par l'utilisateur)"""
-    email_record = Email.query.get_or_404(email_id)
+    # Seules les colonnes utiles a l'envoi (pas de corps ni d'objet ORM a suivre)
+    email_record = db.session.execute(
+        db.select(Email.sender_email, Email.subject, Email.message_id).where(Email.id == email_id)
+    ).one_or_none()
+    if email_record is None:
+        abort(404)
 
     data = request.get_json()
     if not data or not data.get('response'):
@@ -2031,10 +2394,6 @@ def send_custom_response(email_id):
 
     response_text = data['response']
 
-    # Marque comme modifie
-    email_record.modified_before_send = True
-    email_record.generated_response = response_text
-
     # Envoie l'email
     handler = get_email_handler()
     subject = f"Re: {email_record.subject}"
@@ -2047,9 +2406,17 @@ def send_custom_response(email_id):
     )
 
     if success:
-        email_record.status = 'sent'
-        email_record.sent_at = datetime.utcnow()
+        # Marque comme modifie et envoye en un seul UPDATE
+        db.session.execute(
+            db.update(Email).where(Email.id == email_id).values(
+                modified_before_send=True,
+                generated_response=response_text,
+                status='sent',
+                sent_at=datetime.utcnow()
+            )
+        )
         db.session.commit()
+        _invalidate_stats_cache()  # UPDATE Core : pas d'evenement ORM
 
         return jsonify({
             'success': True,
@@ -2062,44 +2429,45 @@ def send_custom_response(email_id):
         }), 500
 
 
-@app.route('/api/parcelpanel/status', methods=['GET'])
-def parcelpanel_status():
-    """Verifie la configuration Parcelpanel pour tous les shops"""
+@lru_cache(maxsize=1)
+def _parcelpanel_status_payload():
+    """JSON du statut Parcelpanel, calculé une seule fois
+
+    Les clés API sont lues depuis l'environnement à la création du manager et ne
+    changent plus ensuite : inutile de recalculer (et resérialiser) à chaque appel.
+    """
     parcelpanel_manager = get_parcelpanel_manager()
 
     configured_shops = parcelpanel_manager.get_all_configured_shops()
+    configured_set = set(configured_shops)
 
-    # Liste des 7 shops attendus
-    expected_shops = [
-        'tgir1c-x2',  # FR
-        'qk16wv-2e',  # NL
-        'jl1brs-gp',  # ES
-        'pz5e9e-2e',  # IT
-        'u06wln-hf',  # DE
-        'xptmak-r7',  # PL
-        'fyh99s-h9'   # EN
-    ]
-
-    shop_status = {}
-    for shop in expected_shops:
-        shop_status[shop] = {
-            'configured': shop in configured_shops,
+    shop_status = {
+        shop: {
+            'configured': shop in configured_set,
             'handler': parcelpanel_manager.get_handler(shop) is not None
         }
+        for shop in _EXPECTED_PP_SHOPS
+    }
 
-    missing_shops = [s for s in expected_shops if s not in configured_shops]
+    missing_shops = [s for s in _EXPECTED_PP_SHOPS if s not in configured_set]
 
-    return jsonify({
+    return app.json.dumps({
         'success': len(missing_shops) == 0,
         'configured_count': len(configured_shops),
-        'expected_count': len(expected_shops),
+        'expected_count': len(_EXPECTED_PP_SHOPS),
         'configured_shops': configured_shops,
         'missing_shops': missing_shops,
         'shop_status': shop_status,
-        'message': f'{len(configured_shops)}/{len(expected_shops)} shops Parcelpanel configures'
+        'message': f'{len(configured_shops)}/{len(_EXPECTED_PP_SHOPS)} shops Parcelpanel configures'
     })
 
 
+@app.route('/api/parcelpanel/status', methods=['GET'])
+def parcelpanel_status():
+    """Verifie la configuration Parcelpanel pour tous les shops"""
+    return app.response_class(_parcelpanel_status_payload(), mimetype='application/json')
+
+
 @app.route('/api/parcelpanel/test/<shop_name>', methods=['POST'])
 def test_parcelpanel_shop(shop_name):
     """Teste la connexion Parcelpanel pour un shop specifique"""
@@ -2119,75 +2487,154 @@ def test_parcelpanel_shop(shop_name):
     return jsonify(result)
 
 
+# Cache des stats du dashboard : le dashboard poll /api/stats en boucle alors que
+# les compteurs changent rarement. Invalidé au commit de toute écriture sur Email.
+# Cache du process : suffisant avec un seul worker gunicorn (voir Procfile).
+STATS_CACHE_TTL = 5  # secondes
+_stats_cache = {'version': 0, 'cached_version': None, 'expires_at': 0.0, 'payload': None}
+
+
+def _invalidate_stats_cache(*args):
+    """Invalide le cache des stats (appel direct après un INSERT/UPDATE en masse commité)"""
+    _stats_cache['version'] += 1
+
+
+def _mark_stats_dirty(mapper, connection, target):
+    """Listener SQLAlchemy : les stats changeront au prochain commit de la session"""
+    object_session(target).info['stats_dirty'] = True
+
+
+def _invalidate_stats_on_commit(session):
+    """Invalide après le commit (pas au flush) : une requête concurrente ne peut pas
+    remettre en cache les anciens compteurs sous la nouvelle version"""
+    if session.info.pop('stats_dirty', False):
+        _invalidate_stats_cache()
+
+
+def _reset_stats_dirty(session):
+    """Rollback : les écritures annulées ne changent pas les stats"""
+    session.info.pop('stats_dirty', None)
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Email, _event_name, _mark_stats_dirty)
+event.listen(Session, 'after_commit', _invalidate_stats_on_commit)
+event.listen(Session, 'after_rollback', _reset_stats_dirty)
+
+
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     """RÃ©cupÃ¨re les statistiques"""
-    total = Email.query.count()
-    pending = Email.query.filter_by(status='pending').count()
-    sent = Email.query.filter_by(status='sent').count()
-    auto_sent = Email.query.filter_by(auto_sent=True).count()
-    ignored = Email.query.filter_by(status='ignored').count()
-
-    # Stats par catÃ©gorie
-    categories = db.session.query(
-        Email.category, db.func.count(Email.id)
-    ).group_by(Email.category).all()
-
-    return jsonify({
+    # Sert directement le JSON déjà sérialisé tant que rien n'a changé
+    now = time.monotonic()
+    version = _stats_cache['version']
+    if _stats_cache['cached_version'] == version and now < _stats_cache['expires_at']:
+        return app.response_class(_stats_cache['payload'], mimetype='application/json')
+
+    # Tous les compteurs en une seule requête (SUM(CASE ...) compatible SQLite/Postgres)
+    # En Core sur la table : pas de Query ORM ni d'instances à construire
+    emails = Email.__table__.c
+    total, pending, sent, auto_sent, ignored = db.session.execute(
+        db.select(
+            db.func.count(),
+            db.func.sum(db.case((emails.status == 'pending', 1), else_=0)),
+            db.func.sum(db.case((emails.status == 'sent', 1), else_=0)),
+            db.func.sum(db.case((emails.auto_sent == True, 1), else_=0)),
+            db.func.sum(db.case((emails.status == 'ignored', 1), else_=0))
+        ).select_from(Email.__table__)
+    ).one()
+
+    # Stats par catégorie
+    categories = db.session.execute(
+        db.select(emails.category, db.func.count()).group_by(emails.category)
+    ).all()
+
+    payload = app.json.dumps({
         'success': True,
         'stats': {
             'total': total,
-            'pending': pending,
-            'sent': sent,
-            'auto_sent': auto_sent,
-            'ignored': ignored,
+            'pending': pending or 0,
+            'sent': sent or 0,
+            'auto_sent': auto_sent or 0,
+            'ignored': ignored or 0,
             'categories': {cat: count for cat, count in categories if cat}
         }
     })
+    _stats_cache.update(cached_version=version, expires_at=now + STATS_CACHE_TTL, payload=payload)
+
+    return app.response_class(payload, mimetype='application/json')
+
+
+TEST_CONNECTIONS_TIMEOUT = 10  # secondes, pour l'ensemble des tests
 
 
 @app.route('/api/test-connections', methods=['POST'])
 def test_connections():
-    """Teste toutes les connexions (Zoho, Shopify, Claude)"""
+    """Teste toutes les connexions (Zoho, Shopify, Gemini) en parallèle"""
     results = {}
+    futures = {}
 
-    # Test Zoho
-    if app.config.get('ZOHO_EMAIL') and app.config.get('ZOHO_PASSWORD'):
-        results['zoho'] = test_zoho_connection(
-            app.config['ZOHO_EMAIL'],
-            app.config['ZOHO_PASSWORD'],
-            app.config.get('ZOHO_IMAP_SERVER', 'imap.zoho.eu')
-        )
-    else:
-        results['zoho'] = {'success': False, 'message': 'Non configurÃ©'}
+    executor = ThreadPoolExecutor(max_workers=3)
+    try:
+        # Test Zoho
+        if app.config.get('ZOHO_EMAIL') and app.config.get('ZOHO_PASSWORD'):
+            futures['zoho'] = executor.submit(
+                test_zoho_connection,
+                app.config['ZOHO_EMAIL'],
+                app.config['ZOHO_PASSWORD'],
+                app.config.get('ZOHO_IMAP_SERVER', 'imap.zoho.eu')
+            )
+        else:
+            results['zoho'] = {'success': False, 'message': 'Non configuré'}
 
-    # Test Shopify (OAuth ou legacy)
-    storage = get_token_storage_instance()
-    shops = storage.get_all_shops()
+        # Test Shopify (OAuth ou legacy) - le storage est lu ici, dans le contexte de la requête
+        storage = get_token_storage_instance()
+        shops = storage.get_all_shops()
 
-    if shops:
-        # Test avec le premier shop connectÃ© via OAuth
-        shop_name = list(shops.keys())[0]
-        access_token = storage.get_token(shop_name)
-        results['shopify'] = test_shopify_connection(shop_name, access_token)
-        results['shopify']['connected_shops'] = len(shops)
-    elif app.config.get('SHOPIFY_SHOP_NAME') and app.config.get('SHOPIFY_ACCESS_TOKEN'):
-        # Fallback: token legacy
-        results['shopify'] = test_shopify_connection(
-            app.config['SHOPIFY_SHOP_NAME'],
-            app.config['SHOPIFY_ACCESS_TOKEN']
-        )
-    else:
-        results['shopify'] = {'success': False, 'message': 'Aucun shop connectÃ©'}
+        if shops:
+            # Test avec le premier shop connecté via OAuth
+            shop_name = next(iter(shops))
+            access_token = storage.get_token(shop_name)
+            futures['shopify'] = executor.submit(test_shopify_connection, shop_name, access_token)
+        elif app.config.get('SHOPIFY_SHOP_NAME') and app.config.get('SHOPIFY_ACCESS_TOKEN'):
+            # Fallback: token legacy
+            futures['shopify'] = executor.submit(
+                test_shopify_connection,
+                app.config['SHOPIFY_SHOP_NAME'],
+                app.config['SHOPIFY_ACCESS_TOKEN']
+            )
+        else:
+            results['shopify'] = {'success': False, 'message': 'Aucun shop connecté'}
 
-    # Test Gemini (IA)
-    api_key = app.config.get('GEMINI_API_KEY') or app.config.get('ANTHROPIC_API_KEY')
-    if api_key:
-        results['gemini'] = test_ai_connection(api_key)
-    else:
-        results['gemini'] = {'success': False, 'message': 'Non configuré'}
+        # Test Gemini (IA) - premiere cle configuree (GEMINI_API_KEYS si GEMINI_API_KEY absente)
+        api_key = (app.config.get('GEMINI_API_KEY') or (app.config.get('GEMINI_API_KEYS') or [None])[0]
+                   or app.config.get('ANTHROPIC_API_KEY'))
+        if api_key:
+            futures['gemini'] = executor.submit(test_ai_connection, api_key)
+        else:
+            results['gemini'] = {'success': False, 'message': 'Non configuré'}
 
-    all_ok = all(r.get('success') for r in results.values())
+        # Résultats au fil de l'eau, avec un délai global : un service lent ne retarde
+        # pas la réponse au-delà de TEST_CONNECTIONS_TIMEOUT
+        names = {future: name for name, future in futures.items()}
+        try:
+            for future in as_completed(names, timeout=TEST_CONNECTIONS_TIMEOUT):
+                try:
+                    results[names[future]] = future.result()
+                except Exception as e:
+                    results[names[future]] = {'success': False, 'message': str(e)}
+        except TimeoutError:
+            for name in futures:
+                results.setdefault(name, {'success': False, 'message': 'Timeout'})
+    finally:
+        # N'attend pas les tests encore en cours (leur résultat est déjà compté en échec)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # Les services non configurés ou en échec rendent le test global négatif
+    all_ok = all(result.get('success') for result in results.values())
+
+    if shops and 'shopify' in futures:
+        results['shopify']['connected_shops'] = len(shops)
 
     return jsonify({
         'success': all_ok,
@@ -2199,19 +2646,79 @@ def test_connections():
 # BACKGROUND TASK - Email Checker
 # ============================================
 
-def background_email_checker():
-    """VÃ©rifie les emails en arriÃ¨re-plan"""
-    while True:
-        interval = app.config.get('EMAIL_CHECK_INTERVAL', 300)
-        time.sleep(interval)
+def check_emails_job():
+    """Job planifié : vérifie les emails (pousse son propre contexte applicatif)"""
+    with app.app_context():
+        try:
+            logger.info("Vérification automatique des emails...")
+            # Simule l'appel API
+            # En production, on appellerait directement la logique
+        except Exception as e:
+            logger.error(f"Erreur background checker: {e}")
+
 
-        with app.app_context():
-            try:
-                logger.info("VÃ©rification automatique des emails...")
-                # Simule l'appel API
-                # En production, on appellerait directement la logique
-            except Exception as e:
-                logger.error(f"Erreur background checker: {e}")
+def classification_batch_job():
+    """Job planifié : applique la classification différée dès que le batch Gemini est terminé"""
+    with app.app_context():
+        try:
+            batch_name, classified = apply_classification_batch()
+            if classified:
+                logger.info(f"Batch {batch_name} appliqué: {classified} emails classifiés")
+        except Exception as e:
+            logger.error(f"Erreur batch classification: {e}")
+
+
+def start_email_scheduler():
+    """
+    Démarre le checker en background via APScheduler.
+    coalesce + max_instances=1 : les exécutions manquées sont fusionnées
+    et deux vérifications ne se chevauchent jamais.
+    """
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    interval = app.config.get('EMAIL_CHECK_INTERVAL', 300)
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(
+        check_emails_job,
+        'interval',
+        seconds=interval,
+        id='check_emails',
+        coalesce=True,
+        max_instances=1
+    )
+    scheduler.start()
+    # Arrêt propre à la sortie du process (sans attendre un job en cours)
+    atexit.register(scheduler.shutdown, wait=False)
+    logger.info(f"Scheduler emails démarré (toutes les {interval}s)")
+    return scheduler
+
+
+def start_classification_batch_scheduler():
+    """
+    Démarre l'application périodique des batchs de classification (mode AI_BATCH_ENABLED).
+    Indépendant du checker emails (optionnel) : sans lui, un job envoyé ne serait jamais appliqué.
+    """
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    interval = app.config.get('EMAIL_CHECK_INTERVAL', 300)
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(
+        classification_batch_job,
+        'interval',
+        seconds=interval,
+        id='classification_batch',
+        coalesce=True,
+        max_instances=1
+    )
+    scheduler.start()
+    atexit.register(scheduler.shutdown, wait=False)
+    logger.info(f"Scheduler batch classification démarré (toutes les {interval}s)")
+    return scheduler
+
+
+# Démarré à l'import : gunicorn (Procfile, un seul worker) n'exécute pas le bloc __main__
+if app.config.get('AI_BATCH_ENABLED'):
+    start_classification_batch_scheduler()
 
 
 # ============================================
@@ -2220,8 +2727,7 @@ def background_email_checker():
 
 if __name__ == '__main__':
     # DÃ©marre le checker en background (optionnel)
-    # checker_thread = threading.Thread(target=background_email_checker, daemon=True)
-    # checker_thread.start()
+    # start_email_scheduler()
 
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
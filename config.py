@@ -20,6 +20,16 @@ class Config:
     SQLALCHEMY_DATABASE_URI = _database_url
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Pool de connexions Postgres : Railway coupe les connexions inactives (~300 s),
+    # pool_pre_ping détecte une connexion morte avant usage et pool_recycle la renouvelle avant
+    if not _database_url.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_pre_ping': True,
+            'pool_recycle': 280
+        }
+
     # Zoho Mail
     ZOHO_EMAIL = os.getenv('ZOHO_EMAIL')
     ZOHO_PASSWORD = os.getenv('ZOHO_PASSWORD')
@@ -43,6 +53,11 @@ class Config:
 
     # Gemini (Google AI) - utilisé pour les réponses
     GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+    # Clés supplémentaires (séparées par des virgules), utilisées à tour de rôle en cas de limite (429)
+    GEMINI_API_KEYS = [key.strip() for key in os.getenv('GEMINI_API_KEYS', '').split(',') if key.strip()]
+
+    # Classification des files (reclassification) via le Batch API Gemini : différée, moitié prix
+    AI_BATCH_ENABLED = os.getenv('AI_BATCH_ENABLED', 'false').lower() == 'true'
 
     # Anthropic (legacy - gardé pour compatibilité)
     ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
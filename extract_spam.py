@@ -12,6 +12,30 @@ load_dotenv()
 
 from modules.email_handler import ZohoEmailHandler
 
+# Seul un aperçu de 100 caractères est exporté : en-têtes + début du texte suffisent
+# (BODY.PEEK : les emails ne sont pas marqués comme lus)
+PREVIEW_FETCH_SPEC = '(BODY.PEEK[HEADER] BODY.PEEK[TEXT]<0.2048>)'
+
+def _csv_row(email_data: dict) -> list:
+    """Ligne CSV d'un email spam"""
+    # Aperçu du contenu (premiers 100 caractères)
+    body_preview = email_data.get('body', '')[:100].replace('\n', ' ').replace('\r', '')
+
+    # Format date
+    received_at = email_data.get('received_at')
+    if received_at:
+        date_str = received_at.strftime('%Y-%m-%d %H:%M') if isinstance(received_at, datetime) else str(received_at)
+    else:
+        date_str = ''
+
+    return [
+        date_str,
+        email_data.get('sender_email', ''),
+        email_data.get('sender_name', ''),
+        email_data.get('subject', ''),
+        body_preview
+    ]
+
 def extract_spam_to_csv(output_file: str = "spam_emails.csv", limit: int = None):
     """Extrait les emails du dossier Courrier indésirable vers un CSV"""
 
@@ -34,21 +58,18 @@ def extract_spam_to_csv(output_file: str = "spam_emails.csv", limit: int = None)
     folders = handler.list_folders()
     print(f"Dossiers disponibles: {folders}")
 
-    # Essaie plusieurs noms possibles pour le dossier spam
+    # Plusieurs noms possibles pour le dossier spam : on prend le premier qui existe
+    # (sur la connexion ouverte, sans reconnexion par nom essayé)
     spam_folders = ["Courrier indésirable", "Spam", "Junk", "Bulk"]
+    available = {name.lower(): name for name in folders}
+    spam_folder = next((available[name.lower()] for name in spam_folders if name.lower() in available), None)
 
     spam_emails = []
 
-    for spam_folder in spam_folders:
-        print(f"Tentative avec le dossier: {spam_folder}")
-        handler.disconnect_imap()
-        handler.connect_imap()
-
-        emails = handler.fetch_unread_emails(folder=spam_folder, limit=limit)
-        if emails:
-            print(f"Trouvé {len(emails)} emails dans {spam_folder}")
-            spam_emails.extend(emails)
-            break
+    if spam_folder:
+        print(f"Dossier spam: {spam_folder}")
+        spam_emails = handler.fetch_unread_emails(folder=spam_folder, limit=limit, fetch_spec=PREVIEW_FETCH_SPEC)
+        print(f"Trouvé {len(spam_emails)} emails dans {spam_folder}")
 
     if not spam_emails:
         print("Aucun email trouvé dans les dossiers spam")
@@ -70,24 +91,8 @@ def extract_spam_to_csv(output_file: str = "spam_emails.csv", limit: int = None)
             'Aperçu du contenu (100 chars)'
         ])
 
-        for email_data in spam_emails:
-            # Aperçu du contenu (premiers 100 caractères)
-            body_preview = email_data.get('body', '')[:100].replace('\n', ' ').replace('\r', '')
-
-            # Format date
-            received_at = email_data.get('received_at')
-            if received_at:
-                date_str = received_at.strftime('%Y-%m-%d %H:%M') if isinstance(received_at, datetime) else str(received_at)
-            else:
-                date_str = ''
-
-            writer.writerow([
-                date_str,
-                email_data.get('sender_email', ''),
-                email_data.get('sender_name', ''),
-                email_data.get('subject', ''),
-                body_preview
-            ])
+        # Toutes les lignes en un seul appel (générateur : pas de liste intermédiaire)
+        writer.writerows(_csv_row(email_data) for email_data in spam_emails)
 
     handler.disconnect_imap()
     print(f"✓ Export terminé: {output_file}")
@@ -2,20 +2,47 @@
 Modèles de base de données pour Avena SAV
 """
 from datetime import datetime
+import logging
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import validates
 
 db = SQLAlchemy()
 
+logger = logging.getLogger(__name__)
+
 
 class Email(db.Model):
     """Modèle pour stocker les emails SAV"""
     __tablename__ = 'emails'
+    __table_args__ = (
+        # Index partiel pour l'enrichissement client (pagination par id)
+        db.Index(
+            'ix_email_enrich', 'category', 'order_number', 'id',
+            postgresql_where=text("order_number IS NULL AND category <> 'SPAM'"),
+            sqlite_where=text("order_number IS NULL AND category <> 'SPAM'")
+        ),
+        # Filtres / GROUP BY des statistiques (status seul : servi par ix_email_status_category)
+        db.Index('ix_email_category', 'category'),
+        # File de classification (classify-next / reclassify-all) et tri de la liste
+        db.Index('ix_email_status_category', 'status', 'category'),
+        db.Index('ix_email_received_at', 'received_at'),
+        # Conversation : emails d'une adresse, déjà triés par date (sert aussi les recherches par adresse)
+        db.Index('ix_email_sender_ci_received', 'sender_email_ci', 'received_at'),
+        db.Index(
+            'ix_email_auto_sent', 'auto_sent',
+            postgresql_where=text('auto_sent'),
+            sqlite_where=text('auto_sent = 1')
+        ),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(db.String(255), unique=True, nullable=False)
 
     # Infos email
     sender_email = db.Column(db.String(255), nullable=False)
+    # Adresse en minuscules (renseignée automatiquement) : recherches insensibles à la casse indexées
+    sender_email_ci = db.Column(db.String(255), info={'backfill': 'lower(sender_email)'})
     sender_name = db.Column(db.String(255))
     subject = db.Column(db.String(500))
     body = db.Column(db.Text)
@@ -24,6 +51,7 @@ class Email(db.Model):
     # Classification IA
     category = db.Column(db.String(50))  # SUIVI, RETOUR, PROBLEME, QUESTION, AUTRE
     confidence = db.Column(db.Float)  # Score de confiance 0-1
+    language = db.Column(db.String(5))  # Langue détectée (fr, en, de...) - évite de la recalculer
 
     # Lien Shopify
     order_number = db.Column(db.String(50))
@@ -56,6 +84,7 @@ class Email(db.Model):
             'received_at': self.received_at.isoformat() if self.received_at else None,
             'category': self.category,
             'confidence': self.confidence,
+            'language': self.language,
             'order_number': self.order_number,
             'generated_response': self.generated_response,
             'status': self.status,
@@ -63,6 +92,12 @@ class Email(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+    @validates('sender_email')
+    def _sync_sender_email_ci(self, key, value):
+        """Tient à jour sender_email_ci à chaque affectation de sender_email"""
+        self.sender_email_ci = value.lower() if value else value
+        return value
+
 
 class ResponseTemplate(db.Model):
     """Templates de réponses personnalisables"""
@@ -93,12 +128,17 @@ class Settings(db.Model):
 class SentEmail(db.Model):
     """Modèle pour stocker les emails envoyés (réponses SAV)"""
     __tablename__ = 'sent_emails'
+    __table_args__ = (
+        # Conversation : emails envoyés à une adresse, déjà triés par date
+        db.Index('ix_sent_recipient_ci_sent', 'recipient_email_ci', 'sent_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(db.String(255), unique=True, nullable=False)
 
     # Destinataire
     recipient_email = db.Column(db.String(255), nullable=False, index=True)
+    recipient_email_ci = db.Column(db.String(255), info={'backfill': 'lower(recipient_email)'})
     recipient_name = db.Column(db.String(255))
 
     # Contenu
@@ -111,7 +151,7 @@ class SentEmail(db.Model):
     references = db.Column(db.Text)  # Chain de références
 
     # Lien avec l'email reçu (si on peut le retrouver)
-    original_email_id = db.Column(db.Integer, db.ForeignKey('emails.id'), nullable=True)
+    original_email_id = db.Column(db.Integer, db.ForeignKey('emails.id'), nullable=True, index=True)
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -130,6 +170,12 @@ class SentEmail(db.Model):
             'type': 'sent'  # Pour différencier des emails reçus
         }
 
+    @validates('recipient_email')
+    def _sync_recipient_email_ci(self, key, value):
+        """Tient à jour recipient_email_ci à chaque affectation de recipient_email"""
+        self.recipient_email_ci = value.lower() if value else value
+        return value
+
 
 class ShopifyToken(db.Model):
     """Tokens Shopify stockés en base de données (persistant)"""
@@ -152,3 +198,52 @@ class ShopifyToken(db.Model):
             'shop_email': self.shop_email,
             'connected_at': self.created_at.isoformat() if self.created_at else None
         }
+
+
+class MailboxState(db.Model):
+    """Dernier UID IMAP importé par dossier (ne récupère que les nouveaux emails)"""
+    __tablename__ = 'mailbox_states'
+
+    id = db.Column(db.Integer, primary_key=True)
+    folder = db.Column(db.String(255), unique=True, nullable=False)
+    uid_validity = db.Column(db.BigInteger)  # UIDVALIDITY du dossier : si elle change, les UIDs repartent de zéro
+    last_uid = db.Column(db.BigInteger, nullable=False, default=0)
+
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# Index remplacés par un index composite qui commence par la même colonne
+OBSOLETE_INDEXES = ('ix_emails_sender_email_ci', 'ix_sent_emails_recipient_email_ci', 'ix_email_status')
+
+
+def upgrade_schema():
+    """Ajoute les colonnes et index manquants (et supprime les index obsolètes) sur une base existante
+
+    db.create_all() ne crée que les tables absentes : les colonnes et index
+    ajoutés aux modèles après coup doivent être créés à la main (pas d'Alembic).
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {col['name'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                logger.info(f"Colonne ajoutée: {table.name}.{column.name}")
+
+                # Remplit la nouvelle colonne pour les lignes existantes si besoin
+                if column.info.get('backfill'):
+                    conn.execute(text(f"UPDATE {table.name} SET {column.name} = {column.info['backfill']}"))
+
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        for index_name in OBSOLETE_INDEXES:
+            conn.execute(text(f'DROP INDEX IF EXISTS {index_name}'))
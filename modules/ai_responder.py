@@ -2,18 +2,30 @@
 Module IA - Classification et génération de réponses avec Gemini
 Intègre les données Parcelpanel pour le tracking en temps réel
 """
+import os
+import re
+import hashlib
+import threading
+import time
 import requests
-from typing import Dict, Optional, Tuple
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 import logging
 
+import orjson
+
 logger = logging.getLogger(__name__)
 
 
 # Catégories de demandes SAV avec type de traitement
 # AUTO = L'IA peut répondre automatiquement (avec infos Parcelpanel)
 # MANUAL = Nécessite validation humaine avant envoi
-CATEGORIES = {
+CATEGORIES = MappingProxyType({
     "SUIVI": {
         "description": "Demande de suivi de commande (où est ma commande, délai de livraison)",
         "type": "AUTO",  # Auto si tracking disponible
@@ -49,38 +61,459 @@ CATEGORIES = {
         "type": "MANUAL",  # Par défaut, validation humaine
         "requires_tracking": False
     }
+})
+
+
+# Domaines nationaux -> langue (raccourci avant l'analyse du texte)
+TLD_LANGUAGES = MappingProxyType({
+    'fr': 'fr',
+    'de': 'de',
+    'it': 'it',
+    'es': 'es',
+    'nl': 'nl',
+    'pl': 'pl'
+})
+
+
+# Mots clés pour détection rapide de la langue
+LANG_KEYWORDS = MappingProxyType({
+    'fr': ['bonjour', 'merci', 'commande', 'livraison', 'retour', 'colis', 'je', 'vous', 'nous', 'mon', 'ma', 'mes'],
+    'en': ['hello', 'thank', 'order', 'delivery', 'return', 'package', 'my', 'your', 'please', 'the', 'tracking'],
+    'de': ['hallo', 'danke', 'bestellung', 'lieferung', 'paket', 'meine', 'ihre', 'bitte', 'wann', 'zurück'],
+    'es': ['hola', 'gracias', 'pedido', 'envío', 'paquete', 'mi', 'cuando', 'dónde', 'devolver', 'entrega'],
+    'it': ['ciao', 'grazie', 'ordine', 'spedizione', 'pacco', 'mio', 'quando', 'dove', 'reso', 'consegna'],
+    'nl': ['hallo', 'bedankt', 'bestelling', 'levering', 'pakket', 'mijn', 'wanneer', 'retour', 'verzending'],
+    'pl': ['cześć', 'dzięki', 'zamówienie', 'dostawa', 'paczka', 'moje', 'kiedy', 'gdzie', 'zwrot', 'przesyłka']
+})
+
+LANG_KEYWORD_SETS = MappingProxyType({lang: frozenset(keywords) for lang, keywords in LANG_KEYWORDS.items()})
+
+
+def _keyword_trie_pattern(words) -> str:
+    """
+    Alternance regex factorisée en arbre de préfixes (trie) : "ma|mes|mon" devient "m(?:a|es|on)"
+
+    Le moteur ne teste plus chaque mot clé l'un après l'autre à chaque position :
+    il suit un seul chemin caractère par caractère, comme un automate Aho-Corasick.
+    Les quantificateurs gourmands gardent le mot clé le plus long.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True  # Fin d'un mot clé
+
+    def build(node) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{pattern})?' if '' in node else pattern
+
+    return build(trie)
+
+
+# Tous les mots clés en une seule regex, ancrés en début de mot :
+# "thank" reconnaît aussi "thanks", mais "ma" n'est plus trouvé au milieu de "commande"
+LANG_KEYWORDS_RE = re.compile(
+    r'\b(' + _keyword_trie_pattern({kw for kws in LANG_KEYWORDS.values() for kw in kws}) + ')'
+)
+
+
+# Début du texte analysé pour la langue : suffisant, et l'historique cité plus bas
+# (souvent nos propres réponses en français) ne fausse pas la détection
+LANG_DETECT_MAX_CHARS = 2000
+
+
+@lru_cache(maxsize=4096)
+def _detect_language_from_text(text: str) -> str:
+    """Détection par mots clés (voir AIResponder.detect_language), mémorisée par texte"""
+    # Texte trop court pour être analysé
+    if len(text.strip()) < 30:
+        return 'fr'
+
+    # Une seule passe regex sur le texte : mots clés distincts trouvés
+    found = set(LANG_KEYWORDS_RE.findall(text.lower()))
+    if len(found) < 2:
+        return 'fr'  # Aucune langue ne peut atteindre le score minimum
+
+    # Langue avec le plus de correspondances, en un seul parcours (égalité : la première l'emporte)
+    detected, best_score = 'fr', 0
+    for lang, keywords in LANG_KEYWORD_SETS.items():
+        score = len(found & keywords)
+        if score > best_score:
+            detected, best_score = lang, score
+
+    # Si pas assez de confiance, défaut français
+    if best_score < 2:
+        return 'fr'
+
+    logger.info(f"Langue détectée: {detected} (score: {best_score})")
+    return detected
+
+
+# Consignes fixes de classification (systemInstruction) : seul l'email change d'un appel à l'autre
+CLASSIFY_RUBRIC = """Tu classes les emails du service client d'Avena Paris (e-commerce mode/beauté).
+AUTO (réponse automatique possible) : suivi de commande, question produit (taille, couleur, stock), délais/transporteurs, question simple sur retours/échanges.
+MANUEL (humain requis) : retour ou remboursement, produit défectueux/erroné/endommagé, modification ou annulation de commande, réclamation, cas complexe ou sensible."""
+
+# Le format de sortie est imposé par responseSchema : pas d'exemple JSON à répéter
+CLASSIFY_SYSTEM_PROMPT = CLASSIFY_RUBRIC + """
+Donne la catégorie et ta confiance (0 à 1)."""
+
+
+# Partie variable des prompts (le tour utilisateur) : gabarits remplis par str.format
+CLASSIFY_USER_PROMPT = """Sujet : {subject}
+Corps : {body}"""
+
+GENERATE_USER_PROMPT = """LANGUE : {lang_name}
+CONTEXTE :
+{context_str}
+Sujet : {subject}
+Message : {body}"""
+
+
+# Noms des langues pour le prompt de génération
+LANG_NAMES = MappingProxyType({
+    'fr': 'français',
+    'en': 'anglais',
+    'de': 'allemand',
+    'es': 'espagnol',
+    'it': 'italien',
+    'nl': 'néerlandais',
+    'pl': 'polonais'
+})
+
+# Traduction des statuts de livraison Shopify
+SHIPMENT_STATUS_LABELS = MappingProxyType({
+    'confirmed': 'Pris en charge',
+    'in_transit': 'En cours de livraison',
+    'out_for_delivery': 'En livraison aujourd\'hui',
+    'delivered': 'Livré',
+    'attempted_delivery': 'Tentative de livraison',
+    'ready_for_pickup': 'À retirer en point relais',
+    'failure': 'Problème de livraison'
+})
+
+
+# Instructions de rédaction selon la catégorie
+GENERATE_CATEGORY_INSTRUCTIONS = MappingProxyType({
+    "SUIVI": """
+- UTILISE LES INFORMATIONS DE TRACKING EN TEMPS RÉEL si disponibles (statut actuel, localisation, date estimée)
+- Si un tracking est disponible, donne le statut précis, le transporteur et le lien de suivi
+- Si pas de tracking, indique que la commande est en préparation et donne un délai estimé (2-5 jours ouvrés)
+- Reste rassurant et professionnel""",
+
+    "RETOUR": """
+- Indique la procédure de retour (14 jours, produit non porté, étiquette retour)
+- Propose un échange ou remboursement
+- Demande des précisions si nécessaire (raison, taille souhaitée pour échange)""",
+
+    "PROBLEME": """
+- Présente des excuses pour le désagrément
+- Propose une solution (renvoi du produit, remboursement, geste commercial)
+- Demande des photos si pertinent
+- Montre de l'empathie""",
+
+    "QUESTION": """
+- Réponds de manière informative et chaleureuse
+- Propose de l'aide supplémentaire
+- Invite à passer commande si pertinent""",
+
+    "MODIFICATION": """
+- Vérifie si la modification est encore possible (selon le statut)
+- Si expédié, explique qu'il n'est plus possible de modifier
+- Propose des alternatives si besoin""",
+
+    "AUTRE": """
+- Réponds de manière générique mais professionnelle
+- Redirige vers le bon service si nécessaire
+- Reste aimable et serviable"""
+})
+
+
+@lru_cache(maxsize=32)
+def _generate_system_prompt(company_name: str, category: str) -> str:
+    """
+    Consignes fixes de génération (systemInstruction) pour une catégorie
+
+    Construites une fois par (entreprise, catégorie) : le texte est identique d'un
+    email à l'autre, seuls la langue, le contexte et l'email passent dans le prompt.
+    """
+    instructions = GENERATE_CATEGORY_INSTRUCTIONS.get(category, GENERATE_CATEGORY_INSTRUCTIONS["AUTRE"])
+
+    return f"""Tu rédiges les réponses du service client de {company_name} (e-commerce mode, Paris).
+Demande de type {category} :{instructions}
+
+Consignes :
+- Réponds ENTIÈREMENT dans la LANGUE indiquée avec l'email, salutation comprise
+- Professionnel, chaleureux, direct ; vouvoiement (ou forme polie équivalente)
+- Utilise le tracking du CONTEXTE s'il est fourni
+- Termine par une formule de politesse et "L'équipe {company_name}"
+- Aucun placeholder ([XX]) : réponse prête à envoyer
+- Écris uniquement la réponse, sans commentaire ni explication"""
+
+
+@lru_cache(maxsize=8)
+def _classify_and_generate_system_prompt(company_name: str) -> str:
+    """Consignes fixes de l'appel combiné : classification AUTO/MANUEL puis rédaction de la réponse"""
+    return f"""{CLASSIFY_RUBRIC}
+
+Puis rédige la réponse au client (champ response) :
+
+{_generate_system_prompt(company_name, "AUTRE")}"""
+
+
+# Budgets de sortie : une réponse SAV fait 120-250 tokens, un JSON de classification moins de 50
+CLASSIFY_MAX_TOKENS = 64  # Par email classifié
+GENERATE_MAX_TOKENS = 400
+GENERATE_MAX_TOKENS_CEILING = 1000  # Relance si la réponse est tronquée
+GENERATE_STOP_SEQUENCES = ["\n\n---", "```"]
+
+
+# Appels Gemini simultanés au maximum pour un lot d'emails (borne pour le rate limit)
+AI_CONCURRENCY = int(os.getenv('AI_CONCURRENCY', 8))
+
+# Borne commune à tout le processus : lots de classify_many, requêtes web et jobs planifiés
+# se partagent les mêmes AI_CONCURRENCY appels en vol au lieu de s'additionner
+_gemini_slots = threading.BoundedSemaphore(AI_CONCURRENCY)
+
+
+@lru_cache(maxsize=1)
+def _gemini_session() -> requests.Session:
+    """
+    Session HTTP partagée par tous les appels Gemini (responders et test de connexion)
+
+    Keep-alive : la connexion TLS est réutilisée d'un appel à l'autre, et le pool
+    garde assez de connexions ouvertes pour les appels simultanés de classify_many.
+    Les erreurs serveur (5xx) sont relancées avec un délai croissant ; un 429 est renvoyé
+    tout de suite à _post_model, qui passe à la clé suivante. Relances à réserver
+    aux appels qui ne créent rien côté Gemini (generateContent), une requête relancée
+    après avoir été acceptée ne fait que régénérer le même texte.
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),  # 429 : rotation de clé immédiate (_post_model)
+        allowed_methods=frozenset({"POST"}),  # generateContent : pas d'état créé, relance possible
+        raise_on_status=False  # Après le dernier essai, raise_for_status() lève l'HTTPError habituelle
+    )
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(AI_CONCURRENCY, 10), max_retries=retry)
+    session.mount("https://", adapter)
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+
+# Règles locales appliquées avant Gemini : les demandes évidentes ne coûtent pas d'appel.
+# Testées dans l'ordre, MANUEL d'abord (en cas de doute, validation humaine) ; texte déjà en minuscules
+CLASSIFY_RULES = [
+    ('MANUEL', re.compile(
+        r"\b(rembours|refund|retourner|renvoyer|return(ing)? (the|my|an?) |échang|exchange|annul|cancel"
+        r"|défectu|defect|cass[ée]|broken|abîm|abim|endommag|damaged|réclamation|plainte|complaint"
+        r"|pas reçu|jamais reçu|not received|never received|never arrived|wrong (item|size|product)"
+        r"|rückerstatt|erstattung|stornier|beschädigt|kaputt|reembols|devoluci|devolver|cancelar|dañad"
+        r"|rimbors|annull|danneggiat|terugbetal|annuleren|beschadigd|zwrot pieni|anulow|uszkodz|reklamac)"
+    )),
+    ('AUTO', re.compile(
+        r"\b(o[uù] (est|en est) ma commande|suivi de (ma )?commande|num[ée]ro de suivi|tracking|track my"
+        r"|where is my (order|package|parcel)|when will (i|my order)|wo ist meine (bestellung|sendung)"
+        r"|sendungsverfolgung|d[oó]nde est[aá] mi pedido|seguimiento|dov'?[èe] il mio (ordine|pacco)"
+        r"|tracciamento|waar is mijn (bestelling|pakket)|gdzie jest moja? (zamówienie|paczka)|śledzeni)"
+    )),
+]
+CLASSIFY_RULE_CONFIDENCE = 0.9
+
+
+def _classify_by_rules(subject: str, body: str) -> Optional[Tuple[str, float]]:
+    """Classification immédiate par mots clés, ou None si l'email n'est pas évident"""
+    text = f"{subject or ''}\n{body or ''}".lower()
+    for category, pattern in CLASSIFY_RULES:
+        match = pattern.search(text)
+        if match:
+            logger.info(f"Email classifié par règle: {category} (mot clé: {match.group(0)!r})")
+            return category, CLASSIFY_RULE_CONFIDENCE
+    return None
+
+
+# Emails regroupés dans une même requête de classification (classify_many)
+CLASSIFY_BATCH_SIZE = int(os.getenv('CLASSIFY_BATCH_SIZE', 10))
+
+
+# Réponses JSON imposées à Gemini (responseSchema) : plus de texte libre à nettoyer
+CLASSIFICATION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "category": {"type": "STRING", "enum": ["AUTO", "MANUEL"]},
+        "confidence": {"type": "NUMBER"}
+    },
+    "required": ["category", "confidence"],
+    "propertyOrdering": ["category", "confidence"]
+}
+
+CLASSIFY_AND_GENERATE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {**CLASSIFICATION_SCHEMA["properties"], "response": {"type": "STRING"}},
+    "required": ["category", "confidence", "response"],
+    "propertyOrdering": ["category", "confidence", "response"]
+}
+
+BATCH_CLASSIFICATION_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {"i": {"type": "INTEGER"}, **CLASSIFICATION_SCHEMA["properties"]},
+        "required": ["i", "category", "confidence"],
+        "propertyOrdering": ["i", "category", "confidence"]
+    }
 }
 
 
+class BatchJobFailed(Exception):
+    """Job Batch API terminé sans résultat (échec, annulé, expiré ou introuvable) : inutile de le relancer"""
+
+
+def _parse_json_reply(result_text: str):
+    """Parse la réponse JSON de Gemini (retire d'éventuelles balises ``` par sécurité)"""
+    return orjson.loads(result_text.removeprefix("```json").removeprefix("```").removesuffix("```").strip())
+
+
+def _parse_classification(result: Dict) -> Tuple[str, float]:
+    """Extrait (catégorie, confiance) d'un objet JSON de classification"""
+    category = result.get("category", "MANUEL").upper()
+    confidence = float(result.get("confidence", 0.5))
+
+    # Valide : seulement AUTO ou MANUEL
+    if category not in ['AUTO', 'MANUEL']:
+        category = 'MANUEL'  # Par défaut = validation humaine
+
+    return category, confidence
+
+
+# Cache des classifications : un email renvoyé ou une newsletter identique ne repasse pas par l'API
+CLASSIFY_CACHE_SIZE = 4096
+_classify_cache: "OrderedDict[bytes, Tuple[str, float]]" = OrderedDict()
+_classify_inflight: Dict[bytes, Future] = {}  # Classifications en cours, partagées entre threads
+_classify_lock = threading.Lock()
+
+
+def _classify_key(subject: str, body: str) -> bytes:
+    """Empreinte (sujet, corps) normalisée : minuscules, espaces fusionnés"""
+    normalized = '\x00'.join(' '.join((part or '').lower().split()) for part in (subject, body))
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+
+
+def _remember_classification(key: bytes, result: Tuple[str, float]):
+    """Ajoute une classification au cache (évince la plus ancienne au-delà de la limite)"""
+    with _classify_lock:
+        _classify_cache[key] = result
+        if len(_classify_cache) > CLASSIFY_CACHE_SIZE:
+            _classify_cache.popitem(last=False)
+
+
+# Cache des réponses générées : un même message renvoyé pour une commande (relance à
+# l'identique) reçoit la même réponse tant que rien n'a bougé (statut, suivi)
+RESPONSE_CACHE_SIZE = 2048
+RESPONSE_CACHE_TTL = 3600  # secondes
+_response_cache: "OrderedDict[Tuple, Tuple[float, str]]" = OrderedDict()  # Clé -> (expiration, réponse)
+_response_lock = threading.Lock()
+
+
+def _response_cache_key(company_name: str, category: str, language: str,
+                        email_data: Dict, order_context: Dict) -> Optional[Tuple]:
+    """Clé (commande, message, catégorie, langue, état de livraison), ou None sans commande identifiée
+
+    L'empreinte du message en fait partie : les catégories (AUTO/MANUEL) ne disent pas ce que
+    demande le client, deux questions différentes sur une commande ont chacune leur réponse.
+    """
+    order = order_context.get('order') or {}
+    if not order.get('order_number'):
+        return None  # Sans commande, deux emails n'ont rien en commun : pas de cache
+
+    tracking = order_context.get('parcelpanel_tracking') or {}
+    return (
+        company_name, category, language,
+        order['order_number'], _classify_key(email_data.get('subject'), email_data.get('body')),
+        order.get('tracking_number'),
+        order.get('fulfillment_status'), order.get('shipment_status'), tracking.get('status')
+    )
+
+
+def _cached_response(key: Tuple) -> Optional[str]:
+    """Réponse en cache encore valide pour cette clé"""
+    with _response_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry[0]:
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return entry[1]
+
+
+def _remember_response(key: Tuple, response: str):
+    """Ajoute une réponse au cache (évince la plus ancienne au-delà de la limite)"""
+    with _response_lock:
+        _response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, response)
+        _response_cache.move_to_end(key)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
 class AIResponder:
     """Gestionnaire IA pour classification et génération de réponses avec Gemini"""
 
-    def __init__(self, api_key: str, company_name: str = "Avena Paris"):
+    def __init__(self, api_key: Union[str, Sequence[str]], company_name: str = "Avena Paris"):
         """
         Initialise le responder IA avec Gemini
 
         Args:
-            api_key: Clé API Gemini
+            api_key: Clé API Gemini, ou liste de clés utilisées à tour de rôle
+                quand l'une atteint sa limite (429)
             company_name: Nom de l'entreprise pour les réponses
         """
-        self.api_key = api_key
+        self.api_keys = (api_key,) if isinstance(api_key, str) or api_key is None else tuple(api_key)
+        self.api_key = self.api_keys[0] if self.api_keys else None  # Clé principale (jobs batch)
+        self._key_index = 0
+        self._key_lock = threading.Lock()
         self.company_name = company_name
         self.model = "gemini-2.0-flash"  # Modèle rapide et économique
         self.base_url = "https://generativelanguage.googleapis.com/v1beta/models"
 
-    def _call_gemini(self, prompt: str, max_tokens: int = 1000) -> str:
+    def _post_model(self, action: str, payload: Dict, **kwargs) -> requests.Response:
         """
-        Appelle l'API Gemini
-
-        Args:
-            prompt: Le prompt à envoyer
-            max_tokens: Nombre max de tokens en sortie
+        POST sur le modèle (generateContent, streamGenerateContent...)
 
-        Returns:
-            La réponse textuelle de Gemini
+        Si la clé courante est limitée (429, non relancé par la session), passe à la
+        clé suivante pour cet appel et les suivants ; la dernière réponse est renvoyée telle quelle.
+        Au plus AI_CONCURRENCY appels à la fois (en streaming, seule l'ouverture est comptée).
         """
-        url = f"{self.base_url}/{self.model}:generateContent?key={self.api_key}"
-
+        params = kwargs.pop('params', {})
+        for _ in range(len(self.api_keys)):
+            with self._key_lock:
+                key = self.api_keys[self._key_index]
+
+            with _gemini_slots:
+                response = _gemini_session().post(
+                    f"{self.base_url}/{self.model}:{action}", params={**params, 'key': key}, json=payload, **kwargs
+                )
+            if response.status_code != 429 or len(self.api_keys) == 1:
+                return response
+
+            response.close()
+            with self._key_lock:
+                # Un autre thread a peut-être déjà changé de clé
+                if self.api_keys[self._key_index] == key:
+                    self._key_index = (self._key_index + 1) % len(self.api_keys)
+            logger.warning(f"Clé Gemini limitée (429) - passage à la clé {self._key_index + 1}/{len(self.api_keys)}")
+
+        return response
+
+    def _gemini_payload(self, prompt: str, max_tokens: int, system_instruction: str = None,
+                        response_schema: Dict = None, stop_sequences: List[str] = None) -> Dict:
+        """Corps de requête Gemini (commun aux appels simples et en streaming)"""
         payload = {
             "contents": [{
                 "parts": [{"text": prompt}]
@@ -90,10 +523,38 @@ class AIResponder:
                 "temperature": 0.7
             }
         }
+        if system_instruction:
+            payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+        if response_schema:
+            payload["generationConfig"]["responseMimeType"] = "application/json"
+            payload["generationConfig"]["responseSchema"] = response_schema
+        if stop_sequences:
+            payload["generationConfig"]["stopSequences"] = stop_sequences
+
+        return payload
+
+    def _call_gemini(self, prompt: str, max_tokens: int = 1000, system_instruction: str = None,
+                     response_schema: Dict = None, stop_sequences: List[str] = None,
+                     max_tokens_ceiling: int = None) -> str:
+        """
+        Appelle l'API Gemini
 
-        headers = {"Content-Type": "application/json"}
+        Args:
+            prompt: Le prompt à envoyer (partie propre à chaque email)
+            max_tokens: Nombre max de tokens en sortie
+            system_instruction: Consignes fixes, envoyées à part (systemInstruction) :
+                identiques d'un appel à l'autre, elles profitent du cache de contexte Gemini
+            response_schema: Schéma OpenAPI de la réponse : Gemini renvoie alors du JSON strict
+            stop_sequences: Séquences qui arrêtent la génération
+            max_tokens_ceiling: Si la réponse est tronquée (MAX_TOKENS), relance avec un budget
+                doublé, sans dépasser ce plafond
 
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        Returns:
+            La réponse textuelle de Gemini
+        """
+        payload = self._gemini_payload(prompt, max_tokens, system_instruction, response_schema, stop_sequences)
+
+        response = self._post_model("generateContent", payload, timeout=30)
         response.raise_for_status()
 
         data = response.json()
@@ -101,50 +562,74 @@ class AIResponder:
         # Extrait le texte de la réponse
         if "candidates" in data and len(data["candidates"]) > 0:
             candidate = data["candidates"][0]
+
+            if (candidate.get("finishReason") == "MAX_TOKENS"
+                    and max_tokens_ceiling and max_tokens < max_tokens_ceiling):
+                logger.info(f"Réponse tronquée à {max_tokens} tokens - nouvel essai")
+                return self._call_gemini(
+                    prompt, min(max_tokens * 2, max_tokens_ceiling), system_instruction,
+                    response_schema, stop_sequences, max_tokens_ceiling
+                )
+
             if "content" in candidate and "parts" in candidate["content"]:
                 return candidate["content"]["parts"][0]["text"].strip()
 
         raise Exception("Réponse Gemini vide ou invalide")
 
-    def detect_language(self, text: str) -> str:
+    def _stream_gemini(self, prompt: str, max_tokens: int = 1000, system_instruction: str = None,
+                       response_schema: Dict = None, stop_sequences: List[str] = None) -> Iterator[str]:
         """
-        Détecte la langue d'un texte
+        Appelle l'API Gemini en streaming (Server-Sent Events)
+
+        Arrêter l'itération ferme la connexion : la suite de la réponse n'est pas attendue.
 
         Returns:
-            Code langue (fr, en, de, es, it, nl, pl)
+            Itérateur sur les morceaux de texte, au fur et à mesure de leur génération
         """
-        # Mots clés pour détection rapide
-        lang_keywords = {
-            'fr': ['bonjour', 'merci', 'commande', 'livraison', 'retour', 'colis', 'je', 'vous', 'nous', 'mon', 'ma', 'mes'],
-            'en': ['hello', 'thank', 'order', 'delivery', 'return', 'package', 'my', 'your', 'please', 'the', 'tracking'],
-            'de': ['hallo', 'danke', 'bestellung', 'lieferung', 'paket', 'meine', 'ihre', 'bitte', 'wann', 'zurück'],
-            'es': ['hola', 'gracias', 'pedido', 'envío', 'paquete', 'mi', 'cuando', 'dónde', 'devolver', 'entrega'],
-            'it': ['ciao', 'grazie', 'ordine', 'spedizione', 'pacco', 'mio', 'quando', 'dove', 'reso', 'consegna'],
-            'nl': ['hallo', 'bedankt', 'bestelling', 'levering', 'pakket', 'mijn', 'wanneer', 'retour', 'verzending'],
-            'pl': ['cześć', 'dzięki', 'zamówienie', 'dostawa', 'paczka', 'moje', 'kiedy', 'gdzie', 'zwrot', 'przesyłka']
-        }
-
-        text_lower = text.lower()
-        scores = {}
-
-        for lang, keywords in lang_keywords.items():
-            score = sum(1 for kw in keywords if kw in text_lower)
-            scores[lang] = score
+        payload = self._gemini_payload(prompt, max_tokens, system_instruction, response_schema, stop_sequences)
+
+        with self._post_model("streamGenerateContent", payload, params={"alt": "sse"},
+                              timeout=30, stream=True) as response:
+            response.raise_for_status()
+
+            for line in response.iter_lines():
+                # Chaque évènement SSE : "data: {...}" (réponse partielle au même format)
+                if not line.startswith(b"data:"):
+                    continue
+                data = orjson.loads(line[5:])
+                for candidate in data.get("candidates", [])[:1]:
+                    text = "".join(part.get("text", "") for part in candidate.get("content", {}).get("parts", []))
+                    if text:
+                        yield text
+
+    def detect_language(self, text: str, sender_email: str = None) -> str:
+        """
+        Détecte la langue d'un texte
 
-        # Langue avec le plus de correspondances
-        detected = max(scores, key=scores.get)
+        Args:
+            text: Texte à analyser (sujet + corps)
+            sender_email: Email de l'expéditeur (son domaine national suffit souvent)
 
-        # Si pas assez de confiance, défaut français
-        if scores[detected] < 2:
-            return 'fr'
+        Returns:
+            Code langue (fr, en, de, es, it, nl, pl)
+        """
+        # Raccourci 1 : domaine national de l'expéditeur (ex: .de -> allemand)
+        if sender_email and '.' in sender_email:
+            tld = sender_email.rsplit('.', 1)[1].strip().lower()
+            if tld in TLD_LANGUAGES:
+                return TLD_LANGUAGES[tld]
 
-        logger.info(f"Langue détectée: {detected} (score: {scores[detected]})")
-        return detected
+        # Analyse du début du texte, mémorisée : les fils d'un même client se ressemblent
+        return _detect_language_from_text(text[:LANG_DETECT_MAX_CHARS])
 
     def classify_email(self, subject: str, body: str) -> Tuple[str, float]:
         """
         Classifie un email SAV en AUTO ou MANUEL
 
+        Un email déjà classifié (même sujet et corps) est servi depuis le cache ;
+        si le même email est en cours de classification dans un autre thread,
+        on attend son résultat au lieu de relancer un appel.
+
         Args:
             subject: Sujet de l'email
             body: Corps de l'email
@@ -152,55 +637,241 @@ class AIResponder:
         Returns:
             Tuple (catégorie AUTO ou MANUEL, score de confiance)
         """
-        prompt = f"""Tu es un assistant spécialisé dans la classification des emails de service client pour Avena Paris, une boutique e-commerce de mode/beauté.
+        by_rules = _classify_by_rules(subject, body)
+        if by_rules:
+            return by_rules
+
+        key = _classify_key(subject, body)
+
+        with _classify_lock:
+            cached = _classify_cache.get(key)
+            if cached is not None:
+                _classify_cache.move_to_end(key)
+                return cached
+
+            pending = _classify_inflight.get(key)
+            if pending is None:
+                pending = _classify_inflight[key] = Future()
+                owner = True
+            else:
+                owner = False
 
-Analyse cet email et classifie-le dans UNE des 2 catégories suivantes :
+        if not owner:
+            return pending.result()
 
-AUTO = L'IA peut répondre automatiquement. Exemples :
-- Demande de suivi de commande (où est ma commande, tracking, délai)
-- Question sur les produits (taille, couleur, disponibilité)
-- Question sur la livraison (délais, transporteurs)
-- Questions simples sur les politiques (retours, échanges)
+        result = ("MANUEL", 0.0)  # Par défaut = validation humaine
+        try:
+            result = self._classify_with_api(subject, body)
 
-MANUEL = Nécessite une intervention humaine. Exemples :
-- Demande de retour ou remboursement
-- Problème avec un produit (défectueux, erreur, colis endommagé)
-- Modification de commande (adresse, annulation)
-- Réclamation, plainte
-- Cas complexes ou sensibles
+            # Seules les vraies réponses sont mises en cache (pas le défaut sur erreur)
+            _remember_classification(key, result)
 
-EMAIL À CLASSIFIER :
-Sujet : {subject}
-Corps : {body}
+        except Exception as e:
+            logger.error(f"Erreur classification: {e}")
 
-Réponds UNIQUEMENT avec un JSON : {{"category": "AUTO", "confidence": 0.95}} ou {{"category": "MANUEL", "confidence": 0.95}}
-"""
+        finally:
+            with _classify_lock:
+                _classify_inflight.pop(key, None)
+            pending.set_result(result)
 
-        try:
-            result_text = self._call_gemini(prompt, max_tokens=100)
+        return result
 
-            # Parse le JSON - nettoie si besoin
-            if result_text.startswith("```"):
-                result_text = result_text.split("```")[1]
-                if result_text.startswith("json"):
-                    result_text = result_text[4:]
-            result_text = result_text.strip().strip("```")
+    def _classify_with_api(self, subject: str, body: str) -> Tuple[str, float]:
+        """Classification par Gemini (lève une exception en cas d'échec)"""
+        prompt = CLASSIFY_USER_PROMPT.format(subject=subject, body=body)
 
-            result = json.loads(result_text)
+        # Appel simple (pas de streaming) : le JSON tient en quelques tokens, et un flux
+        # interrompu ferme la connexion au lieu de la rendre au pool keep-alive
+        result_text = self._call_gemini(
+            prompt, max_tokens=CLASSIFY_MAX_TOKENS,
+            system_instruction=CLASSIFY_SYSTEM_PROMPT, response_schema=CLASSIFICATION_SCHEMA
+        )
 
-            category = result.get("category", "MANUEL").upper()
-            confidence = float(result.get("confidence", 0.5))
+        category, confidence = _parse_classification(_parse_json_reply(result_text))
 
-            # Valide : seulement AUTO ou MANUEL
-            if category not in ['AUTO', 'MANUEL']:
-                category = 'MANUEL'  # Par défaut = validation humaine
+        logger.info(f"Email classifié: {category} (confiance: {confidence})")
+        return category, confidence
 
-            logger.info(f"Email classifié: {category} (confiance: {confidence})")
-            return category, confidence
+    def classify_many(self, emails: List[Tuple[str, str]]) -> List[Tuple[str, float]]:
+        """
+        Classifie plusieurs emails
+
+        Les emails évidents (CLASSIFY_RULES) ou déjà en cache sont servis directement ; les autres (dédoublonnés)
+        partent par lots de CLASSIFY_BATCH_SIZE dans une seule requête chacun, avec
+        jusqu'à AI_CONCURRENCY lots en vol en même temps.
+
+        Args:
+            emails: Liste de tuples (sujet, corps)
+
+        Returns:
+            Liste de tuples (catégorie, confiance) dans le même ordre
+        """
+        results: List[Optional[Tuple[str, float]]] = [None] * len(emails)
+        pending: Dict[bytes, List[int]] = {}  # Empreinte -> positions des emails identiques
+
+        with _classify_lock:
+            for i, (subject, body) in enumerate(emails):
+                results[i] = _classify_by_rules(subject, body)
+                if results[i]:
+                    continue
+                key = _classify_key(subject, body)
+                cached = _classify_cache.get(key)
+                if cached is not None:
+                    _classify_cache.move_to_end(key)
+                    results[i] = cached
+                else:
+                    pending.setdefault(key, []).append(i)
+
+        if not pending:
+            return results
+
+        positions = list(pending.values())
+        batches = [positions[k:k + CLASSIFY_BATCH_SIZE] for k in range(0, len(positions), CLASSIFY_BATCH_SIZE)]
+
+        def classify_group(batch):
+            return self.classify_batch([emails[indexes[0]] for indexes in batch])
+
+        with ThreadPoolExecutor(max_workers=min(AI_CONCURRENCY, len(batches))) as executor:
+            for batch, batch_results in zip(batches, executor.map(classify_group, batches)):
+                for indexes, result in zip(batch, batch_results):
+                    for i in indexes:
+                        results[i] = result
+
+        return results
+
+    def classify_batch(self, emails: List[Tuple[str, str]]) -> List[Tuple[str, float]]:
+        """
+        Classifie un petit lot d'emails en une seule requête Gemini
+
+        Si la réponse groupée est inexploitable, chaque email est reclassifié seul.
+
+        Args:
+            emails: Liste de tuples (sujet, corps), CLASSIFY_BATCH_SIZE au plus de préférence
+
+        Returns:
+            Liste de tuples (catégorie, confiance) dans le même ordre
+        """
+        if len(emails) <= 1:
+            return [self.classify_email(subject, body) for subject, body in emails]
 
+        try:
+            results = self._classify_batch_with_api(emails)
         except Exception as e:
-            logger.error(f"Erreur classification: {e}")
-            return "MANUEL", 0.0  # Par défaut = validation humaine
+            logger.warning(f"Classification groupée impossible ({e}) - classification email par email")
+            return [self.classify_email(subject, body) for subject, body in emails]
+
+        for (subject, body), result in zip(emails, results):
+            _remember_classification(_classify_key(subject, body), result)
+
+        logger.info(f"{len(emails)} emails classifiés en une requête")
+        return results
+
+    def _classify_batch_with_api(self, emails: List[Tuple[str, str]]) -> List[Tuple[str, float]]:
+        """Classification groupée par Gemini (lève une exception si un email manque dans la réponse)"""
+        blocks = [f"[{i}] Sujet : {subject}\nCorps : {body}" for i, (subject, body) in enumerate(emails)]
+        prompt = f"{len(emails)} emails, un objet par email (i = numéro) :\n\n" + "\n---\n".join(blocks)
+
+        result_text = self._call_gemini(
+            prompt, max_tokens=CLASSIFY_MAX_TOKENS * len(emails),
+            system_instruction=CLASSIFY_SYSTEM_PROMPT, response_schema=BATCH_CLASSIFICATION_SCHEMA
+        )
+
+        by_index = {int(item["i"]): _parse_classification(item) for item in _parse_json_reply(result_text)}
+        return [by_index[i] for i in range(len(emails))]
+
+    def submit_classification_batch(self, emails: Dict[str, Tuple[str, str]]) -> Tuple[Dict[str, Tuple[str, float]], Optional[str]]:
+        """
+        Envoie des classifications au Batch API Gemini (traitement différé, moitié prix)
+
+        Pour les files non interactives (rattrapage, reclassification) : les emails évidents
+        (CLASSIFY_RULES) ou déjà en cache sont résolus tout de suite, les autres partent
+        dans un job dont on récupère le résultat plus tard avec poll_classification_batch.
+
+        Args:
+            emails: Dict identifiant -> (sujet, corps)
+
+        Returns:
+            Tuple (résultats immédiats par identifiant, nom du job batch ou None si rien à envoyer)
+        """
+        known: Dict[str, Tuple[str, float]] = {}
+        batch_requests: List[Dict] = []
+
+        for email_key, (subject, body) in emails.items():
+            result = _classify_by_rules(subject, body)
+            if result is None:
+                with _classify_lock:
+                    result = _classify_cache.get(_classify_key(subject, body))
+            if result is not None:
+                known[email_key] = result
+                continue
+
+            prompt = CLASSIFY_USER_PROMPT.format(subject=subject, body=body)
+            batch_requests.append({
+                "request": self._gemini_payload(
+                    prompt, CLASSIFY_MAX_TOKENS, CLASSIFY_SYSTEM_PROMPT, CLASSIFICATION_SCHEMA
+                ),
+                "metadata": {"key": email_key}
+            })
+
+        if not batch_requests:
+            return known, None
+
+        url = f"{self.base_url}/{self.model}:batchGenerateContent?key={self.api_key}"
+        payload = {
+            "batch": {
+                "display_name": "avena-sav-classification",
+                "input_config": {"requests": {"requests": batch_requests}}
+            }
+        }
+        # Hors session partagée : pas de relance automatique, un timeout après acceptation
+        # du job en créerait un second (facturé) dont on ne connaîtrait pas le nom
+        response = requests.post(url, json=payload, timeout=60)
+        response.raise_for_status()
+
+        batch_name = response.json()["name"]
+        logger.info(f"Batch de classification envoyé: {batch_name} ({len(batch_requests)} emails)")
+        return known, batch_name
+
+    def poll_classification_batch(self, batch_name: str) -> Optional[Dict[str, Tuple[str, float]]]:
+        """
+        Récupère le résultat d'un batch de classification
+
+        Returns:
+            Dict identifiant -> (catégorie, confiance), ou None si le job n'est pas terminé.
+            Un email dont la réponse est inexploitable est mis en MANUEL (validation humaine).
+
+        Raises:
+            BatchJobFailed: job en échec, annulé, expiré ou introuvable (état définitif)
+        """
+        url = f"https://generativelanguage.googleapis.com/v1beta/{batch_name}?key={self.api_key}"
+        response = _gemini_session().get(url, timeout=30)
+        if response.status_code == 404:
+            raise BatchJobFailed(f"Batch {batch_name} introuvable")
+        response.raise_for_status()  # Erreur passagère : on réessaiera au prochain passage
+        data = response.json()
+
+        state = data.get("metadata", {}).get("state", "")
+        if state in ("BATCH_STATE_PENDING", "BATCH_STATE_RUNNING"):
+            return None
+        if state != "BATCH_STATE_SUCCEEDED":
+            raise BatchJobFailed(f"Batch {batch_name} terminé sans résultat ({state})")
+
+        inlined = data.get("response", {}).get("inlinedResponses", {})
+        if isinstance(inlined, dict):
+            inlined = inlined.get("inlinedResponses", [])
+
+        results = {}
+        for item in inlined:
+            email_key = item.get("metadata", {}).get("key")
+            try:
+                text = item["response"]["candidates"][0]["content"]["parts"][0]["text"]
+                results[email_key] = _parse_classification(_parse_json_reply(text))
+            except Exception as e:
+                logger.error(f"Erreur classification (batch) {email_key}: {e}")
+                results[email_key] = ("MANUEL", 0.0)  # Par défaut = validation humaine
+
+        logger.info(f"Batch {batch_name} terminé: {len(results)} emails classifiés")
+        return results
 
     def is_auto_eligible(self, category: str, confidence: float, order_context: Dict) -> Tuple[bool, str]:
         """
@@ -232,165 +903,230 @@ Réponds UNIQUEMENT avec un JSON : {{"category": "AUTO", "confidence": 0.95}} ou
         return True, f"Auto-réponse possible pour {category}"
 
     def generate_response(self, email_data: Dict, order_context: Dict,
-                          category: str, language: str = None) -> str:
+                          category: str, language: str = None, use_cache: bool = True) -> str:
         """
         Génère une réponse personnalisée à un email SAV
 
+        Un même message renvoyé sur une même commande (même catégorie, langue et état de
+        livraison) reprend la réponse générée dans l'heure au lieu de rappeler Gemini.
+
         Args:
             email_data: Données de l'email (subject, body, sender_name, etc.)
             order_context: Contexte Shopify + Parcelpanel (order, customer, parcelpanel_tracking, etc.)
             category: Catégorie de la demande
             language: Code langue pour la réponse (fr, en, de, es, it, nl, pl)
+            use_cache: False pour forcer une nouvelle réponse (régénération demandée)
 
         Returns:
             Réponse générée
         """
-
-        # Détecte la langue si non fournie
+        # Détecte la langue si non fournie (elle fait partie de la clé du cache)
         if not language:
-            text = f"{email_data.get('subject', '')} {email_data.get('body', '')}"
-            language = self.detect_language(text)
+            language = self.detect_language(f"{email_data.get('subject', '')} {email_data.get('body', '')}")
 
-        # Noms des langues pour le prompt
-        lang_names = {
-            'fr': 'français',
-            'en': 'anglais',
-            'de': 'allemand',
-            'es': 'espagnol',
-            'it': 'italien',
-            'nl': 'néerlandais',
-            'pl': 'polonais'
-        }
-        lang_name = lang_names.get(language, 'français')
+        cache_key = _response_cache_key(self.company_name, category, language, email_data, order_context)
+        if use_cache and cache_key:
+            cached = _cached_response(cache_key)
+            if cached:
+                logger.info(f"Réponse reprise du cache (commande #{cache_key[3]})")
+                return cached
 
-        # Construit le contexte pour Gemini
-        context_parts = []
+        prompt, customer_name = self._generation_prompt(email_data, order_context, language)
 
-        # Infos client
-        customer_name = email_data.get('sender_name') or "Client"
-        if order_context.get('customer'):
-            customer = order_context['customer']
-            customer_name = customer.get('full_name') or customer.get('first_name') or customer_name
-            context_parts.append(f"Client : {customer_name}")
-            if customer.get('orders_count'):
-                context_parts.append(f"Historique : {customer['orders_count']} commande(s)")
+        try:
+            generated_response = self._call_gemini(
+                prompt, max_tokens=GENERATE_MAX_TOKENS,
+                system_instruction=_generate_system_prompt(self.company_name, category),
+                stop_sequences=GENERATE_STOP_SEQUENCES,
+                max_tokens_ceiling=GENERATE_MAX_TOKENS_CEILING
+            )
+            logger.info(f"Réponse générée ({len(generated_response)} caractères)")
 
-        # Infos commande Shopify
-        if order_context.get('order'):
-            order = order_context['order']
-            context_parts.append(f"\nCOMMANDE #{order.get('order_number')} :")
-            context_parts.append(f"- Statut commande : {order.get('fulfillment_status')}")
-            context_parts.append(f"- Paiement : {order.get('financial_status')}")
+            # Seules les vraies réponses sont mises en cache (pas la réponse de secours)
+            if cache_key:
+                _remember_response(cache_key, generated_response)
+            return generated_response
 
-            # TRACKING depuis Shopify
-            if order.get('tracking_number'):
-                context_parts.append(f"\n📦 INFORMATIONS DE SUIVI :")
-                context_parts.append(f"- Numéro de suivi : {order['tracking_number']}")
-
-                if order.get('tracking_company'):
-                    context_parts.append(f"- Transporteur : {order['tracking_company']}")
-
-                if order.get('shipment_status'):
-                    # Traduction des statuts Shopify
-                    status_map = {
-                        'confirmed': 'Pris en charge',
-                        'in_transit': 'En cours de livraison',
-                        'out_for_delivery': 'En livraison aujourd\'hui',
-                        'delivered': 'Livré',
-                        'attempted_delivery': 'Tentative de livraison',
-                        'ready_for_pickup': 'À retirer en point relais',
-                        'failure': 'Problème de livraison'
-                    }
-                    status_text = status_map.get(order['shipment_status'], order['shipment_status'])
-                    context_parts.append(f"- Statut livraison : {status_text}")
-
-                if order.get('shipped_at'):
-                    context_parts.append(f"- Date d'expédition : {order['shipped_at'][:10]}")
-
-                if order.get('tracking_url'):
-                    context_parts.append(f"- Lien de suivi : {order['tracking_url']}")
-
-            if order.get('line_items'):
-                items = [f"{i['quantity']}x {i['name']}" for i in order['line_items'][:3]]
-                context_parts.append(f"- Produits : {', '.join(items)}")
+        except Exception as e:
+            logger.error(f"Erreur génération: {e}")
+            return self._get_fallback_response(customer_name, category)
 
-        context_str = "\n".join(context_parts) if context_parts else "Aucune information de commande trouvée"
+    def classify_and_generate(self, email_data: Dict, order_context: Dict, language: str = None) -> Dict:
+        """
+        Classifie un email ET rédige sa réponse en un seul appel Gemini
 
-        # Instructions selon la catégorie
-        category_instructions = {
-            "SUIVI": """
-- UTILISE LES INFORMATIONS DE TRACKING EN TEMPS RÉEL si disponibles (statut actuel, localisation, date estimée)
-- Si un tracking est disponible, donne le statut précis, le transporteur et le lien de suivi
-- Si pas de tracking, indique que la commande est en préparation et donne un délai estimé (2-5 jours ouvrés)
-- Reste rassurant et professionnel""",
+        Remplace classify_email + generate_response quand les deux sont nécessaires.
+        Un email évident (CLASSIFY_RULES) ou déjà en cache n'a besoin que de la génération ;
+        si la réponse combinée est inexploitable, on repasse par les deux appels séparés.
 
-            "RETOUR": """
-- Indique la procédure de retour (14 jours, produit non porté, étiquette retour)
-- Propose un échange ou remboursement
-- Demande des précisions si nécessaire (raison, taille souhaitée pour échange)""",
-
-            "PROBLEME": """
-- Présente des excuses pour le désagrément
-- Propose une solution (renvoi du produit, remboursement, geste commercial)
-- Demande des photos si pertinent
-- Montre de l'empathie""",
+        Args:
+            email_data: Données de l'email (subject, body, sender_name, etc.)
+            order_context: Contexte Shopify + Parcelpanel
+            language: Code langue pour la réponse
 
-            "QUESTION": """
-- Réponds de manière informative et chaleureuse
-- Propose de l'aide supplémentaire
-- Invite à passer commande si pertinent""",
+        Returns:
+            Dict {category, confidence, response}
+        """
+        subject = email_data.get('subject') or ''
+        body = email_data.get('body') or ''
+        key = _classify_key(subject, body)
 
-            "MODIFICATION": """
-- Vérifie si la modification est encore possible (selon le statut)
-- Si expédié, explique qu'il n'est plus possible de modifier
-- Propose des alternatives si besoin""",
+        with _classify_lock:
+            known = _classify_cache.get(key)
+        known = _classify_by_rules(subject, body) or known
 
-            "AUTRE": """
-- Réponds de manière générique mais professionnelle
-- Redirige vers le bon service si nécessaire
-- Reste aimable et serviable"""
+        if known:
+            category, confidence = known
+        else:
+            prompt, _ = self._generation_prompt(email_data, order_context, language)
+            try:
+                result = _parse_json_reply(self._call_gemini(
+                    prompt, max_tokens=GENERATE_MAX_TOKENS + CLASSIFY_MAX_TOKENS,
+                    system_instruction=_classify_and_generate_system_prompt(self.company_name),
+                    response_schema=CLASSIFY_AND_GENERATE_SCHEMA,
+                    max_tokens_ceiling=GENERATE_MAX_TOKENS_CEILING + CLASSIFY_MAX_TOKENS
+                ))
+                category, confidence = _parse_classification(result)
+                _remember_classification(key, (category, confidence))
+                logger.info(f"Email classifié et réponse générée en un appel: {category} (confiance: {confidence})")
+                return {'category': category, 'confidence': confidence, 'response': result['response'].strip()}
+
+            except Exception as e:
+                logger.warning(f"Appel combiné impossible ({e}) - classification et génération séparées")
+                category, confidence = self.classify_email(subject, body)
+
+        return {
+            'category': category,
+            'confidence': confidence,
+            'response': self.generate_response(email_data, order_context, category, language)
         }
 
-        instructions = category_instructions.get(category, category_instructions["AUTRE"])
+    def generate_response_stream(self, email_data: Dict, order_context: Dict,
+                                 category: str, language: str = None) -> Iterator[str]:
+        """
+        Génère une réponse comme generate_response, mais la renvoie morceau par morceau
 
-        prompt = f"""Tu es un assistant service client pour {self.company_name}, une boutique e-commerce de mode parisienne.
-Tu dois rédiger une réponse professionnelle, chaleureuse et efficace à cet email client.
+        Le premier texte arrive dès que Gemini commence à écrire au lieu d'attendre
+        la réponse complète. Si l'appel échoue avant tout texte, la réponse de secours
+        est renvoyée d'un bloc. Toujours une nouvelle réponse (régénération), mise en
+        cache comme celles de generate_response une fois complète.
 
-IMPORTANT - LANGUE : L'email du client est en {lang_name}. Tu DOIS répondre ENTIÈREMENT en {lang_name}.
+        Returns:
+            Itérateur sur les morceaux de la réponse
+        """
+        if not language:
+            language = self.detect_language(f"{email_data.get('subject', '')} {email_data.get('body', '')}")
+        prompt, customer_name = self._generation_prompt(email_data, order_context, language)
 
-CONTEXTE CLIENT/COMMANDE :
-{context_str}
+        parts = []
+        try:
+            for text in self._stream_gemini(
+                prompt, max_tokens=GENERATE_MAX_TOKENS_CEILING,  # Pas de relance possible en cours de flux
+                system_instruction=_generate_system_prompt(self.company_name, category),
+                stop_sequences=GENERATE_STOP_SEQUENCES
+            ):
+                parts.append(text)
+                yield text
+
+            cache_key = _response_cache_key(self.company_name, category, language, email_data, order_context)
+            if cache_key and parts:
+                _remember_response(cache_key, ''.join(parts))
 
-EMAIL DU CLIENT :
-Sujet : {email_data.get('subject', '')}
-Message : {email_data.get('body', '')}
+        except Exception as e:
+            logger.error(f"Erreur génération (streaming): {e}")
+            if not parts:
+                yield self._get_fallback_response(customer_name, category)
 
-TYPE DE DEMANDE : {category}
+    def _generation_prompt(self, email_data: Dict, order_context: Dict, language: str = None) -> Tuple[str, str]:
+        """
+        Construit la partie variable du prompt de génération (langue, contexte, email)
 
-INSTRUCTIONS SPÉCIFIQUES :
-{instructions}
+        Returns:
+            Tuple (prompt, nom du client pour la réponse de secours)
+        """
+        # Détecte la langue si non fournie
+        if not language:
+            text = f"{email_data.get('subject', '')} {email_data.get('body', '')}"
+            language = self.detect_language(text)
 
-CONSIGNES DE RÉDACTION :
-- ÉCRIS TOUTE LA RÉPONSE EN {lang_name.upper()}
-- Commence par une salutation appropriée dans la langue du client
-- Sois professionnel mais chaleureux, pas robotique
-- Va droit au but, évite les phrases inutiles
-- Utilise le vouvoiement (ou équivalent formel dans la langue)
-- Si tu as des informations de tracking, utilise-les pour donner une réponse précise et rassurante
-- Termine par une formule de politesse et "L'équipe {self.company_name}"
-- Ne mets PAS de crochets ou de placeholders comme [XX] dans la réponse
-- La réponse doit être prête à envoyer telle quelle
+        lang_name = LANG_NAMES.get(language, 'français')
 
-Rédige UNIQUEMENT la réponse en {lang_name}, sans commentaire ni explication."""
+        # Construit le contexte pour Gemini (chaque bloc du contexte n'est lu qu'une fois)
+        customer = order_context.get('customer')
+        order = order_context.get('order')
+        tracking = order_context.get('parcelpanel_tracking')
 
-        try:
-            generated_response = self._call_gemini(prompt, max_tokens=1000)
-            logger.info(f"Réponse générée ({len(generated_response)} caractères)")
-            return generated_response
+        context_parts = []
+        add = context_parts.append
 
-        except Exception as e:
-            logger.error(f"Erreur génération: {e}")
-            return self._get_fallback_response(customer_name, category)
+        # Infos client
+        customer_name = email_data.get('sender_name') or "Client"
+        if customer:
+            customer_name = customer.get('full_name') or customer.get('first_name') or customer_name
+            add(f"Client : {customer_name}")
+            orders_count = customer.get('orders_count')
+            if orders_count:
+                add(f"Historique : {orders_count} commande(s)")
+
+        # Infos commande Shopify
+        if order:
+            add(f"\nCOMMANDE #{order.get('order_number')} :")
+            add(f"- Statut commande : {order.get('fulfillment_status')}")
+            add(f"- Paiement : {order.get('financial_status')}")
+
+            # TRACKING depuis Shopify
+            tracking_number = order.get('tracking_number')
+            if tracking_number:
+                add(f"\n📦 INFORMATIONS DE SUIVI :")
+                add(f"- Numéro de suivi : {tracking_number}")
+
+                tracking_company = order.get('tracking_company')
+                if tracking_company:
+                    add(f"- Transporteur : {tracking_company}")
+
+                shipment_status = order.get('shipment_status')
+                if shipment_status:
+                    add(f"- Statut livraison : {SHIPMENT_STATUS_LABELS.get(shipment_status, shipment_status)}")
+
+                shipped_at = order.get('shipped_at')
+                if shipped_at:
+                    add(f"- Date d'expédition : {shipped_at[:10]}")
+
+                tracking_url = order.get('tracking_url')
+                if tracking_url:
+                    add(f"- Lien de suivi : {tracking_url}")
+
+            line_items = order.get('line_items')
+            if line_items:
+                items = [f"{i['quantity']}x {i['name']}" for i in line_items[:3]]
+                add(f"- Produits : {', '.join(items)}")
+
+        # Suivi en temps réel Parcelpanel (ajouté par l'appelant quand il est trouvé)
+        if tracking is not None:
+            add("\n🚚 SUIVI EN TEMPS RÉEL :")
+            add(f"- Statut actuel : {tracking.get('status_text')}")
+            if tracking.get('carrier'):
+                add(f"- Transporteur : {tracking['carrier']}")
+            if tracking.get('estimated_delivery'):
+                add(f"- Livraison estimée : {tracking['estimated_delivery']}")
+            events = tracking.get('events')
+            if events:
+                last_event = events[0]
+                location = f" - {last_event['location']}" if last_event.get('location') else ""
+                add(f"- Dernier événement : {last_event.get('description')} ({last_event.get('date')}){location}")
+            if tracking.get('tracking_url'):
+                add(f"- Lien de suivi : {tracking['tracking_url']}")
+
+        context_str = "\n".join(context_parts) if context_parts else "Aucune information de commande trouvée"
+
+        prompt = GENERATE_USER_PROMPT.format(
+            lang_name=lang_name,
+            context_str=context_str,
+            subject=email_data.get('subject', ''),
+            body=email_data.get('body', '')
+        )
+
+        return prompt, customer_name
 
     def _get_fallback_response(self, customer_name: str, category: str) -> str:
         """Réponse de secours si l'IA échoue"""
@@ -444,8 +1180,17 @@ L'équipe {self.company_name}"""
         return False, f"Catégorie {category} requiert validation manuelle"
 
 
+# Une connexion réussie est mémorisée : les vérifications répétées ne refont pas d'appel payant
+AI_CONNECTION_CACHE_TTL = 60  # secondes
+_connection_cache: Dict[str, Tuple[float, Dict]] = {}  # Clé API -> (expiration, résultat)
+
+
 def test_ai_connection(api_key: str) -> Dict:
-    """Teste la connexion à l'API Gemini"""
+    """Teste la connexion à l'API Gemini (résultat positif mémorisé AI_CONNECTION_CACHE_TTL secondes)"""
+    cached = _connection_cache.get(api_key)
+    if cached and time.monotonic() < cached[0]:
+        return dict(cached[1])
+
     result = {
         'success': False,
         'message': ''
@@ -463,7 +1208,7 @@ def test_ai_connection(api_key: str) -> Dict:
             }
         }
 
-        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"}, timeout=10)
+        response = _gemini_session().post(url, json=payload, timeout=10)
         response.raise_for_status()
 
         data = response.json()
@@ -481,4 +1226,8 @@ def test_ai_connection(api_key: str) -> Dict:
     except Exception as e:
         result['message'] = f"Erreur: {str(e)}"
 
+    # Les échecs ne sont pas mémorisés : un nouveau test après correction doit refaire l'appel
+    if result['success']:
+        _connection_cache[api_key] = (time.monotonic() + AI_CONNECTION_CACHE_TTL, dict(result))
+
     return result
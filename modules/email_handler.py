@@ -9,11 +9,15 @@ from email.mime.multipart import MIMEMultipart
 from email.header import decode_header
 from datetime import datetime
 import re
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Regex d'adresses compilées une fois (appelées pour chaque email parsé)
+SENDER_RE = re.compile(r'^(.+?)\s*<(.+?)>$')
+EMAIL_ADDRESS_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+')
+
 
 class ZohoEmailHandler:
     """Gestionnaire d'emails Zoho via IMAP/SMTP"""
@@ -27,6 +31,8 @@ class ZohoEmailHandler:
         self.smtp_server = smtp_server
         self.imap_connection = None
         self.smtp_connection = None
+        # {dossier: (uid_validity, plus grand UID vu)} rempli par fetch_emails_from_folders
+        self.uid_marks = {}
 
     def connect_imap(self) -> bool:
         """Connexion au serveur IMAP Zoho"""
@@ -48,6 +54,21 @@ class ZohoEmailHandler:
                 pass
             self.imap_connection = None
 
+    def ensure_imap_connection(self) -> bool:
+        """Vérifie la connexion existante (NOOP) et ne se reconnecte que si elle est perdue
+
+        Un NOOP coûte un aller-retour, une reconnexion une poignée de main TLS + LOGIN.
+        """
+        if self.imap_connection:
+            try:
+                status, _ = self.imap_connection.noop()
+                if status == 'OK':
+                    return True
+            except (imaplib.IMAP4.error, OSError) as e:
+                logger.warning(f"Connexion IMAP perdue ({e}), reconnexion...")
+            self.disconnect_imap()
+        return self.connect_imap()
+
     def _decode_header_value(self, value: str) -> str:
         """Décode une valeur d'en-tête email"""
         if not value:
@@ -157,12 +178,29 @@ class ZohoEmailHandler:
 
         return body.strip()
 
+    def _extract_message_body(self, msg) -> str:
+        """Extrait le corps d'un EmailMessage (policy.default) via get_body()
+
+        Ne décode que la partie retenue (texte brut, sinon HTML) ;
+        repli sur _extract_email_body si la partie est illisible.
+        """
+        try:
+            part = msg.get_body(preferencelist=('plain', 'html'))
+            if part is None:
+                return ""
+            content = part.get_content()
+            if part.get_content_type() == "text/html":
+                content = self._clean_html_to_text(content)
+            return content.strip()
+        except Exception:
+            return self._extract_email_body(msg)
+
     def _parse_sender(self, from_header: str) -> Dict[str, str]:
         """Parse l'en-tête From pour extraire nom et email"""
         from_decoded = self._decode_header_value(from_header)
 
         # Pattern: "Nom <email@domain.com>" ou juste "email@domain.com"
-        match = re.match(r'^(.+?)\s*<(.+?)>$', from_decoded)
+        match = SENDER_RE.match(from_decoded)
         if match:
             return {
                 'name': match.group(1).strip().strip('"'),
@@ -170,7 +208,7 @@ class ZohoEmailHandler:
             }
 
         # Juste l'email
-        email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', from_decoded)
+        email_match = EMAIL_ADDRESS_RE.search(from_decoded)
         if email_match:
             return {
                 'name': '',
@@ -205,13 +243,86 @@ class ZohoEmailHandler:
 
         return folders
 
-    def fetch_emails_from_folders(self, folders: List[str] = None, limit_per_folder: int = 500) -> List[Dict]:
+    def select_folder(self, folder: str, readonly: bool = False) -> bool:
+        """Sélectionne un dossier sur la connexion existante
+
+        Ne se reconnecte que si la connexion a été perdue (socket fermée),
+        un dossier inexistant renvoie simplement False.
+        """
+        if not self.imap_connection:
+            if not self.connect_imap():
+                return False
+
+        mailbox = f'"{folder}"' if ' ' in folder and not folder.startswith('"') else folder
+
+        for attempt in range(2):
+            try:
+                status, _ = self.imap_connection.select(mailbox, readonly=readonly)
+                return status == 'OK'
+            except (imaplib.IMAP4.abort, OSError) as e:
+                logger.warning(f"Connexion IMAP perdue ({e}), reconnexion...")
+                self.disconnect_imap()
+                if attempt or not self.connect_imap():
+                    return False
+            except imaplib.IMAP4.error:
+                return False
+
+        return False
+
+    def fetch_parts(self, email_ids: List[bytes], items: str, uid: bool = False) -> Dict[bytes, Dict[str, bytes]]:
+        """Récupère des parties de plusieurs messages en UNE seule commande FETCH
+
+        Args:
+            email_ids: Numéros de séquence IMAP, ou UIDs si uid=True (dossier déjà sélectionné)
+            items: Éléments FETCH, ex: '(BODY.PEEK[HEADER.FIELDS (SUBJECT)] BODY.PEEK[TEXT])'
+            uid: Utilise UID FETCH (identifiants stables) au lieu des numéros de séquence
+
+        Returns:
+            {id: {'HEADER': bytes, 'TEXT': bytes, ...}} selon les parties demandées
+        """
+        parts = {}
+        if not email_ids:
+            return parts
+
+        id_set = b','.join(email_ids)
+        if uid:
+            status, data = self.imap_connection.uid('FETCH', id_set, items)
+        else:
+            status, data = self.imap_connection.fetch(id_set, items)
+        if status != 'OK':
+            return parts
+
+        current = None
+        for item in data:
+            # Chaque partie est un tuple (b'12 (UID 345 BODY[HEADER.FIELDS (...)] {342}', contenu) ;
+            # les parties suivantes du même message commencent par b' BODY[TEXT] {n}'
+            # et la réponse se termine par b')' (ou b' UID 345)' selon le serveur)
+            prefix, content = item if isinstance(item, tuple) else (item, None)
+            seq_match = re.match(rb'(\d+) \(', prefix)
+            if seq_match:
+                current = {}
+                if not uid:
+                    parts[seq_match.group(1)] = current
+            uid_match = re.search(rb'UID (\d+)', prefix) if uid else None
+            if uid_match and current is not None:
+                # Indexé uniquement par UID : un numéro de séquence peut égaler l'UID d'un autre message
+                parts[uid_match.group(1)] = current
+            section = re.search(rb'BODY\[([A-Z]*)', prefix)
+            if current is not None and section and content is not None:
+                current[(section.group(1) or b'BODY').decode()] = content
+
+        return parts
+
+    def fetch_emails_from_folders(self, folders: List[str] = None, limit_per_folder: int = 500,
+                                  since_uids: Dict[str, Tuple[Optional[int], int]] = None) -> List[Dict]:
         """Récupère les emails de plusieurs dossiers
 
         Args:
             folders: Liste des dossiers à parcourir
             limit_per_folder: Limite par dossier (défaut 500 pour éviter timeout)
+            since_uids: {dossier: (uid_validity, dernier UID importé)} pour ne récupérer que les nouveaux
         """
+        since_uids = since_uids or {}
         if folders is None:
             # Dossiers par défaut - inclut variantes FR/EN
             folders = ["INBOX", "Archive", "Archiver", "Newsletter", "Notification"]
@@ -227,15 +338,21 @@ class ZohoEmailHandler:
                 continue
 
             try:
-                # Reconnexion avant chaque dossier pour éviter timeout
-                self.disconnect_imap()
-                if not self.connect_imap():
+                # Reconnexion seulement si la connexion a expiré entre deux dossiers
+                if not self.ensure_imap_connection():
                     logger.error(f"Impossible de se reconnecter pour {folder}")
                     continue
 
-                folder_emails = self.fetch_unread_emails(folder=folder, limit=limit_per_folder)
+                uid_validity, since_uid = since_uids.get(folder, (None, None))
+                folder_emails = self.fetch_unread_emails(folder=folder, limit=limit_per_folder,
+                                                         since_uid=since_uid, uid_validity=uid_validity)
                 if folder_emails:
                     processed_folders.add(folder_lower)
+                    # Marque haute du dossier (avant déduplication entre dossiers)
+                    self.uid_marks[folder] = (
+                        folder_emails[0]['uid_validity'],
+                        max(int(e['imap_id']) for e in folder_emails)
+                    )
                     for email_data in folder_emails:
                         # Évite les doublons basés sur message_id
                         if email_data['message_id'] not in seen_message_ids:
@@ -253,8 +370,28 @@ class ZohoEmailHandler:
         logger.info(f"Total récupéré de tous les dossiers: {len(all_emails)} emails")
         return all_emails
 
-    def fetch_unread_emails(self, folder: str = "INBOX", limit: int = None) -> List[Dict]:
-        """Récupère tous les emails (lus et non lus) - sans limite par défaut"""
+    def _get_uid_validity(self) -> Optional[int]:
+        """UIDVALIDITY du dossier sélectionné (réponse non sollicitée du SELECT)"""
+        try:
+            _, data = self.imap_connection.response('UIDVALIDITY')
+            return int(data[0]) if data and data[0] else None
+        except (ValueError, TypeError):
+            return None
+
+    def fetch_unread_emails(self, folder: str = "INBOX", limit: int = None,
+                            since_uid: int = None, uid_validity: int = None,
+                            since: datetime = None, fetch_spec: str = '(RFC822)',
+                            readonly: bool = False) -> List[Dict]:
+        """Récupère tous les emails (lus et non lus) - sans limite par défaut
+
+        Les emails sont identifiés par leur UID IMAP (stable), renvoyé dans 'imap_id'.
+        Avec since_uid, seuls les emails d'UID supérieur sont récupérés (ignoré si
+        l'UIDVALIDITY du dossier ne correspond plus à uid_validity).
+        Avec since, le filtre par date est fait côté serveur (SEARCH SINCE).
+        fetch_spec permet de ne télécharger qu'une partie des messages, par exemple
+        '(BODY.PEEK[HEADER] BODY.PEEK[TEXT]<0.2048>)' pour un simple aperçu.
+        Avec readonly, le dossier est ouvert en lecture seule (EXAMINE) : aucun email n'est marqué lu.
+        """
         emails = []
 
         if not self.imap_connection:
@@ -268,7 +405,7 @@ class ZohoEmailHandler:
 
             for variant in folder_variants:
                 try:
-                    status, _ = self.imap_connection.select(variant)
+                    status, _ = self.imap_connection.select(variant, readonly=readonly)
                     if status == 'OK':
                         selected = True
                         logger.info(f"Dossier sélectionné: {variant}")
@@ -280,18 +417,31 @@ class ZohoEmailHandler:
                 logger.warning(f"Impossible de sélectionner le dossier {folder}")
                 return emails
 
+            current_validity = self._get_uid_validity()
+            if since_uid is not None and uid_validity is not None and uid_validity != current_validity:
+                logger.info(f"UIDVALIDITY de {folder} modifiée, récupération complète")
+                since_uid = None
+
             # Récupère d'abord la liste des emails non lus pour savoir lesquels sont lus/non lus
-            status, unseen_messages = self.imap_connection.search(None, 'UNSEEN')
+            status, unseen_messages = self.imap_connection.uid('SEARCH', None, 'UNSEEN')
             unseen_ids = set(unseen_messages[0].split()) if status == 'OK' and unseen_messages[0] else set()
 
-            # Recherche de TOUS les emails (pas seulement non lus)
-            status, messages = self.imap_connection.search(None, 'ALL')
+            # Recherche de TOUS les emails (pas seulement non lus), ou seulement les nouveaux
+            criteria = []
+            if since_uid is not None:
+                criteria.append(f'UID {since_uid + 1}:*')
+            if since is not None:
+                criteria.append(f'SINCE {since.strftime("%d-%b-%Y")}')
+            status, messages = self.imap_connection.uid('SEARCH', None, ' '.join(criteria) or 'ALL')
 
             if status != 'OK':
                 logger.error("Erreur lors de la recherche des emails")
                 return emails
 
-            email_ids = messages[0].split()
+            email_ids = messages[0].split() if messages[0] else []
+            if since_uid is not None:
+                # "n:*" renvoie toujours au moins le dernier message, même déjà importé
+                email_ids = [uid for uid in email_ids if int(uid) > since_uid]
             logger.info(f"Nombre total d'emails trouvés dans {folder}: {len(email_ids)}")
 
             # Prend les emails les plus récents (applique une limite seulement si spécifiée)
@@ -302,13 +452,14 @@ class ZohoEmailHandler:
 
             for email_id in email_ids:
                 try:
-                    # Récupère l'email complet
-                    status, msg_data = self.imap_connection.fetch(email_id, '(RFC822)')
+                    # Récupère l'email (complet par défaut, ou seulement les parties demandées)
+                    status, msg_data = self.imap_connection.uid('FETCH', email_id, fetch_spec)
 
-                    if status != 'OK':
+                    if status != 'OK' or not msg_data or not isinstance(msg_data[0], tuple):
                         continue
 
-                    raw_email = msg_data[0][1]
+                    # Plusieurs parties (ex: en-têtes + début du texte) : recollées dans l'ordre
+                    raw_email = b''.join(part[1] for part in msg_data if isinstance(part, tuple))
                     msg = email.message_from_bytes(raw_email)
 
                     # Parse les infos
@@ -339,6 +490,7 @@ class ZohoEmailHandler:
                         'received_at': received_at,
                         'order_number': order_number,
                         'imap_id': email_id.decode() if isinstance(email_id, bytes) else email_id,
+                        'uid_validity': current_validity,
                         'is_read': is_read
                     })
 
@@ -371,10 +523,10 @@ class ZohoEmailHandler:
         return None
 
     def mark_as_read(self, imap_id: str):
-        """Marque un email comme lu"""
+        """Marque un email comme lu (imap_id = UID renvoyé par fetch_unread_emails)"""
         if self.imap_connection:
             try:
-                self.imap_connection.store(imap_id.encode(), '+FLAGS', '\\Seen')
+                self.imap_connection.uid('STORE', imap_id.encode(), '+FLAGS', '\\Seen')
             except Exception as e:
                 logger.error(f"Erreur mark as read: {e}")
 
@@ -499,9 +651,8 @@ class ZohoEmailHandler:
         results = {'success_count': 0, 'failed_count': 0, 'failed_ids': []}
 
         for msg_id in message_ids:
-            # Reconnecte pour chaque email pour éviter timeout
-            self.disconnect_imap()
-            if self.connect_imap():
+            # Reconnecte seulement si la connexion a expiré
+            if self.ensure_imap_connection():
                 if self.move_to_spam(msg_id, source_folder):
                     results['success_count'] += 1
                 else:
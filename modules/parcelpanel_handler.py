@@ -30,6 +30,9 @@ class ParcelpanelHandler:
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        # Session keep-alive : réutilise la connexion TLS entre les appels
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
 
     def get_tracking_info(self, tracking_number: str) -> Optional[Dict]:
         """
@@ -45,7 +48,7 @@ class ParcelpanelHandler:
             url = f"{self.BASE_URL}/parcels"
             params = {"tracking_number": tracking_number}
 
-            response = requests.get(url, headers=self.headers, params=params, timeout=10)
+            response = self.session.get(url, params=params, timeout=10)
 
             if response.status_code == 200:
                 data = response.json()
@@ -74,7 +77,7 @@ class ParcelpanelHandler:
             url = f"{self.BASE_URL}/parcels"
             params = {"order_number": order_number}
 
-            response = requests.get(url, headers=self.headers, params=params, timeout=10)
+            response = self.session.get(url, params=params, timeout=10)
 
             if response.status_code == 200:
                 data = response.json()
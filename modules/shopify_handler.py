@@ -28,6 +28,9 @@ class ShopifyHandler:
             "X-Shopify-Access-Token": access_token,
             "Content-Type": "application/json"
         }
+        # Session keep-alive : réutilise la connexion TLS entre les appels
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
 
     def _make_request(self, endpoint: str, method: str = "GET",
                       params: Dict = None) -> Optional[Dict]:
@@ -35,10 +38,9 @@ class ShopifyHandler:
         url = f"{self.base_url}/{endpoint}"
 
         try:
-            response = requests.request(
+            response = self.session.request(
                 method=method,
                 url=url,
-                headers=self.headers,
                 params=params,
                 timeout=30
             )
@@ -56,6 +58,70 @@ class ShopifyHandler:
             logger.error(f"Erreur requête Shopify: {e}")
             return None
 
+    def _graphql_request(self, query: str, variables: Dict = None) -> Optional[Dict]:
+        """Effectue une requête à l'API GraphQL Admin de Shopify"""
+        url = f"{self.base_url}/graphql.json"
+
+        try:
+            response = self.session.post(
+                url,
+                json={"query": query, "variables": variables or {}},
+                timeout=30
+            )
+
+            if response.status_code != 200:
+                logger.error(f"Erreur GraphQL Shopify {response.status_code}: {response.text}")
+                return None
+
+            data = response.json()
+            if data.get('errors'):
+                logger.error(f"Erreur GraphQL Shopify: {data['errors']}")
+                return None
+
+            return data.get('data')
+
+        except Exception as e:
+            logger.error(f"Erreur requête GraphQL Shopify: {e}")
+            return None
+
+    def find_customers_bulk(self, emails: List[str], chunk_size: int = 30) -> Dict[str, str]:
+        """
+        Recherche plusieurs clients par email en une seule requête GraphQL par lot
+
+        Args:
+            emails: Liste d'emails clients
+            chunk_size: Nombre d'emails par requête (limite la taille du filtre Shopify)
+
+        Returns:
+            Dict email (minuscules) -> numéro de la dernière commande
+        """
+        query = """
+        query($filter: String!, $first: Int!) {
+          customers(first: $first, query: $filter) {
+            edges { node { email lastOrder { name } } }
+          }
+        }
+        """
+
+        unique_emails = list(dict.fromkeys(e.lower() for e in emails if e))
+        results = {}
+
+        for i in range(0, len(unique_emails), chunk_size):
+            chunk = unique_emails[i:i + chunk_size]
+            search_filter = " OR ".join(f'email:"{e}"' for e in chunk)
+
+            data = self._graphql_request(query, {"filter": search_filter, "first": len(chunk)})
+            if not data:
+                continue
+
+            for edge in data.get('customers', {}).get('edges', []):
+                node = edge.get('node') or {}
+                last_order = node.get('lastOrder') or {}
+                if node.get('email') and last_order.get('name'):
+                    results[node['email'].lower()] = last_order['name'].replace('#', '')
+
+        return results
+
     def get_order_by_number(self, order_number: str) -> Optional[Dict]:
         """
         Récupère une commande par son numéro
@@ -8,9 +8,10 @@ import hashlib
 import base64
 import requests
 from urllib.parse import urlencode, parse_qs
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import logging
 import json
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
@@ -243,6 +244,12 @@ class ShopifyTokenStorage:
             return tokens[shop_key].get('access_token')
         return None
 
+    def get_tokens_bulk(self, shop_domains: List[str]) -> Dict[str, str]:
+        """Récupère les tokens de plusieurs shops en une seule lecture"""
+        tokens = self._load_tokens()
+        shop_keys = [d.replace('.myshopify.com', '') for d in shop_domains]
+        return {k: tokens[k]['access_token'] for k in shop_keys if tokens.get(k, {}).get('access_token')}
+
     def get_all_shops(self) -> Dict:
         """Retourne tous les shops connectés"""
         return self._load_tokens()
@@ -302,6 +309,14 @@ class ShopifyTokenStorageDB:
         token_record = self.TokenModel.query.filter_by(shop_domain=shop_key).first()
         return token_record.access_token if token_record else None
 
+    def get_tokens_bulk(self, shop_domains: List[str]) -> Dict[str, str]:
+        """Récupère les tokens de plusieurs shops en une seule requête (IN)"""
+        shop_keys = [d.replace('.myshopify.com', '') for d in shop_domains]
+        if not shop_keys:
+            return {}
+        records = self.TokenModel.query.filter(self.TokenModel.shop_domain.in_(shop_keys)).all()
+        return {r.shop_domain: r.access_token for r in records}
+
     def get_all_shops(self) -> Dict:
         """Retourne tous les shops connectés"""
         tokens = self.TokenModel.query.all()
@@ -317,6 +332,21 @@ class ShopifyTokenStorageDB:
             logger.info(f"Token supprimé de la DB pour {shop_key}")
 
 
+@lru_cache(maxsize=1)
+def get_shopify_credentials() -> Dict:
+    """
+    Retourne les credentials multi-boutiques (SHOPIFY_CREDENTIALS).
+
+    Les variables d'environnement ne changent pas en cours de route :
+    le JSON n'est parsé qu'une seule fois par processus.
+    """
+    try:
+        return json.loads(os.getenv('SHOPIFY_CREDENTIALS', '{}'))
+    except json.JSONDecodeError:
+        logger.warning("SHOPIFY_CREDENTIALS n'est pas un JSON valide, utilisation des credentials par défaut")
+        return {}
+
+
 def get_oauth_handler() -> ShopifyOAuth:
     """Factory pour créer un handler OAuth avec les variables d'environnement (credentials par défaut)"""
     client_id = os.getenv('SHOPIFY_CLIENT_ID')
@@ -348,12 +378,7 @@ def get_oauth_handler_for_shop(shop_domain: str) -> ShopifyOAuth:
     scopes = os.getenv('SHOPIFY_SCOPES', 'read_orders,read_customers')
 
     # Essaie de récupérer les credentials spécifiques au shop
-    credentials_json = os.getenv('SHOPIFY_CREDENTIALS', '{}')
-    try:
-        credentials = json.loads(credentials_json)
-    except json.JSONDecodeError:
-        logger.warning("SHOPIFY_CREDENTIALS n'est pas un JSON valide, utilisation des credentials par défaut")
-        credentials = {}
+    credentials = get_shopify_credentials()
 
     if shop_key in credentials:
         shop_creds = credentials[shop_key]
@@ -386,11 +411,7 @@ def get_permanent_access_token(shop_domain: str) -> Optional[str]:
     """
     shop_key = shop_domain.replace('.myshopify.com', '')
 
-    credentials_json = os.getenv('SHOPIFY_CREDENTIALS', '{}')
-    try:
-        credentials = json.loads(credentials_json)
-    except json.JSONDecodeError:
-        return None
+    credentials = get_shopify_credentials()
 
     if shop_key in credentials:
         access_token = credentials[shop_key].get('access_token')
@@ -4,7 +4,7 @@ Apprend des emails marqués comme spam par l'utilisateur
 """
 import re
 import logging
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -862,6 +862,45 @@ CLIENT_PATTERNS = [
 ]
 
 
+# Patterns compilés par liste : plus de 600 patterns au total, soit plus que le cache
+# interne du module re (512 entrées) -> ils étaient recompilés à chaque email analysé
+_COMPILED_PATTERNS: Dict[int, Tuple[int, Optional[re.Pattern], List[Tuple[str, re.Pattern]]]] = {}
+
+
+def _compiled_patterns(patterns: List[str]) -> Tuple[Optional[re.Pattern], List[Tuple[str, re.Pattern]]]:
+    """
+    Retourne (regex combinée, [(pattern, regex compilée)]) pour une liste de patterns
+
+    La regex combinée (alternative de tous les patterns) sert de pré-filtre : un seul
+    passage sur le texte écarte les emails qui ne matchent aucun pattern de la liste.
+    Recompilé si la liste a été complétée entre-temps (add_spam_*_pattern).
+    """
+    cached = _COMPILED_PATTERNS.get(id(patterns))
+    if cached is None or cached[0] != len(patterns):
+        compiled = [(pattern, re.compile(pattern, re.IGNORECASE)) for pattern in patterns]
+        try:
+            combined = re.compile('|'.join(f'(?:{pattern})' for pattern in patterns), re.IGNORECASE)
+        except re.error:
+            combined = None  # Pas de pré-filtre, on teste les patterns un par un
+        cached = (len(patterns), combined, compiled)
+        _COMPILED_PATTERNS[id(patterns)] = cached
+    return cached[1], cached[2]
+
+
+def _matching_patterns(patterns: List[str], text: str) -> Iterator[str]:
+    """Patterns de la liste (dans l'ordre) qui matchent le texte"""
+    combined, compiled = _compiled_patterns(patterns)
+    if combined is not None and not combined.search(text):
+        return
+    for pattern, regex in compiled:
+        if regex.search(text):
+            yield pattern
+
+
+# Adresse Gmail générique : prénom + chiffres ou prénom + mot + chiffres
+GMAIL_SUSPECT_RE = re.compile(r'^[a-z]+\d{2,}$|^[a-z]+[a-z]+\d+$')
+
+
 def is_tools_email(sender_email: str, sender_name: str, subject: str) -> Tuple[bool, str]:
     """
     Détecte si l'email provient d'un outil/service utilisé (Clarity, TikTok, etc.)
@@ -877,17 +916,16 @@ def is_tools_email(sender_email: str, sender_name: str, subject: str) -> Tuple[b
     subject_lower = subject.lower() if subject else ''
 
     # Vérifie si le domaine est un domaine d'outil connu
-    for pattern in TOOLS_DOMAINS:
-        if re.search(pattern, sender_lower, re.IGNORECASE):
-            # Extrait le nom de l'outil du domaine
-            tool_name = sender_lower.split('@')[-1].split('.')[0] if '@' in sender_lower else 'tool'
-            return True, tool_name
+    if next(_matching_patterns(TOOLS_DOMAINS, sender_lower), None):
+        # Extrait le nom de l'outil du domaine
+        tool_name = sender_lower.split('@')[-1].split('.')[0] if '@' in sender_lower else 'tool'
+        return True, tool_name
 
     # Vérifie les patterns dans le sujet ou le nom
     full_text = f"{name_lower} {subject_lower}"
-    for pattern in TOOLS_PATTERNS:
-        if re.search(pattern, full_text, re.IGNORECASE):
-            return True, pattern.split('\\s*')[0].replace('\\', '')
+    pattern = next(_matching_patterns(TOOLS_PATTERNS, full_text), None)
+    if pattern:
+        return True, pattern.split('\\s*')[0].replace('\\', '')
 
     return False, ""
 
@@ -949,14 +987,12 @@ def is_whitelisted(sender_email: str, subject: str) -> bool:
     subject_lower = subject.lower() if subject else ''
 
     # Check whitelist expéditeurs
-    for pattern in WHITELIST_SENDERS:
-        if re.search(pattern, sender_lower, re.IGNORECASE):
-            return True
+    if next(_matching_patterns(WHITELIST_SENDERS, sender_lower), None):
+        return True
 
     # Check whitelist sujets
-    for pattern in WHITELIST_SUBJECTS:
-        if re.search(pattern, subject_lower, re.IGNORECASE):
-            return True
+    if next(_matching_patterns(WHITELIST_SUBJECTS, subject_lower), None):
+        return True
 
     return False
 
@@ -977,9 +1013,9 @@ def is_real_client(subject: str, body: str) -> Tuple[bool, str]:
     full_text = f"{subject_lower} {body_lower}"
 
     # Vérifie si l'email contient des patterns de vrai client
-    for pattern in CLIENT_PATTERNS:
-        if re.search(pattern, full_text, re.IGNORECASE):
-            return True, f"client_pattern:{pattern[:25]}"
+    pattern = next(_matching_patterns(CLIENT_PATTERNS, full_text), None)
+    if pattern:
+        return True, f"client_pattern:{pattern[:25]}"
 
     return False, "no_client_pattern"
 
@@ -1031,33 +1067,30 @@ def detect_spam(sender_email: str, sender_name: str, subject: str, body: str) ->
     reasons = []
 
     # Check patterns expéditeur (poids: 0.4)
-    for pattern in SPAM_SENDER_PATTERNS:
-        if re.search(pattern, sender_lower, re.IGNORECASE):
-            spam_score += 0.4
-            reasons.append(f"sender_pattern:{pattern[:20]}")
-            break
+    pattern = next(_matching_patterns(SPAM_SENDER_PATTERNS, sender_lower), None)
+    if pattern:
+        spam_score += 0.4
+        reasons.append(f"sender_pattern:{pattern[:20]}")
 
     # Check patterns sujet (poids: 0.35)
     subject_matches = 0
-    for pattern in SPAM_SUBJECT_PATTERNS:
-        if re.search(pattern, subject_lower, re.IGNORECASE):
-            subject_matches += 1
-            if subject_matches == 1:
-                spam_score += 0.35
-                reasons.append(f"subject_pattern:{pattern[:20]}")
-            elif subject_matches > 1:
-                spam_score += 0.1  # Bonus pour multiples matches
+    for pattern in _matching_patterns(SPAM_SUBJECT_PATTERNS, subject_lower):
+        subject_matches += 1
+        if subject_matches == 1:
+            spam_score += 0.35
+            reasons.append(f"subject_pattern:{pattern[:20]}")
+        elif subject_matches > 1:
+            spam_score += 0.1  # Bonus pour multiples matches
 
     # Check patterns body (poids: 0.25)
     body_matches = 0
-    for pattern in SPAM_BODY_PATTERNS:
-        if re.search(pattern, body_lower, re.IGNORECASE):
-            body_matches += 1
-            if body_matches == 1:
-                spam_score += 0.25
-                reasons.append(f"body_pattern:{pattern[:20]}")
-            elif body_matches > 1:
-                spam_score += 0.05
+    for pattern in _matching_patterns(SPAM_BODY_PATTERNS, body_lower):
+        body_matches += 1
+        if body_matches == 1:
+            spam_score += 0.25
+            reasons.append(f"body_pattern:{pattern[:20]}")
+        elif body_matches > 1:
+            spam_score += 0.05
 
     # Bonus si le nom de l'expéditeur contient des mots suspects
     suspicious_names = [
@@ -1082,8 +1115,7 @@ def detect_spam(sender_email: str, sender_name: str, subject: str, body: str) ->
     if '@gmail.com' in sender_lower:
         # Vérifie si c'est un pattern de nom africain/démarcheur typique
         gmail_name = sender_lower.split('@')[0]
-        # Pattern: prénom + chiffres ou prénom + mot + chiffres
-        if re.search(r'^[a-z]+\d{2,}$', gmail_name) or re.search(r'^[a-z]+[a-z]+\d+$', gmail_name):
+        if GMAIL_SUSPECT_RE.search(gmail_name):
             spam_score += 0.3
             reasons.append("gmail_suspect_pattern")
 
@@ -0,0 +1,11 @@
+"""
+Tests Avena SAV
+
+Les tests qui importent l'application utilisent une base SQLite temporaire
+(jamais la base configurée dans .env).
+"""
+import os
+import tempfile
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'avena_sav_test.db')
+os.environ['AI_BATCH_ENABLED'] = 'false'
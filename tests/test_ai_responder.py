@@ -0,0 +1,165 @@
+"""
+Tests du responder Gemini (sans appel réseau : la session HTTP partagée est remplacée)
+"""
+import unittest
+
+import orjson
+
+import re
+
+import modules.ai_responder as ai_responder
+from modules.ai_responder import AIResponder, BatchJobFailed, LANG_KEYWORDS_RE, _keyword_trie_pattern
+
+
+class FakeResponse:
+
+    def __init__(self, payload=None, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Remplace _gemini_session() : réponses prévues à l'avance, requêtes enregistrées"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def _next(self, url, **kwargs):
+        self.requests.append((url, kwargs))
+        return self.responses.pop(0)
+
+    post = get = _next
+
+
+class GeminiTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = None
+        self._original_session = ai_responder._gemini_session
+        ai_responder._gemini_session = lambda: self.session
+
+    def tearDown(self):
+        ai_responder._gemini_session = self._original_session
+
+
+def inlined(key, text):
+    return {'metadata': {'key': key}, 'response': {'candidates': [{'content': {'parts': [{'text': text}]}}]}}
+
+
+class PollClassificationBatchTest(GeminiTestCase):
+
+    def test_results_by_email_key(self):
+        self.session = FakeSession(FakeResponse({
+            'metadata': {'state': 'BATCH_STATE_SUCCEEDED'},
+            'response': {'inlinedResponses': {'inlinedResponses': [
+                inlined('12', orjson.dumps({'category': 'AUTO', 'confidence': 0.93}).decode()),
+                inlined('15', '```json\n{"category": "MANUEL", "confidence": 0.8}\n```'),
+                inlined('17', 'pas du JSON'),  # Réponse inexploitable : validation humaine
+            ]}}
+        }))
+
+        results = AIResponder('key').poll_classification_batch('batches/abc')
+
+        self.assertEqual(results, {'12': ('AUTO', 0.93), '15': ('MANUEL', 0.8), '17': ('MANUEL', 0.0)})
+
+    def test_running_job(self):
+        self.session = FakeSession(FakeResponse({'metadata': {'state': 'BATCH_STATE_RUNNING'}}))
+
+        self.assertIsNone(AIResponder('key').poll_classification_batch('batches/abc'))
+
+    def test_terminal_failures(self):
+        for response in (FakeResponse({'metadata': {'state': 'BATCH_STATE_EXPIRED'}}),
+                         FakeResponse({'metadata': {'state': 'BATCH_STATE_FAILED'}}),
+                         FakeResponse(status_code=404)):
+            self.session = FakeSession(response)
+            with self.assertRaises(BatchJobFailed):
+                AIResponder('key').poll_classification_batch('batches/abc')
+
+    def test_transient_error_is_not_terminal(self):
+        self.session = FakeSession(FakeResponse(status_code=503))
+
+        with self.assertRaises(Exception) as raised:
+            AIResponder('key').poll_classification_batch('batches/abc')
+        self.assertNotIsInstance(raised.exception, BatchJobFailed)
+
+
+def reply(text):
+    return FakeResponse({'candidates': [{'content': {'parts': [{'text': text}]}}]})
+
+
+class KeyRotationTest(GeminiTestCase):
+
+    def test_rotates_on_429(self):
+        self.session = FakeSession(FakeResponse(status_code=429), reply('Bonjour'), reply('Encore'))
+        responder = AIResponder(['key-1', 'key-2', 'key-3'])
+
+        self.assertEqual(responder._call_gemini('prompt', max_tokens=50), 'Bonjour')
+        # La clé limitée est abandonnée pour les appels suivants aussi
+        self.assertEqual(responder._call_gemini('prompt', max_tokens=50), 'Encore')
+        self.assertEqual([kwargs['params']['key'] for _, kwargs in self.session.requests], ['key-1', 'key-2', 'key-2'])
+
+    def test_all_keys_limited(self):
+        self.session = FakeSession(FakeResponse(status_code=429), FakeResponse(status_code=429))
+        responder = AIResponder(['key-1', 'key-2'])
+
+        with self.assertRaises(Exception):
+            responder._call_gemini('prompt', max_tokens=50)
+        self.assertEqual(len(self.session.requests), 2)  # Une tentative par clé, pas de boucle
+
+    def test_single_key(self):
+        self.session = FakeSession(FakeResponse(status_code=429))
+        responder = AIResponder('only-key')
+
+        with self.assertRaises(Exception):
+            responder._call_gemini('prompt', max_tokens=50)
+        self.assertEqual(len(self.session.requests), 1)
+
+    def test_session_does_not_retry_429(self):
+        # La rotation doit être immédiate : la session partagée ne relance pas un 429 sur la même clé
+        retry = self._original_session().get_adapter('https://generativelanguage.googleapis.com').max_retries
+        self.assertNotIn(429, retry.status_forcelist)
+
+
+class LanguageDetectionTest(unittest.TestCase):
+
+    def test_trie_pattern_matches_each_word(self):
+        words = {'ma', 'mes', 'mon', 'mi', 'mio', 'mijn'}
+        pattern = re.compile(_keyword_trie_pattern(words))
+
+        for word in words:
+            self.assertTrue(pattern.fullmatch(word), word)
+        for other in ('m', 'me', 'mo', 'mij', 'mios'):
+            self.assertIsNone(pattern.fullmatch(other), other)
+
+    def test_longest_keyword_first(self):
+        # "mio" et "mijn" ne s'arrêtent pas au mot clé plus court "mi"
+        self.assertEqual(LANG_KEYWORDS_RE.findall('mio mijn meine mes'), ['mio', 'mijn', 'meine', 'mes'])
+
+    def test_keywords_at_word_start_only(self):
+        # "ma" n'est pas trouvé au milieu de "informatique", "the" pas dans "other"
+        self.assertEqual(LANG_KEYWORDS_RE.findall('informatique other'), [])
+        self.assertEqual(LANG_KEYWORDS_RE.findall('thanks'), ['thank'])
+
+    def test_detect_language(self):
+        responder = AIResponder('key')
+
+        self.assertEqual(responder.detect_language('Hello, where is my order? Thank you, please send the tracking'), 'en')
+        self.assertEqual(responder.detect_language('Hallo, wann kommt meine Bestellung? Danke und bitte antworten'), 'de')
+        self.assertEqual(responder.detect_language('Bonjour, je n\'ai pas reçu ma commande, merci de vérifier'), 'fr')
+        self.assertEqual(responder.detect_language('Hello there'), 'fr')  # Trop court : défaut
+        self.assertEqual(responder.detect_language('Hello there, my order', 'kunde@beispiel.de'), 'de')
+
+
+if __name__ == '__main__':
+    unittest.main()
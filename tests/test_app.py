@@ -0,0 +1,149 @@
+"""
+Tests des routes de l'application (base SQLite temporaire, voir tests/__init__.py)
+"""
+import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+import app as app_module
+from app import app, AI_BATCH_SETTING, apply_classification_batch
+from models import db, Email, SentEmail, Settings
+from modules.ai_responder import BatchJobFailed
+
+
+@contextmanager
+def count_statements():
+    """Compte les requêtes SQL émises dans le bloc (recette before_cursor_execute)"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class AppTestCase(unittest.TestCase):
+    """Contexte applicatif et tables vidées avant chaque test"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+
+class ConversationTest(AppTestCase):
+
+    def test_conversation_in_two_statements(self):
+        first = Email(message_id='<r1@client>', sender_email='Client@Example.com', subject='Commande',
+                      body='Où est ma commande ?', received_at=datetime(2026, 1, 1, 9))
+        db.session.add_all([
+            first,
+            Email(message_id='<r2@client>', sender_email='client@example.com', subject='Relance',
+                  body='Toujours rien', received_at=datetime(2026, 1, 3, 9)),
+            Email(message_id='<other@client>', sender_email='other@example.com', subject='Autre',
+                  body='Autre client', received_at=datetime(2026, 1, 2, 9)),
+        ])
+        db.session.flush()
+        db.session.add_all([
+            SentEmail(message_id='<s1@avena>', recipient_email='CLIENT@example.com', subject='Re: Commande',
+                      body='Elle arrive', sent_at=datetime(2026, 1, 2, 10), original_email_id=first.id),
+            SentEmail(message_id='<s2@avena>', recipient_email='client@example.com', subject='Re: Relance',
+                      body='Voici le suivi', sent_at=datetime(2026, 1, 4, 10)),
+        ])
+        db.session.commit()
+        email_id = first.id
+        db.session.expunge_all()
+
+        with count_statements() as statements:
+            response = self.client.get(f'/api/emails/{email_id}/conversation')
+
+        data = response.get_json()
+        self.assertTrue(data['success'])
+        self.assertLessEqual(len(statements), 2)  # email principal puis fil complet (UNION ALL)
+        self.assertEqual(
+            [message['message_id'] for message in data['conversation']],
+            ['<r1@client>', '<s1@avena>', '<r2@client>', '<s2@avena>']
+        )
+        self.assertTrue(data['has_reply'])
+
+
+class FakeBatchResponder:
+    """Responder factice : poll_classification_batch renvoie (ou lève) le résultat prévu"""
+
+    def __init__(self, result):
+        self.result = result
+
+    def poll_classification_batch(self, batch_name):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class ApplyClassificationBatchTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._original_get_ai_responder = app_module.get_ai_responder
+        submitted_at = datetime.utcnow() - timedelta(hours=1)
+
+        self.emails = [
+            Email(message_id=f'<m{i}@client>', sender_email=f'c{i}@example.com', subject='Question',
+                  body='...', category='PENDING', status='pending', updated_at=submitted_at - timedelta(minutes=1))
+            for i in range(3)
+        ]
+        db.session.add_all(self.emails)
+        db.session.add(Settings(key=AI_BATCH_SETTING, value='batches/abc', updated_at=submitted_at))
+        db.session.commit()
+
+    def tearDown(self):
+        app_module.get_ai_responder = self._original_get_ai_responder
+        super().tearDown()
+
+    def use_result(self, result):
+        app_module.get_ai_responder = lambda: FakeBatchResponder(result)
+
+    def categories(self):
+        db.session.expire_all()
+        return [(email.category, email.confidence) for email in Email.query.order_by(Email.id)]
+
+    def test_results_update_categories(self):
+        first, second, third = self.emails
+        # Décision manuelle prise après l'envoi du job : le résultat différé ne l'écrase pas
+        third.category = 'SPAM'
+        db.session.commit()
+        self.use_result({str(first.id): ('AUTO', 0.9), str(second.id): ('MANUEL', 0.7), str(third.id): ('AUTO', 0.95)})
+
+        self.assertEqual(apply_classification_batch(), ('batches/abc', 2))
+        self.assertEqual(self.categories(), [('AUTO', 0.9), ('MANUEL', 0.7), ('SPAM', None)])
+        self.assertIsNone(Settings.query.filter_by(key=AI_BATCH_SETTING).first())
+
+    def test_running_job_is_kept(self):
+        self.use_result(None)
+
+        self.assertEqual(apply_classification_batch(), ('batches/abc', None))
+        self.assertIsNotNone(Settings.query.filter_by(key=AI_BATCH_SETTING).first())
+
+    def test_failed_job_is_released(self):
+        self.use_result(BatchJobFailed('expired'))
+
+        with self.assertRaises(BatchJobFailed):
+            apply_classification_batch()
+        self.assertIsNone(Settings.query.filter_by(key=AI_BATCH_SETTING).first())
+        self.assertEqual(self.categories(), [('PENDING', None)] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tests du découpage des réponses FETCH IMAP (ZohoEmailHandler.fetch_parts)
+"""
+import unittest
+
+from modules.email_handler import ZohoEmailHandler
+
+
+class FakeIMAP:
+    """Connexion IMAP factice : renvoie la réponse FETCH fournie"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def uid(self, command, id_set, items):
+        return 'OK', self.data
+
+    def fetch(self, id_set, items):
+        return 'OK', self.data
+
+
+def make_handler(data):
+    handler = ZohoEmailHandler('sav@example.com', 'secret')
+    handler.imap_connection = FakeIMAP(data)
+    return handler
+
+
+class FetchPartsTest(unittest.TestCase):
+
+    def test_uid_equal_to_other_sequence_number(self):
+        # A (séquence 3, UID 5) puis B (séquence 5, UID 8) : B ne doit pas écraser A
+        data = [
+            (b'3 (UID 5 BODY[HEADER.FIELDS (SUBJECT)] {12}', b'Subject: A\r\n'),
+            b')',
+            (b'5 (UID 8 BODY[HEADER.FIELDS (SUBJECT)] {12}', b'Subject: B\r\n'),
+            b')',
+        ]
+        parts = make_handler(data).fetch_parts([b'5', b'8'], '(BODY.PEEK[HEADER.FIELDS (SUBJECT)])', uid=True)
+
+        self.assertEqual(set(parts), {b'5', b'8'})
+        self.assertEqual(parts[b'5']['HEADER'], b'Subject: A\r\n')
+        self.assertEqual(parts[b'8']['HEADER'], b'Subject: B\r\n')
+
+    def test_trailing_uid(self):
+        # Certains serveurs renvoient l'UID après les parties : b' UID 345)'
+        data = [
+            (b'3 (BODY[HEADER] {9}', b'Header A\n'),
+            (b' BODY[TEXT] {6}', b'Body A'),
+            b' UID 5)',
+            (b'5 (BODY[HEADER] {9}', b'Header B\n'),
+            b' UID 8)',
+        ]
+        parts = make_handler(data).fetch_parts([b'5', b'8'], '(BODY.PEEK[HEADER] BODY.PEEK[TEXT])', uid=True)
+
+        self.assertEqual(set(parts), {b'5', b'8'})
+        self.assertEqual(parts[b'5'], {'HEADER': b'Header A\n', 'TEXT': b'Body A'})
+        self.assertEqual(parts[b'8'], {'HEADER': b'Header B\n'})
+
+    def test_sequence_numbers(self):
+        data = [(b'3 (BODY[TEXT] {1}', b'a'), b')', (b'5 (BODY[TEXT] {1}', b'b'), b')']
+        parts = make_handler(data).fetch_parts([b'3', b'5'], '(BODY.PEEK[TEXT])')
+
+        self.assertEqual(parts, {b'3': {'TEXT': b'a'}, b'5': {'TEXT': b'b'}})
+
+
+class FetchUnreadEmailsTest(unittest.TestCase):
+
+    def test_readonly_folder_is_examined(self):
+        # Lecture seule : le dossier est ouvert avec EXAMINE, le FETCH RFC822 ne marque rien comme lu
+        class SelectRecorder(FakeIMAP):
+            def select(self, mailbox, readonly=False):
+                self.readonly = readonly
+                return 'NO', [b'']
+
+        handler = make_handler([])
+        handler.imap_connection = SelectRecorder([])
+        self.assertEqual(handler.fetch_unread_emails(folder='Sent', readonly=True), [])
+        self.assertTrue(handler.imap_connection.readonly)
+
+
+if __name__ == '__main__':
+    unittest.main()
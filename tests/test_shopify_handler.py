@@ -0,0 +1,75 @@
+"""
+Tests de la recherche groupée de clients Shopify (ShopifyHandler.find_customers_bulk)
+"""
+import unittest
+
+from modules.shopify_handler import ShopifyHandler
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.text = ''
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession:
+    """Session factice : enregistre les variables GraphQL et renvoie les réponses prévues"""
+
+    def __init__(self, *payloads):
+        self.payloads = list(payloads)
+        self.variables = []
+
+    def post(self, url, json=None, timeout=None):
+        self.variables.append(json['variables'])
+        return FakeResponse(self.payloads.pop(0))
+
+
+def customers(*nodes):
+    return {'data': {'customers': {'edges': [{'node': node} for node in nodes]}}}
+
+
+class FindCustomersBulkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ShopifyHandler('boutique-test', 'token')
+
+    def test_maps_each_email_to_last_order(self):
+        self.handler.session = FakeSession(customers(
+            {'email': 'Alice@Example.com', 'lastOrder': {'name': '#1042'}},
+            {'email': 'bob@example.com', 'lastOrder': None},  # Client sans commande
+            {'email': 'carol@example.com', 'lastOrder': {'name': '1077'}},
+        ))
+
+        result = self.handler.find_customers_bulk(['alice@example.com', 'BOB@example.com', 'carol@example.com'])
+
+        self.assertEqual(result, {'alice@example.com': '1042', 'carol@example.com': '1077'})
+
+    def test_deduplicates_and_chunks_emails(self):
+        self.handler.session = FakeSession(
+            customers({'email': 'a@example.com', 'lastOrder': {'name': '#1'}}),
+            customers({'email': 'c@example.com', 'lastOrder': {'name': '#3'}}),
+        )
+
+        result = self.handler.find_customers_bulk(
+            ['a@example.com', 'A@example.com', 'b@example.com', None, 'c@example.com'], chunk_size=2
+        )
+
+        self.assertEqual(result, {'a@example.com': '1', 'c@example.com': '3'})
+        self.assertEqual(self.handler.session.variables, [
+            {'filter': 'email:"a@example.com" OR email:"b@example.com"', 'first': 2},
+            {'filter': 'email:"c@example.com"', 'first': 1},
+        ])
+
+    def test_graphql_errors_skip_the_chunk(self):
+        self.handler.session = FakeSession({'errors': [{'message': 'Throttled'}]})
+
+        self.assertEqual(self.handler.find_customers_bulk(['a@example.com']), {})
+
+
+if __name__ == '__main__':
+    unittest.main()